@@ -0,0 +1,203 @@
+import json
+import os
+import threading
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from ai.embeddings import normalize_rows, top_k_similar
+from ai.index import EMBEDDINGS_DIR, EmbeddingIndex
+from database.services import APIEndpoint
+
+# Directory (inside EMBEDDINGS_DIR) of the index over the endpoints of all services
+ANN_INDEX_NAME = "all_services"
+DEFAULT_NPROBE = 8
+# Below this size brute force is fast enough, the index keeps a single cluster
+MIN_CLUSTERED_ROWS = 4096
+ASSIGN_CHUNK_SIZE = 4096
+
+
+def assign_clusters(matrix: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # chunked so the (rows x clusters) similarity matrix stays small
+    labels = np.empty(len(matrix), dtype=np.int64)
+    for start in range(0, len(matrix), ASSIGN_CHUNK_SIZE):
+        chunk = matrix[start : start + ASSIGN_CHUNK_SIZE]
+        labels[start : start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return labels
+
+
+def spherical_kmeans(
+    matrix: np.ndarray, n_clusters: int, iterations: int = 10, seed: int = 0
+) -> np.ndarray:
+    """
+    Clusters L2-normalized rows by cosine similarity. Returns the normalized
+    centroids, (n_clusters, dim).
+    """
+    rng = np.random.default_rng(seed)
+    centroids = np.array(matrix[rng.choice(len(matrix), n_clusters, replace=False)])
+
+    for _ in range(iterations):
+        labels = assign_clusters(matrix, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, matrix)
+        counts = np.bincount(labels, minlength=n_clusters)
+
+        # re-seed empty clusters with random rows
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = matrix[rng.choice(len(matrix), len(empty), replace=False)]
+        centroids = normalize_rows(sums)
+
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted file index for approximate nearest neighbour search: rows are grouped
+    by their closest k-means centroid and a query is only compared with the rows
+    of the nprobe clusters closest to it.
+
+    Rows are stored sorted by cluster, `offsets[c]:offsets[c + 1]` being the rows
+    of cluster c.
+    """
+
+    def __init__(self, centroids, offsets, ids, matrix, fingerprint=None):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.ids = ids
+        self.matrix = matrix
+        self.fingerprint = fingerprint
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(
+        cls,
+        ids: np.ndarray,
+        matrix: np.ndarray,
+        n_clusters: Optional[int] = None,
+        fingerprint=None,
+        seed: int = 0,
+    ):
+        """
+        Builds the index over normalized rows, by default with ~4*sqrt(n) clusters,
+        or a single one (exact search) for less than MIN_CLUSTERED_ROWS rows.
+        """
+        if len(matrix) == 0:
+            return cls(matrix, np.zeros(1, dtype=np.int64), ids, matrix, fingerprint)
+
+        if n_clusters is None:
+            n_clusters = (
+                int(4 * np.sqrt(len(matrix))) if len(matrix) >= MIN_CLUSTERED_ROWS else 1
+            )
+        n_clusters = max(1, min(n_clusters, len(matrix)))
+
+        centroids = spherical_kmeans(matrix, n_clusters, seed=seed)
+        labels = assign_clusters(matrix, centroids)
+        order = np.argsort(labels, kind="stable")
+        offsets = np.zeros(n_clusters + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(labels, minlength=n_clusters))
+
+        return cls(
+            centroids.astype(np.float32),
+            offsets,
+            np.asarray(ids)[order],
+            np.ascontiguousarray(matrix[order], dtype=np.float32),
+            fingerprint,
+        )
+
+    def search(
+        self, query: np.ndarray, top_k: int = 10, nprobe: int = DEFAULT_NPROBE
+    ) -> List[Tuple[int, float]]:
+        """
+        Returns the approximate (endpoint id, cosine similarity) of the top_k closest
+        endpoints to the query, sorted by similarity in descending order.
+        """
+        if len(self) == 0:
+            return []
+
+        clusters, _ = top_k_similar(query, self.centroids, nprobe)
+        rows = np.concatenate(
+            [np.arange(self.offsets[c], self.offsets[c + 1]) for c in clusters]
+        )
+        indices, scores = top_k_similar(query, self.matrix[rows], top_k)
+        return [
+            (int(self.ids[rows[i]]), float(score)) for i, score in zip(indices, scores)
+        ]
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        arrays = {
+            "centroids": self.centroids,
+            "offsets": self.offsets,
+            "ids": self.ids,
+            "matrix": self.matrix,
+        }
+        for name, array in arrays.items():
+            path = os.path.join(directory, f"{name}.npy")
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(tmp_path, path)
+
+        # the metadata goes last, it is what makes the new arrays current
+        path = os.path.join(directory, "index.json")
+        with open(f"{path}.{os.getpid()}.tmp", "w") as f:
+            json.dump({"fingerprint": self.fingerprint}, f)
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+    @classmethod
+    def load(cls, directory: str, fingerprint):
+        """
+        Memory-maps a saved index. Returns None when it is missing or was built for
+        another fingerprint, see APIEndpoint.get_all_embeddings_fingerprint.
+        """
+        if fingerprint is None or None in fingerprint:
+            return None
+        try:
+            with open(os.path.join(directory, "index.json")) as f:
+                saved_fingerprint = tuple(json.load(f)["fingerprint"])
+            if saved_fingerprint != tuple(fingerprint):
+                return None
+            arrays = {
+                name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+                for name in ["centroids", "offsets", "ids", "matrix"]
+            }
+        except (OSError, ValueError, KeyError):
+            return None
+        return cls(fingerprint=saved_fingerprint, **arrays)
+
+
+def build_ann_index(session, directory: str = EMBEDDINGS_DIR) -> IVFIndex:
+    """Builds the index over the endpoints of all services and saves it."""
+    fingerprint = APIEndpoint.get_all_embeddings_fingerprint(session)
+    index = EmbeddingIndex.from_rows(APIEndpoint.get_embedding_rows(None, session))
+    ann_index = IVFIndex.build(index.ids, index.matrix, fingerprint=fingerprint)
+    ann_index.save(os.path.join(directory, ANN_INDEX_NAME))
+    return ann_index
+
+
+_ann_index = None
+_lock = threading.Lock()
+
+
+def get_ann_index() -> IVFIndex:
+    """
+    Returns the process-wide index over all services, memory-mapping the one saved
+    by populate_db.py. When it is missing or out of date the index is built in
+    memory from the database instead.
+    """
+    global _ann_index
+    fingerprint = APIEndpoint.get_all_embeddings_fingerprint()
+    if _ann_index is not None and _ann_index.fingerprint == fingerprint:
+        return _ann_index
+
+    with _lock:
+        if _ann_index is None or _ann_index.fingerprint != fingerprint:
+            _ann_index = IVFIndex.load(
+                os.path.join(EMBEDDINGS_DIR, ANN_INDEX_NAME), fingerprint
+            )
+            if _ann_index is None:
+                index = EmbeddingIndex.from_rows(APIEndpoint.get_embedding_rows(None))
+                _ann_index = IVFIndex.build(index.ids, index.matrix, fingerprint=fingerprint)
+    return _ann_index
@@ -0,0 +1,197 @@
+import importlib.util
+import os
+import threading
+from typing import Dict, Optional
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+from ai.models import get_model
+from ai.rate_limit import RateLimiter
+
+# Connection pool shared by all the OpenAI (completions and embeddings) requests
+# of the process. Connections are kept alive between requests, so only the first
+# requests pay for the TCP and TLS handshakes.
+MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+KEEPALIVE_EXPIRY = 60  # seconds
+HTTP_TIMEOUT = httpx.Timeout(90, connect=10)  # seconds
+# HTTP/2 multiplexes concurrent requests over a single connection, it needs the
+# optional h2 package
+HTTP2 = os.getenv("LLM_HTTP2", "1") != "0" and importlib.util.find_spec("h2") is not None
+
+# Rate limits of the completions, requests and tokens (prompt + completion) per
+# minute. When unset, each model gets the limits of ai.models.
+MAX_REQS_MINUTE = int(os.getenv("LLM_MAX_REQS_MINUTE", "0")) or None
+MAX_TOKENS_MINUTE = int(os.getenv("LLM_MAX_TOKENS_MINUTE", "0")) or None
+
+
+class PoolMetrics:
+    """
+    Counts requests and newly opened connections through the httpx trace
+    extension. A low connections / requests ratio means connections are reused.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.connections_opened = 0
+        self._lock = threading.Lock()
+
+    def _count(self, event_name: Optional[str] = None):
+        with self._lock:
+            if event_name is None:
+                self.requests += 1
+            elif event_name == "connection.connect_tcp.complete":
+                self.connections_opened += 1
+
+    def sync_hooks(self) -> dict:
+        def on_request(request: httpx.Request):
+            self._count()
+            request.extensions["trace"] = lambda event_name, info: self._count(event_name)
+
+        return {"request": [on_request]}
+
+    def async_hooks(self) -> dict:
+        async def trace(event_name, info):
+            self._count(event_name)
+
+        async def on_request(request: httpx.Request):
+            self._count()
+            request.extensions["trace"] = trace
+
+        return {"request": [on_request]}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "connections_opened": self.connections_opened}
+
+
+def pool_connections(client) -> Optional[dict]:
+    # httpcore doesn't expose the pool publicly, report it only when available
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    connections = getattr(pool, "connections", None)
+    if connections is None:
+        return None
+    return {
+        "open": len(connections),
+        "idle": sum(1 for c in connections if c.is_idle()),
+    }
+
+
+class ClientRegistry:
+    """
+    Process-wide HTTP and OpenAI clients, created on first use. The async clients
+    are bound to the event loop that first uses them, the shared loop of
+    ai.executor in the app.
+    """
+
+    def __init__(self):
+        self.sync_metrics = PoolMetrics()
+        self.async_metrics = PoolMetrics()
+        self._lock = threading.Lock()
+        self._http_client: Optional[httpx.Client] = None
+        self._async_http_client: Optional[httpx.AsyncClient] = None
+        self._openai_client: Optional[OpenAI] = None
+        self._async_openai_client: Optional[AsyncOpenAI] = None
+        self._limiters: Dict[str, RateLimiter] = {}
+
+    @staticmethod
+    def _limits() -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        )
+
+    def http_client(self) -> httpx.Client:
+        if self._http_client is None:
+            with self._lock:
+                if self._http_client is None:
+                    self._http_client = httpx.Client(
+                        limits=self._limits(),
+                        timeout=HTTP_TIMEOUT,
+                        http2=HTTP2,
+                        event_hooks=self.sync_metrics.sync_hooks(),
+                    )
+        return self._http_client
+
+    def async_http_client(self) -> httpx.AsyncClient:
+        if self._async_http_client is None:
+            with self._lock:
+                if self._async_http_client is None:
+                    self._async_http_client = httpx.AsyncClient(
+                        limits=self._limits(),
+                        timeout=HTTP_TIMEOUT,
+                        http2=HTTP2,
+                        event_hooks=self.async_metrics.async_hooks(),
+                    )
+        return self._async_http_client
+
+    def openai_client(self) -> OpenAI:
+        if self._openai_client is None:
+            http_client = self.http_client()
+            with self._lock:
+                if self._openai_client is None:
+                    self._openai_client = OpenAI(http_client=http_client)
+        return self._openai_client
+
+    def async_openai_client(self) -> AsyncOpenAI:
+        if self._async_openai_client is None:
+            http_client = self.async_http_client()
+            with self._lock:
+                if self._async_openai_client is None:
+                    self._async_openai_client = AsyncOpenAI(http_client=http_client)
+        return self._async_openai_client
+
+    def limiter(self, model: str) -> RateLimiter:
+        """
+        Rate limiter of the LLM completions of a model, shared by all the
+        AiHandlers. The API limits each model separately.
+        """
+        limiter = self._limiters.get(model)
+        if limiter is None:
+            info = get_model(model)
+            with self._lock:
+                limiter = self._limiters.setdefault(
+                    model,
+                    RateLimiter(
+                        MAX_REQS_MINUTE or info.requests_per_minute,
+                        MAX_TOKENS_MINUTE or info.tokens_per_minute,
+                    ),
+                )
+        return limiter
+
+    def limiter_stats(self) -> dict:
+        return {model: limiter.stats() for model, limiter in list(self._limiters.items())}
+
+    def stats(self) -> dict:
+        stats = {
+            "http2": HTTP2,
+            "sync": self.sync_metrics.stats(),
+            "async": self.async_metrics.stats(),
+        }
+        for name, client in [("sync", self._http_client), ("async", self._async_http_client)]:
+            if client is not None:
+                stats[name]["pool"] = pool_connections(client)
+        return stats
+
+
+clients = ClientRegistry()
+
+
+def get_openai_client() -> OpenAI:
+    """Returns the OpenAI client shared by the whole process."""
+    return clients.openai_client()
+
+
+def get_async_openai_client() -> AsyncOpenAI:
+    """Returns the async OpenAI client shared by the whole process."""
+    return clients.async_openai_client()
+
+
+def configure_litellm():
+    """Makes litellm send its OpenAI requests through the shared connection pools."""
+    import litellm
+
+    litellm.client_session = clients.http_client()
+    litellm.aclient_session = clients.async_http_client()
@@ -0,0 +1,325 @@
+import json
+from typing import Dict, List, Optional, Tuple
+
+from ai.embeddings import clip_tokens, count_tokens
+from database.services import TOKENS_FIELD
+
+# Longest descriptions kept, in characters: of the operation and the parameters,
+# and of the properties of the schemas
+MAX_DESCRIPTION_LENGTH = 300
+MAX_PROPERTY_DESCRIPTION_LENGTH = 80
+MAX_ENUM_VALUES = 10
+MAX_ALTERNATIVES = 3  # oneOf / anyOf / allOf
+# Nested levels of properties kept in the request body schemas
+REQUEST_DEPTH = 4
+# Compaction levels, tried in order until an endpoint fits the budget: nested
+# levels of properties kept in the response schema (0 drops it)
+RESPONSE_DEPTHS = (3, 1, 0)
+# Objects at least this long, once serialized, are written once under
+# "definitions" when several endpoints (or properties) share them
+SHARED_SCHEMA_LENGTH = 200
+
+SEPARATORS = (",", ":")
+# Characters per token of the compacted definitions, on the low side (JSON runs
+# at about 3.5 with cl100k_base) so the estimates rarely cross the budget
+CHARS_PER_TOKEN = 3
+# Tokens of the "method" and "path" keys, which the stored counts don't cover
+PATH_METHOD_TOKENS = 12
+
+
+def shorten(text: Optional[str], length: int) -> Optional[str]:
+    if not text or len(text) <= length:
+        return text
+    return text[: length - 3].rstrip() + "..."
+
+
+def compact_schema(schema, depth: int):
+    """
+    Keeps the parts of a resolved JSON schema that matter to call the API: types,
+    properties, required fields and enums, down to `depth` nested levels of
+    properties. Patterns, examples, titles and the like are dropped.
+    """
+    if isinstance(schema, list):
+        # tuple validation "items"
+        return [compact_schema(item, depth) for item in schema[:MAX_ALTERNATIVES]]
+    if not isinstance(schema, dict):
+        return schema
+    if "$ref" in schema:
+        # unresolved (circular) reference, the name of the schema is enough
+        return {"$ref": str(schema["$ref"]).rsplit("/", 1)[-1]}
+
+    compact = {}
+    for key in ("type", "format", "default", "nullable"):
+        if key in schema:
+            compact[key] = schema[key]
+    if "enum" in schema:
+        compact["enum"] = schema["enum"][:MAX_ENUM_VALUES]
+    description = shorten(schema.get("description"), MAX_PROPERTY_DESCRIPTION_LENGTH)
+    if description:
+        compact["description"] = description
+
+    properties = schema.get("properties")
+    if isinstance(properties, dict) and properties:
+        compact.setdefault("type", "object")
+        if depth > 0:
+            compact["properties"] = {
+                name: compact_schema(value, depth - 1) for name, value in properties.items()
+            }
+            if schema.get("required"):
+                compact["required"] = schema["required"]
+    if "items" in schema:
+        # the items of an array don't count as a nested level
+        compact["items"] = compact_schema(schema["items"], depth)
+    for key in ("oneOf", "anyOf", "allOf"):
+        if isinstance(schema.get(key), list):
+            compact[key] = [compact_schema(s, depth) for s in schema[key][:MAX_ALTERNATIVES]]
+    return compact
+
+
+def compact_parameter(parameter: Dict) -> Dict:
+    compact = {"name": parameter.get("name"), "in": parameter.get("in")}
+    if parameter.get("required"):
+        compact["required"] = True
+    description = shorten(parameter.get("description"), MAX_DESCRIPTION_LENGTH)
+    if description:
+        compact["description"] = description
+
+    if "schema" in parameter:
+        schema = compact_schema(parameter["schema"], REQUEST_DEPTH)
+    else:
+        # swagger 2 parameters carry the schema keywords themselves
+        schema = compact_schema(
+            {k: v for k, v in parameter.items() if k not in ("name", "in", "description")},
+            REQUEST_DEPTH,
+        )
+    if "properties" in schema or "items" in schema:
+        compact["schema"] = schema
+    else:
+        schema.pop("description", None)
+        compact.update(schema)
+    return compact
+
+
+def media_schema(content: Dict) -> Tuple[Optional[str], Optional[Dict]]:
+    # (content type, schema) of an OpenAPI 3 content map, JSON preferred
+    if not isinstance(content, dict) or not content:
+        return None, None
+    content_type = "application/json" if "application/json" in content else next(iter(content))
+    media = content[content_type]
+    return content_type, media.get("schema") if isinstance(media, dict) else None
+
+
+def success_response(responses: Dict) -> Tuple[Optional[str], Optional[Dict]]:
+    # the first 2xx response, or the default one
+    if not isinstance(responses, dict):
+        return None, None
+    for status in sorted(responses):
+        if str(status).startswith("2"):
+            return str(status), responses[status]
+    if "default" in responses:
+        return "default", responses["default"]
+    return None, None
+
+
+def compact_definition(endpoint: Dict, response_depth: int = RESPONSE_DEPTHS[0]) -> Dict:
+    """
+    Compacts an endpoint definition (APIEndpoint.to_dict) for a prompt: the
+    parameters and request body come first, only the success response is kept,
+    with its schema pruned to `response_depth` nested levels of properties.
+    Security, tags, examples and extension fields are dropped.
+    """
+    compact = {"method": endpoint.get("method"), "path": endpoint.get("path")}
+    if endpoint.get("summary"):
+        compact["summary"] = endpoint["summary"]
+    description = shorten(endpoint.get("description"), MAX_DESCRIPTION_LENGTH)
+    if description and description != endpoint.get("summary"):
+        compact["description"] = description
+    if endpoint.get("consumes"):
+        compact["consumes"] = endpoint["consumes"]
+
+    parameters = [p for p in endpoint.get("parameters") or [] if isinstance(p, dict)]
+    if parameters:
+        compact["parameters"] = [compact_parameter(p) for p in parameters]
+
+    request_body = endpoint.get("requestBody")
+    if isinstance(request_body, dict):
+        content_type, schema = media_schema(request_body.get("content"))
+        if content_type:
+            compact["requestBody"] = {"contentType": content_type}
+            if request_body.get("required"):
+                compact["requestBody"]["required"] = True
+            if schema:
+                compact["requestBody"]["schema"] = compact_schema(schema, REQUEST_DEPTH)
+
+    status, response = success_response(endpoint.get("responses"))
+    if isinstance(response, dict):
+        compact["response"] = {"status": status}
+        if response.get("description"):
+            compact["response"]["description"] = shorten(
+                response["description"], MAX_PROPERTY_DESCRIPTION_LENGTH
+            )
+        # swagger 2 responses have a schema, OpenAPI 3 ones a content map
+        schema = response.get("schema") or media_schema(response.get("content"))[1]
+        if schema and response_depth > 0:
+            compact["response"]["schema"] = compact_schema(schema, response_depth)
+    return compact
+
+
+def dumps(value) -> str:
+    return json.dumps(value, separators=SEPARATORS)
+
+
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def stored_tokens(endpoint: Dict) -> Optional[int]:
+    """
+    Upper bound of the tokens of a compacted definition: the count of the full
+    definition stored at ingestion, plus its path and method (a token per
+    character at most). None when the endpoint has no stored count.
+    """
+    tokens = endpoint.get(TOKENS_FIELD)
+    if tokens is None:
+        return None
+    path_method = f'{endpoint.get("path")}{endpoint.get("method")}'
+    return tokens + len(path_method) + PATH_METHOD_TOKENS
+
+
+class SharedSchemas:
+    """
+    Finds the objects repeated across the packed definitions, e.g. the same $ref
+    resolved in several endpoints, so they are written once under "definitions"
+    and referenced with {"$ref": "#/definitions/<name>"} everywhere else.
+    """
+
+    def __init__(self):
+        # serialized object -> name, for the objects seen so far
+        self.names: Dict[str, str] = {}
+        # name -> object, for the objects seen more than once
+        self.definitions: Dict[str, Dict] = {}
+
+    def _name(self, key: Optional[str]) -> str:
+        base = (key or "Schema")[:1].upper() + (key or "Schema")[1:]
+        name, suffix = base, 2
+        taken = set(self.names.values())
+        while name in taken:
+            name, suffix = f"{base}{suffix}", suffix + 1
+        return name
+
+    def dedupe(self, value, key: Optional[str] = None, register: bool = True):
+        """
+        Returns the value with the objects seen before replaced by references. With
+        register=False the new objects are not remembered, to measure a candidate.
+        """
+        if isinstance(value, list):
+            return [self.dedupe(item, key, register) for item in value]
+        if not isinstance(value, dict):
+            return value
+
+        if "properties" in value:
+            serialized = json.dumps(value, sort_keys=True)
+            if len(serialized) >= SHARED_SCHEMA_LENGTH:
+                name = self.names.get(serialized)
+                if name is not None:
+                    if register:
+                        self.definitions[name] = value
+                    return {"$ref": f"#/definitions/{name}"}
+                if register:
+                    self.names[serialized] = self._name(key)
+
+        return {k: self.dedupe(v, k, register) for k, v in value.items()}
+
+    def replace(self, value, root: bool = True):
+        # references every shared object, including its first occurrence
+        if isinstance(value, list):
+            return [self.replace(item, False) for item in value]
+        if not isinstance(value, dict):
+            return value
+        if not root and "properties" in value:
+            name = self.names.get(json.dumps(value, sort_keys=True))
+            if name in self.definitions:
+                return {"$ref": f"#/definitions/{name}"}
+        return {k: self.replace(v, False) for k, v in value.items()}
+
+
+def assemble(compacts: List[Dict]) -> str:
+    """
+    One compacted definition per line, followed by the "definitions" of the
+    objects they share.
+    """
+    shared = SharedSchemas()
+    deduped = [shared.dedupe(compact) for compact in compacts]
+    lines = [dumps(shared.replace(definition)) for definition in deduped]
+    if shared.definitions:
+        definitions = {name: shared.replace(d) for name, d in shared.definitions.items()}
+        lines.append(dumps({"definitions": definitions}))
+    return "\n".join(lines)
+
+
+def pack_endpoints(
+    endpoints: List[Dict], max_tokens: int, model: str
+) -> Tuple[str, List[Optional[int]]]:
+    """
+    Packs the definitions of the endpoints, sorted by relevance, in at most
+    max_tokens tokens: one compacted definition per line, followed by the shared
+    "definitions". Endpoints are added greedily in order, each one at the most
+    detailed compaction level that fits the remaining budget; the ones that don't
+    fit at any level are skipped. The first endpoint is clipped on a token boundary
+    if even its smallest form is too long.
+
+    The definitions are budgeted without tokenizing them, with the lower of the
+    count stored at ingestion (see stored_tokens) and an estimate from their
+    length. The packed text is then tokenized once; when the estimates fell short,
+    the last endpoints are dropped until it fits, so no definition (nor a shared
+    one they reference) is ever cut.
+
+    Returns the text and the response depth each endpoint was packed with, None
+    for the skipped (or clipped) ones.
+    """
+    shared = SharedSchemas()
+    # (index of the endpoint, compacted definition)
+    packed, depths, used = [], [], 0
+    for i, endpoint in enumerate(endpoints):
+        remaining = max_tokens - used
+        bound = stored_tokens(endpoint)
+        for depth in RESPONSE_DEPTHS:
+            compact = compact_definition(endpoint, depth)
+            tokens = estimate_tokens(dumps(shared.dedupe(compact, register=False)))
+            if bound is not None:
+                tokens = min(tokens, bound)
+            # and the newline
+            tokens += 1
+            if tokens <= remaining:
+                shared.dedupe(compact)
+                packed.append((i, compact))
+                depths.append(depth)
+                used += tokens
+                break
+        else:
+            if not packed:
+                break
+            depths.append(None)
+    depths += [None] * (len(endpoints) - len(depths))
+
+    while len(packed) > 1:
+        text = assemble([compact for _, compact in packed])
+        if count_tokens(text, model) <= max_tokens:
+            return text, depths
+        i, _ = packed.pop()
+        depths[i] = None
+
+    if not endpoints:
+        return "", depths
+    # the first endpoint alone, at a lower compaction level if need be (at any
+    # level when even its smallest form seemed too long)
+    levels = RESPONSE_DEPTHS
+    if packed:
+        levels = levels[levels.index(depths[0]) :]
+    for depth in levels:
+        text = assemble([compact_definition(endpoints[0], depth)])
+        if count_tokens(text, model) <= max_tokens:
+            depths[0] = depth
+            return text, depths
+    compact = compact_definition(endpoints[0], RESPONSE_DEPTHS[-1])
+    return clip_tokens(dumps(compact), max_tokens, model)[0], [None] * len(endpoints)
@@ -0,0 +1,264 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+from ai.embeddings import (
+    DEFAULT_EMBEDDING_MODEL,
+    get_embedding,
+    get_embedding_async,
+    to_array,
+    to_binary,
+)
+from ai.executor import run_blocking
+
+DEFAULT_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "instance/embedding_cache.db")
+DEFAULT_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+# Share of max_entries the cache grows past before the least recently used entries
+# are evicted, so the puts don't scan the table each time
+EVICTION_SLACK = 0.01
+
+
+def normalize_text(text: str) -> str:
+    # embeddings are computed with newlines replaced, collapse all whitespace
+    return " ".join(text.split())
+
+
+def cache_key(text: str, model: str) -> str:
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode()).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent content-addressed cache of embeddings stored in a local SQLite file.
+    Entries are keyed by a hash of the embedding model and the normalized text, so
+    re-ingesting a spec only embeds the endpoints whose definition changed.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self._conn.commit()
+        # an upper bound of the entries, replaced entries count twice until evict()
+        self._size = len(self)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def get_many(self, texts: List[str], model: str) -> List[Optional[np.ndarray]]:
+        """Returns the cached embedding of each text, None for the misses."""
+        keys = [cache_key(text, model) for text in texts]
+        found = {}
+        with self._lock:
+            # stay below SQLite's limit of host parameters per statement
+            for start in range(0, len(keys), 500):
+                chunk = keys[start : start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                found.update(rows)
+            now = time.time()
+            self._conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(now, key) for key in found],
+            )
+            self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+
+        return [to_array(found[key]) if key in found else None for key in keys]
+
+    def put_many(self, texts: List[str], embeddings: List[np.ndarray], model: str):
+        now = time.time()
+        rows = [
+            (cache_key(text, model), model, to_binary(embedding, model=model), now)
+            for text, embedding in zip(texts, embeddings)
+            if embedding is not None
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, embedding, last_used) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+            self._size += len(rows)
+            full = self._size > self.max_entries + max(1, int(self.max_entries * EVICTION_SLACK))
+        if full:
+            self.evict()
+
+    def evict(self):
+        """Drops the least recently used entries above max_entries."""
+        with self._lock:
+            self._conn.execute(
+                """DELETE FROM embeddings WHERE key IN (
+                    SELECT key FROM embeddings ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )""",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+            self._size = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self),
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class QueryEmbeddingCache:
+    """
+    Bounded in-memory LRU cache with TTL for the embeddings of user prompts.
+    Prompts are keyed on their normalized text and the model. Optionally backed by
+    a persistent EmbeddingCache so entries survive restarts.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl: float = 3600,
+        persistent: Optional[EmbeddingCache] = None,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persistent = persistent
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(text: str, model: str):
+        return model, normalize_text(text).lower()
+
+    def get(self, text: str, model: str) -> Optional[np.ndarray]:
+        key = self.key(text, model)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                embedding, expires = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return embedding
+                del self._entries[key]
+
+        embedding = None
+        if self.persistent is not None:
+            embedding = self.persistent.get_many([key[1]], model)[0]
+
+        with self._lock:
+            if embedding is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._store(key, embedding)
+        return embedding
+
+    def put(self, text: str, model: str, embedding: np.ndarray):
+        key = self.key(text, model)
+        self._store(key, embedding)
+        if self.persistent is not None:
+            self.persistent.put_many([key[1]], [embedding], model)
+
+    def _store(self, key, embedding):
+        with self._lock:
+            self._entries[key] = (embedding, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+        }
+
+
+_query_cache = None
+_query_cache_lock = threading.Lock()
+
+
+def get_query_cache() -> QueryEmbeddingCache:
+    """
+    Returns the process-wide prompt embedding cache, configured on first use with
+    QUERY_CACHE_SIZE, QUERY_CACHE_TTL (seconds) and QUERY_CACHE_PATH (SQLite file
+    to persist entries across restarts, disabled when unset).
+    """
+    global _query_cache
+    if _query_cache is None:
+        with _query_cache_lock:
+            if _query_cache is None:
+                path = os.getenv("QUERY_CACHE_PATH")
+                _query_cache = QueryEmbeddingCache(
+                    max_size=int(os.getenv("QUERY_CACHE_SIZE", "1024")),
+                    ttl=float(os.getenv("QUERY_CACHE_TTL", "3600")),
+                    persistent=EmbeddingCache(path) if path else None,
+                )
+    return _query_cache
+
+
+def get_cached_embedding(text: str, model: str = DEFAULT_EMBEDDING_MODEL) -> np.ndarray:
+    """`get_embedding` behind the process-wide query cache."""
+    query_cache = get_query_cache()
+    embedding = query_cache.get(text, model)
+    if embedding is None:
+        embedding = get_embedding(text, model=model)
+        query_cache.put(text, model, embedding)
+    return embedding
+
+
+async def get_cached_embedding_async(
+    text: str, model: str = DEFAULT_EMBEDDING_MODEL
+) -> np.ndarray:
+    """
+    `get_embedding_async` behind the process-wide query cache. The cache is only
+    consulted in the thread pool when it is backed by SQLite.
+    """
+    query_cache = get_query_cache()
+    if query_cache.persistent is None:
+        embedding = query_cache.get(text, model)
+    else:
+        embedding = await run_blocking(query_cache.get, text, model)
+
+    if embedding is None:
+        embedding = await get_embedding_async(text, model=model)
+        if query_cache.persistent is None:
+            query_cache.put(text, model, embedding)
+        else:
+            await run_blocking(query_cache.put, text, model, embedding)
+    return embedding
@@ -1,28 +1,212 @@
 # from dotenv import load_dotenv, find_dotenv
+import asyncio
 import json
+import logging
+import os
+import struct
+from functools import lru_cache
 import numpy as np
-from typing import List, Dict
+from typing import Awaitable, Callable, List, Dict, Optional, Sequence, Tuple
 
-from openai import OpenAI
-from tiktoken import encoding_for_model, get_encoding
+from openai import AsyncOpenAI
+from tiktoken import get_encoding
+
+from ai.clients import get_async_openai_client, get_openai_client
+from ai.models import get_model
+from ai.rate_limit import RateLimiter
+
+logger = logging.getLogger(__name__)
 
 DEFAULT_EMBEDDING_MODEL = "text-embedding-3-small"
+# Token counts stored with the endpoints use the encoding of this model, shared
+# by the chat and embedding models (cl100k_base)
+TOKEN_COUNT_MODEL = "gpt-4"
+
+# Limits used when embedding many texts at once (e.g. while ingesting a spec).
+# The embeddings API accepts up to 2048 inputs per request.
+EMBEDDING_BATCH_TOKENS = 50_000
+EMBEDDING_BATCH_SIZE = 512
+EMBEDDING_CONCURRENCY = 4
+
+# An embedder takes a batch of texts and a model and returns one vector per text
+Embedder = Callable[[List[str], str], Awaitable[List[List[float]]]]
+
+# Stored embeddings start with a header describing the payload:
+#   magic (4 bytes) | version (u8) | dtype (u8) | dimension (u32) | model length (u16) | model
+# int8 payloads are preceded by their float32 scale. Blobs without the magic are
+# the raw float64 bytes written by previous versions.
+EMBEDDING_MAGIC = b"T2AE"
+EMBEDDING_FORMAT_VERSION = 1
+DEFAULT_STORAGE_DTYPE = "float32"
+
+_HEADER = struct.Struct("<4sBBIH")
+_SCALE = struct.Struct("<f")
+_DTYPE_CODES = {"float32": 0, "float16": 1, "int8": 2, "float64": 3}
+_DTYPE_NAMES = {code: name for name, code in _DTYPE_CODES.items()}
+
+
+def to_binary(
+    embedding: np.ndarray,
+    dtype: str = None,
+    model: str = DEFAULT_EMBEDDING_MODEL,
+) -> bytes:
+    """
+    Serializes an embedding with a header recording its dtype, dimension and model.
+
+    Args:
+    - embedding: The embedding vector, possibly empty.
+    - dtype: "float32", "float16", "int8" (symmetric linear quantization) or
+      "float64". Defaults to the EMBEDDING_STORAGE_DTYPE env variable, or float32.
+    - model: The model that produced the embedding.
+    """
+    dtype = dtype or os.getenv("EMBEDDING_STORAGE_DTYPE", DEFAULT_STORAGE_DTYPE)
+    embedding = np.asarray(embedding, dtype=np.float64).ravel()
+    model_name = model.encode()
+    header = _HEADER.pack(
+        EMBEDDING_MAGIC,
+        EMBEDDING_FORMAT_VERSION,
+        _DTYPE_CODES[dtype],
+        len(embedding),
+        len(model_name),
+    )
+
+    if dtype == "int8":
+        max_value = float(np.abs(embedding).max()) if len(embedding) else 0.0
+        scale = max_value / 127 if max_value else 1.0
+        payload = np.round(embedding / scale).astype(np.int8).tobytes()
+        return header + model_name + _SCALE.pack(scale) + payload
 
+    return header + model_name + embedding.astype(dtype).tobytes()
 
-def to_binary(embedding: np.ndarray) -> bytes:
-    return embedding.tobytes()
+
+def read_embedding_header(binary: bytes) -> Optional[Tuple[str, int, str, int]]:
+    """
+    Returns the (dtype, dimension, model, payload offset) of a stored embedding, or
+    None for blobs in the previous headerless float64 format.
+    """
+    if len(binary) < _HEADER.size or not binary.startswith(EMBEDDING_MAGIC):
+        return None
+    _, version, dtype_code, dim, model_length = _HEADER.unpack_from(binary)
+    if version != EMBEDDING_FORMAT_VERSION or dtype_code not in _DTYPE_NAMES:
+        return None
+
+    dtype = _DTYPE_NAMES[dtype_code]
+    offset = _HEADER.size + model_length
+    model = binary[_HEADER.size : offset].decode(errors="replace")
+    if dtype == "int8":
+        offset += _SCALE.size
+    # a legacy float64 blob starting with the magic by chance won't match the size
+    if len(binary) - offset != dim * np.dtype(dtype).itemsize:
+        return None
+    return dtype, dim, model, offset
 
 
 def to_array(binary: bytes) -> np.ndarray:
-    return np.frombuffer(binary)
+    """
+    Deserializes a stored embedding. Embeddings in the current format are returned
+    as float32 (int8 ones dequantized), legacy blobs as float64.
+    """
+    header = read_embedding_header(binary)
+    if header is None:
+        return np.frombuffer(binary)
+
+    dtype, dim, _, offset = header
+    payload = np.frombuffer(binary, dtype=dtype, count=dim, offset=offset)
+    if dtype == "int8":
+        (scale,) = _SCALE.unpack_from(binary, offset - _SCALE.size)
+        return payload.astype(np.float32) * np.float32(scale)
+    return payload.astype(np.float32)
 
 
 def cosine_similarity(a, b):
     return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
 
 
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """
+    Returns a float32 copy of the matrix with every row scaled to unit length,
+    so that cosine similarity becomes a plain dot product. Zero rows stay zero.
+    """
+    matrix = np.array(matrix, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    matrix /= norms
+    return matrix
+
+
+def stack_embeddings(
+    embeddings: Sequence[np.ndarray], dim: Optional[int] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Stacks the embeddings into a normalized float32 matrix.
+
+    Empty embeddings (stored for definitions too large to embed) and embeddings
+    whose dimension differs from `dim` (by default the most common one) are left
+    out. Returns the matrix and the positions of the embeddings it contains.
+    """
+    lengths = np.fromiter((len(e) for e in embeddings), dtype=np.int64, count=len(embeddings))
+    if dim is None:
+        non_empty = lengths[lengths > 0]
+        if len(non_empty) == 0:
+            return np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.int64)
+        dims, counts = np.unique(non_empty, return_counts=True)
+        dim = int(dims[np.argmax(counts)])
+
+    positions = np.flatnonzero(lengths == dim)
+    matrix = np.empty((len(positions), dim), dtype=np.float32)
+    for row, position in enumerate(positions):
+        matrix[row] = embeddings[position]
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    matrix /= norms
+    return matrix, positions
+
+
+def top_k_similar(
+    queries: np.ndarray, matrix: np.ndarray, top_k: Optional[int] = 100
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Ranks the rows of a normalized embedding matrix (see `stack_embeddings`) by
+    cosine similarity to one query vector or a batch of query vectors.
+
+    Args:
+    - queries: A single query vector (dim,) or a batch of them (n_queries, dim).
+    - matrix: The (n_embeddings, dim) matrix with L2-normalized rows.
+    - top_k: The number of top matches to return, None to rank all of them.
+
+    Returns:
+    The (indices, scores) of the top matches sorted by descending similarity, with
+    shape (k,) for a single query or (n_queries, k) for a batch.
+    """
+    single = np.ndim(queries) == 1
+    queries = normalize_rows(queries)
+    if len(matrix) == 0:
+        indices = np.empty((len(queries), 0), dtype=np.int64)
+        scores = np.empty((len(queries), 0), dtype=np.float32)
+        return (indices[0], scores[0]) if single else (indices, scores)
+
+    scores = queries @ matrix.T
+
+    n = scores.shape[1]
+    if top_k is None or top_k >= n:
+        indices = np.argsort(-scores, axis=1)
+    elif top_k <= 0:
+        indices = np.empty((scores.shape[0], 0), dtype=np.int64)
+    else:
+        # partial selection of the top_k, only those get sorted
+        indices = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        order = np.argsort(-np.take_along_axis(scores, indices, axis=1), axis=1)
+        indices = np.take_along_axis(indices, order, axis=1)
+
+    top_scores = np.take_along_axis(scores, indices, axis=1)
+    if single:
+        return indices[0], top_scores[0]
+    return indices, top_scores
+
+
+@lru_cache(maxsize=None)
 def get_token_encoder(model):
-    return encoding_for_model(model) if "gpt" in model else get_encoding("cl100k_base")
+    return get_encoding(get_model(model).encoding)
 
 
 def count_tokens(input_string: str, model: str) -> int:
@@ -39,20 +223,167 @@ def count_tokens(input_string: str, model: str) -> int:
     return len(encoder.encode(input_string, disallowed_special=()))
 
 
-def get_embedding(text: str, model=DEFAULT_EMBEDDING_MODEL, **kwargs) -> List[float]:
-    client = OpenAI()
+def clip_tokens(text: str, max_tokens: int, model: str) -> Tuple[str, int]:
+    """
+    Clips the text to its first max_tokens tokens, tokenizing it only once.
+
+    Returns the clipped text and its number of tokens.
+    """
+    encoder = get_token_encoder(model)
+    tokens = encoder.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text, len(tokens)
+    # a token boundary can split a multi-byte character, drop the partial bytes
+    clipped = encoder.decode_bytes(tokens[:max_tokens]).decode("utf-8", errors="ignore")
+    return clipped, max_tokens
+
+
+def count_endpoint_tokens(endpoint: Dict) -> Dict[str, int]:
+    """Token counts of the texts of an endpoint record, stored at ingestion."""
+    return {
+        f"{field}_tokens": count_tokens(endpoint[field] or "", TOKEN_COUNT_MODEL)
+        for field in ("summary", "description", "definition")
+    }
+
+
+def prepare_embedding_input(text: str, model: str) -> str:
     # replace newlines, which can negatively affect performance.
     text = text.replace("\n", " ")
-    MAX_TOKENS = 8192
     tokens = count_tokens(text, model)
-    if tokens > MAX_TOKENS:
+    max_tokens = get_model(model).context_tokens
+    if tokens > max_tokens:
         raise ValueError(
-            f"tokens exceed maximum length ({tokens} > {MAX_TOKENS}) for model {model}."
+            f"tokens exceed maximum length ({tokens} > {max_tokens}) for model {model}."
         )
+    return text
+
+
+def get_embedding(text: str, model=DEFAULT_EMBEDDING_MODEL, **kwargs) -> List[float]:
+    text = prepare_embedding_input(text, model)
     return np.array(
-        client.embeddings.create(input=[text], model=model, **kwargs).data[0].embedding
+        get_openai_client().embeddings.create(input=[text], model=model, **kwargs).data[0].embedding
+    )
+
+
+async def get_embedding_async(
+    text: str, model=DEFAULT_EMBEDDING_MODEL, **kwargs
+) -> np.ndarray:
+    """Async version of `get_embedding`."""
+    text = await asyncio.to_thread(prepare_embedding_input, text, model)
+    response = await get_async_openai_client().embeddings.create(
+        input=[text], model=model, **kwargs
+    )
+    return np.array(response.data[0].embedding)
+
+
+def openai_embedder(client: Optional[AsyncOpenAI] = None) -> Embedder:
+    """
+    Returns an embedder that sends each batch as a single embeddings request. The
+    client honours OPENAI_BASE_URL, so it can be pointed to a local fake server.
+    """
+    client = client or AsyncOpenAI()
+
+    async def embed(texts: List[str], model: str) -> List[List[float]]:
+        response = await client.embeddings.create(input=texts, model=model)
+        return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+
+    return embed
+
+
+def batch_texts(
+    token_counts: Sequence[int],
+    max_batch_tokens: int = EMBEDDING_BATCH_TOKENS,
+    max_batch_size: int = EMBEDDING_BATCH_SIZE,
+) -> List[List[int]]:
+    """
+    Groups the positions of the texts into batches bounded by the total number of
+    tokens and the number of texts per batch, keeping the original order.
+    """
+    batches, batch, batch_tokens = [], [], 0
+    for position, tokens in enumerate(token_counts):
+        if batch and (
+            batch_tokens + tokens > max_batch_tokens or len(batch) >= max_batch_size
+        ):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(position)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+async def embed_texts_async(
+    texts: List[str],
+    model: str = DEFAULT_EMBEDDING_MODEL,
+    embedder: Optional[Embedder] = None,
+    max_batch_tokens: int = EMBEDDING_BATCH_TOKENS,
+    max_batch_size: int = EMBEDDING_BATCH_SIZE,
+    concurrency: int = EMBEDDING_CONCURRENCY,
+    requests_per_minute: Optional[int] = None,
+    tokens_per_minute: Optional[int] = None,
+) -> List[Optional[np.ndarray]]:
+    """
+    Embeds many texts packing them into batched requests that run concurrently
+    under a rate limiter.
+
+    Args:
+    - texts: The texts to embed.
+    - model: The embedding model.
+    - embedder: The function performing a batched embedding call, by default the
+      OpenAI embeddings API.
+    - max_batch_tokens: Maximum number of tokens sent in a single request.
+    - max_batch_size: Maximum number of texts sent in a single request.
+    - concurrency: Maximum number of requests in flight.
+    - requests_per_minute: Maximum number of requests started per minute, the
+      limit of the model by default (see ai.models).
+    - tokens_per_minute: Maximum number of tokens sent per minute, the limit of
+      the model by default.
+
+    Returns:
+    One embedding per text, in the same order. Texts exceeding the maximum number
+    of tokens of the model are not embedded and get None.
+    """
+    embedder = embedder or openai_embedder()
+    texts = [text.replace("\n", " ") for text in texts]
+
+    info = get_model(model)
+    token_counts = [count_tokens(text, model) for text in texts]
+    embeddable = [i for i, tokens in enumerate(token_counts) if tokens <= info.context_tokens]
+    for i in set(range(len(texts))) - set(embeddable):
+        logger.warning(
+            f"text {i} exceeds maximum length ({token_counts[i]} > {info.context_tokens}) for model {model}."
+        )
+
+    batches = [
+        [embeddable[i] for i in batch]
+        for batch in batch_texts(
+            [token_counts[i] for i in embeddable], max_batch_tokens, max_batch_size
+        )
+    ]
+
+    embeddings: List[Optional[np.ndarray]] = [None] * len(texts)
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = RateLimiter(
+        requests_per_minute or info.requests_per_minute,
+        tokens_per_minute or info.tokens_per_minute,
     )
 
+    async def embed_batch(batch):
+        async with semaphore:
+            await limiter.acquire(sum(token_counts[i] for i in batch))
+            vectors = await embedder([texts[i] for i in batch], model)
+        for i, vector in zip(batch, vectors):
+            embeddings[i] = np.array(vector)
+
+    await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    return embeddings
+
+
+def embed_texts(texts: List[str], **kwargs) -> List[Optional[np.ndarray]]:
+    """Synchronous version of `embed_texts_async`."""
+    return asyncio.run(embed_texts_async(texts, **kwargs))
+
 
 def generate_embeddings(endpoints: Dict) -> Dict:
     def get_embedding(endpoint):
@@ -0,0 +1,96 @@
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Any, AsyncIterator, Callable, Coroutine, Iterator, Optional, TypeVar
+
+from flask import current_app, has_app_context
+
+T = TypeVar("T")
+
+# Threads running blocking work (database queries, tokenization, SQLite caches)
+# for the coroutines of the shared event loop
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", "16"))
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+_executor = ThreadPoolExecutor(BLOCKING_WORKERS, thread_name_prefix="blocking")
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Returns the event loop shared by the whole process, started on first use in a
+    daemon thread. Every request coroutine runs on it, so the LLM and embedding
+    clients, their connection pools and the rate limiters are shared by all the
+    requests instead of being bound to a throwaway loop per request.
+    """
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=loop.run_forever, name="event-loop", daemon=True
+                ).start()
+                _loop = loop
+    return _loop
+
+
+async def _run_in_context(coro: Coroutine, context: contextvars.Context):
+    # the task copies the caller context, e.g. the Flask app context
+    return await context.run(asyncio.ensure_future, coro)
+
+
+def run_coroutine(coro: Coroutine[Any, Any, T], timeout: Optional[float] = None) -> T:
+    """
+    Runs a coroutine on the shared event loop from a synchronous caller (a Flask
+    view) and waits for its result. The caller's context variables are visible to
+    the coroutine.
+    """
+    future = asyncio.run_coroutine_threadsafe(
+        _run_in_context(coro, contextvars.copy_context()), get_event_loop()
+    )
+    try:
+        return future.result(timeout)
+    except TimeoutError:
+        future.cancel()
+        raise
+
+
+def iterate_async(iterator: AsyncIterator[T], timeout: Optional[float] = None) -> Iterator[T]:
+    """
+    Iterates an async iterator running on the shared event loop from a synchronous
+    caller, e.g. the generator of a streamed Flask response. Closing the generator
+    (the client went away) closes the async iterator too.
+    """
+    try:
+        while True:
+            try:
+                yield run_coroutine(iterator.__anext__(), timeout)
+            except StopAsyncIteration:
+                return
+    finally:
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            run_coroutine(aclose())
+
+
+async def run_blocking(func: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Runs a blocking function in the bounded thread pool without blocking the event
+    loop. When called within a Flask app context, the function runs in a new app
+    context of the same app so it gets its own database session.
+    """
+    call = functools.partial(func, *args, **kwargs)
+    if has_app_context():
+        app = current_app._get_current_object()
+
+        def call_in_app_context():
+            with app.app_context():
+                return func(*args, **kwargs)
+
+        call = call_in_app_context
+
+    return await asyncio.get_running_loop().run_in_executor(_executor, call)
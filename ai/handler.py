@@ -1,15 +1,18 @@
+import asyncio
 import logging
 import os
+from typing import AsyncIterator, Dict, List
 
 import litellm
 import openai
-from aiolimiter import AsyncLimiter
 from litellm import acompletion
 from litellm import RateLimitError
-from litellm.exceptions import APIError
+from litellm.exceptions import APIConnectionError, APIError, ServiceUnavailableError, Timeout
 
-# from openai.error import APIError, RateLimitError, Timeout, TryAgain
-from retry import retry
+from ai.clients import clients, configure_litellm
+from ai.embeddings import count_tokens
+from ai.models import completion_tokens_limit, usage
+from ai.rate_limit import retry_after, retry_async
 
 # Configure the logger
 logging.basicConfig(
@@ -20,7 +23,16 @@ logger = logging.getLogger(__name__)
 AI_TIMEOUT = 90  # seconds
 
 OPENAI_RETRIES = 5
-MAX_REQS_MINUTE = 60
+# Errors worth retrying, the request may succeed later
+RETRYABLE_ERRORS = (RateLimitError, Timeout, APIConnectionError, ServiceUnavailableError)
+# Tokens added by the chat format to each message
+TOKENS_PER_MESSAGE = 4
+
+
+def count_message_tokens(messages: List[Dict[str, str]], model: str) -> int:
+    return sum(
+        count_tokens(message["content"], model) + TOKENS_PER_MESSAGE for message in messages
+    )
 
 
 class AiHandler:
@@ -30,12 +42,12 @@ class AiHandler:
     and provides a method for performing chat completions using the OpenAI ChatCompletion API.
     """
 
-    def __init__(self, model="gpt-4-turbo-preview"):
+    def __init__(self):
         """
         Initializes the OpenAI API key and other settings from a configuration file.
         Raises a ValueError if the OpenAI key is missing.
         """
-        self.limiter = AsyncLimiter(MAX_REQS_MINUTE)
+        configure_litellm()
         try:
             openai.api_key = os.getenv("OPENAI_API_KEY")
             litellm.openai_key = os.getenv("OPENAI_API_KEY")
@@ -43,13 +55,35 @@ class AiHandler:
         except AttributeError as e:
             raise ValueError("OpenAI key is required") from e
 
-    @retry(
-        exceptions=(AttributeError, RateLimitError),
-        tries=OPENAI_RETRIES,
-        delay=2,
-        backoff=2,
-        jitter=(1, 3),
-    )
+    @staticmethod
+    def _on_retry(model: str):
+        def on_retry(error: Exception, delay: float):
+            # a 429 means the budget is exhausted for every caller, not just this one
+            if isinstance(error, RateLimitError):
+                clients.limiter(model).pause(retry_after(error) or delay)
+
+        return on_retry
+
+    async def _acompletion(self, prompt_tokens: int, model: str, **kwargs):
+        # shared by all the handlers, so the rate limits apply to the whole process
+        await clients.limiter(model).acquire(prompt_tokens)
+        # a prompt filling the context leaves no room, the API reports it
+        max_tokens = completion_tokens_limit(model, prompt_tokens)
+        if max_tokens > 0:
+            kwargs["max_tokens"] = max_tokens
+        try:
+            return await acompletion(
+                deployment_id=None, force_timeout=AI_TIMEOUT, model=model, **kwargs
+            )
+        except RETRYABLE_ERRORS:
+            raise
+        except APIError as e:
+            logging.error("Error during OpenAI inference ", e)
+            raise
+        except Exception as e:
+            logging.error("Unknown error during OpenAI inference: ", e)
+            raise APIError from e
+
     async def chat_completion(
         self,
         model: str,
@@ -58,38 +92,90 @@ class AiHandler:
         temperature: float = 0.2,
         frequency_penalty: float = 0.0,
     ):
-        try:
-            async with self.limiter:
-                logger.info("-----------------")
-                logger.info("Running inference ...")
-                logger.info(f"system:\n{system}")
-                logger.info(f"user:\n{user}")
-
-                response = await acompletion(
-                    model=model,
-                    deployment_id=None,
-                    messages=[
-                        {"role": "system", "content": system},
-                        {"role": "user", "content": user},
-                    ],
-                    temperature=temperature,
-                    frequency_penalty=frequency_penalty,
-                    force_timeout=AI_TIMEOUT,
-                )
-        except APIError as e:
-            logging.error("Error during OpenAI inference ", e)
-            raise
-        except RateLimitError as e:
-            logging.error("Rate limit error during OpenAI inference ", e)
-            raise
-        except Exception as e:
-            logging.error("Unknown error during OpenAI inference: ", e)
-            raise APIError from e
+        logger.info("-----------------")
+        logger.info("Running inference ...")
+        logger.info(f"system:\n{system}")
+        logger.info(f"user:\n{user}")
+
+        messages = [
+            {"role": "system", "content": system},
+            {"role": "user", "content": user},
+        ]
+        prompt_tokens = await asyncio.to_thread(count_message_tokens, messages, model)
+        response = await retry_async(
+            lambda: self._acompletion(
+                prompt_tokens,
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                frequency_penalty=frequency_penalty,
+            ),
+            retry_on=RETRYABLE_ERRORS,
+            tries=OPENAI_RETRIES,
+            on_retry=self._on_retry(model),
+        )
+
         if response is None or len(response["choices"]) == 0:
             raise APIError
+        response_usage = response.get("usage")
+        completion_tokens = response_usage["completion_tokens"] if response_usage else 0
+        clients.limiter(model).consume(completion_tokens)
+        usage.record(model, prompt_tokens, completion_tokens)
+
         resp = response["choices"][0]["message"]["content"]
         finish_reason = response["choices"][0]["finish_reason"]
         logger.debug(f"response:\n{resp}")
         logger.info("done")
         logger.info("-----------------")
         return resp, finish_reason
+
+    async def chat_completion_stream(
+        self,
+        model: str,
+        system: str,
+        user: str,
+        temperature: float = 0.2,
+        frequency_penalty: float = 0.0,
+    ) -> AsyncIterator[str]:
+        """
+        Streaming version of `chat_completion`: yields the content of the completion
+        as the tokens arrive. Only opening the stream is retried, tokens may
+        already have been forwarded when an error happens later.
+        """
+        logger.info("-----------------")
+        logger.info("Running streaming inference ...")
+        logger.info(f"system:\n{system}")
+        logger.info(f"user:\n{user}")
+
+        messages = [
+            {"role": "system", "content": system},
+            {"role": "user", "content": user},
+        ]
+        prompt_tokens = await asyncio.to_thread(count_message_tokens, messages, model)
+        response = await retry_async(
+            lambda: self._acompletion(
+                prompt_tokens,
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                frequency_penalty=frequency_penalty,
+                stream=True,
+            ),
+            retry_on=RETRYABLE_ERRORS,
+            tries=OPENAI_RETRIES,
+            on_retry=self._on_retry(model),
+        )
+
+        completion_tokens = 0
+        try:
+            async for chunk in response:
+                content = getattr(chunk.choices[0].delta, "content", None)
+                if content:
+                    # roughly a token per chunk
+                    completion_tokens += 1
+                    yield content
+        finally:
+            clients.limiter(model).consume(completion_tokens)
+            usage.record(model, prompt_tokens, completion_tokens)
+        logger.info("done")
+        logger.info("-----------------")
@@ -0,0 +1,150 @@
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from ai.embeddings import stack_embeddings, to_array, top_k_similar
+from database.services import APIEndpoint, service_deleted_listeners
+
+# Per-service sidecar files written by populate_db.py next to the database:
+# <service>.npy (normalized float32 matrix), <service>.ids.npy and <service>.json
+EMBEDDINGS_DIR = os.getenv("EMBEDDINGS_DIR", "instance/embeddings")
+
+
+class EmbeddingIndex:
+    """
+    Embeddings of all the endpoints of a service stacked in a single contiguous
+    float32 matrix. Rows are L2-normalized at load time so ranking a query is a
+    single matrix-vector product.
+    """
+
+    def __init__(self, ids: np.ndarray, matrix: np.ndarray, fingerprint=None):
+        self.ids = ids
+        self.matrix = matrix
+        self.fingerprint = fingerprint
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_rows(cls, rows: List[Tuple[int, bytes]], fingerprint=None):
+        """
+        Builds the index from (endpoint id, embedding blob) rows. Rows without an
+        embedding (oversized definitions) or with a different dimension are skipped.
+        """
+        ids = np.fromiter((id for id, _ in rows), dtype=np.int64, count=len(rows))
+        matrix, positions = stack_embeddings(
+            [to_array(blob) if blob else () for _, blob in rows]
+        )
+        return cls(ids[positions], matrix, fingerprint)
+
+    def save(self, directory: str, name: str):
+        """
+        Writes the index as .npy sidecar files that `load` can memory-map. Files are
+        written under a temporary name and renamed, so readers never see a partial
+        index.
+        """
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, name)
+        files = {
+            f"{base}.npy": lambda f: np.save(f, np.ascontiguousarray(self.matrix)),
+            f"{base}.ids.npy": lambda f: np.save(f, self.ids),
+            f"{base}.json": lambda f: f.write(
+                json.dumps({"fingerprint": self.fingerprint}).encode()
+            ),
+        }
+        # the metadata goes last, it is what makes the new matrix current
+        for path, write in files.items():
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                write(f)
+            os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, directory: str, name: str, fingerprint):
+        """
+        Memory-maps the sidecar files of an index. The pages are shared with every
+        process mapping the same files. Returns None when the files are missing or
+        were written for another fingerprint, the (service id, version) of the
+        ingestion. Files are never trusted for a service without a version, which
+        a previous ingestion with a reused id would share.
+        """
+        if fingerprint is None or None in fingerprint:
+            return None
+        base = os.path.join(directory, name)
+        try:
+            with open(f"{base}.json") as f:
+                saved_fingerprint = tuple(json.load(f)["fingerprint"])
+            if saved_fingerprint != tuple(fingerprint):
+                return None
+            matrix = np.load(f"{base}.npy", mmap_mode="r")
+            ids = np.load(f"{base}.ids.npy", mmap_mode="r")
+        except (OSError, ValueError, KeyError):
+            return None
+        if len(ids) != len(matrix):
+            return None
+        return cls(ids, matrix, saved_fingerprint)
+
+    def search(self, query: np.ndarray, top_k: Optional[int] = 100) -> List[Tuple[int, float]]:
+        """
+        Returns the (endpoint id, cosine similarity) of the top_k closest endpoints to
+        the query, sorted by similarity in descending order.
+        """
+        indices, scores = top_k_similar(query, self.matrix, top_k)
+        return [(int(self.ids[i]), float(score)) for i, score in zip(indices, scores)]
+
+
+_indexes: Dict[str, EmbeddingIndex] = {}
+_lock = threading.Lock()
+
+
+def get_service_index(service_name: str) -> EmbeddingIndex:
+    """
+    Returns the process-wide embedding index of a service, loading it on first use.
+    The index is reloaded when the service endpoints change in the database, e.g.
+    after populate_db.py re-ingests the service from another process.
+
+    The sidecar files exported by populate_db.py are memory-mapped when they match
+    the database, otherwise the index is built from the embedding rows.
+    """
+    fingerprint = APIEndpoint.get_embeddings_fingerprint(service_name)
+
+    index = _indexes.get(service_name)
+    if index is not None and index.fingerprint == fingerprint:
+        return index
+
+    with _lock:
+        index = _indexes.get(service_name)
+        if index is None or index.fingerprint != fingerprint:
+            index = EmbeddingIndex.load(EMBEDDINGS_DIR, service_name, fingerprint)
+            if index is None:
+                service_id = fingerprint[0]
+                index = EmbeddingIndex.from_rows(
+                    APIEndpoint.get_embedding_rows(service_id), fingerprint
+                )
+            _indexes[service_name] = index
+
+    return index
+
+
+def invalidate_service_index(service_name: Optional[str] = None):
+    with _lock:
+        if service_name is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(service_name, None)
+
+
+service_deleted_listeners.append(invalidate_service_index)
+
+
+def export_service_index(session, service_name: str, directory: str = EMBEDDINGS_DIR):
+    """Builds the index of a service from the database and writes its sidecar files."""
+    fingerprint = APIEndpoint.get_embeddings_fingerprint(service_name, session)
+    index = EmbeddingIndex.from_rows(
+        APIEndpoint.get_embedding_rows(fingerprint[0], session), fingerprint
+    )
+    index.save(directory, service_name)
+    return index
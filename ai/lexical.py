@@ -0,0 +1,291 @@
+import json
+import math
+import os
+import pickle
+import re
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ai.index import EMBEDDINGS_DIR, get_service_index
+from database.services import APIEndpoint, service_deleted_listeners
+
+# Words made of letters and digits, optionally joined by dots or underscores
+# ("conversations.history", "issue_key") so these compounds can be matched literally
+WORD_PATTERN = re.compile(r"[A-Za-z0-9]+(?:[._][A-Za-z0-9]+)*")
+CAMEL_CASE_PATTERN = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from get i in into is it me my of on or "
+    "that the their this to with".split()
+)
+# Path terms are the most specific ones, they count as this many occurrences
+PATH_WEIGHT = 2
+# Reciprocal rank fusion constant, damps the weight of the first ranks
+RRF_K = 60
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """
+    Splits text into lowercase terms. Dotted, underscored and camelCase words are
+    split in their parts and also kept whole, so both "history" and
+    "conversations.history" match the "/conversations.history" path.
+    """
+    if not text:
+        return []
+
+    terms = []
+    for word in WORD_PATTERN.findall(text):
+        pieces = re.split(r"[._]", word)
+        parts = [
+            part.lower() for piece in pieces for part in CAMEL_CASE_PATTERN.findall(piece)
+        ]
+        terms.extend(part for part in parts if part not in STOPWORDS)
+        if len(parts) > 1:
+            terms.append(word.lower())
+            if len(pieces) > 1:
+                terms.extend(piece.lower() for piece in pieces if piece.lower() not in parts)
+    return terms
+
+
+def parameter_names(definition) -> List[str]:
+    # parameters and top-level request body properties of a resolved definition
+    if isinstance(definition, str):
+        definition = json.loads(definition)
+    if not isinstance(definition, dict):
+        return []
+
+    names = [
+        p["name"]
+        for p in definition.get("parameters", [])
+        if isinstance(p, dict) and "name" in p
+    ]
+    content = definition.get("requestBody", {}).get("content", {})
+    for media in content.values():
+        properties = media.get("schema", {}).get("properties", {})
+        if isinstance(properties, dict):
+            names.extend(properties)
+    return names
+
+
+def endpoint_terms(path, summary, description, definition) -> List[str]:
+    """Terms of the text of an endpoint that the lexical index is built on."""
+    terms = tokenize(path) * PATH_WEIGHT
+    terms.extend(tokenize(summary))
+    terms.extend(tokenize(description))
+    if definition:
+        if isinstance(definition, str):
+            definition = json.loads(definition)
+        terms.extend(tokenize(definition.get("operationId")))
+        for name in parameter_names(definition):
+            terms.extend(tokenize(name))
+    return terms
+
+
+class LexicalIndex:
+    """
+    BM25 inverted index over the text of the endpoints of a service. Each term maps
+    to the positions of the endpoints containing it and its frequency in them, so
+    scoring a query only touches the postings of its terms.
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        postings: Dict[str, Tuple[np.ndarray, np.ndarray]],
+        lengths: np.ndarray,
+        fingerprint=None,
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        self.ids = ids
+        self.postings = postings
+        self.lengths = lengths
+        self.fingerprint = fingerprint
+        self.k1 = k1
+        self.b = b
+        self.average_length = float(lengths.mean()) if len(lengths) else 0.0
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_documents(cls, documents: Sequence[Tuple[int, List[str]]], fingerprint=None):
+        """Builds the index from (endpoint id, terms) documents."""
+        ids = np.fromiter((id for id, _ in documents), dtype=np.int64, count=len(documents))
+        lengths = np.array([len(terms) for _, terms in documents], dtype=np.float32)
+
+        positions, frequencies = defaultdict(list), defaultdict(list)
+        for position, (_, terms) in enumerate(documents):
+            for term, count in Counter(terms).items():
+                positions[term].append(position)
+                frequencies[term].append(count)
+
+        postings = {
+            term: (
+                np.array(positions[term], dtype=np.int32),
+                np.array(frequencies[term], dtype=np.float32),
+            )
+            for term in positions
+        }
+        return cls(ids, postings, lengths, fingerprint)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[tuple], fingerprint=None):
+        # (id, path, summary, description, definition) rows, see APIEndpoint.get_text_rows
+        return cls.from_documents(
+            [(row[0], endpoint_terms(*row[1:])) for row in rows], fingerprint
+        )
+
+    def scores(self, query: str) -> np.ndarray:
+        """BM25 score of every endpoint of the index for the query."""
+        scores = np.zeros(len(self), dtype=np.float32)
+        if len(self) == 0:
+            return scores
+
+        norms = self.k1 * (1 - self.b + self.b * self.lengths / self.average_length)
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            positions, frequencies = posting
+            idf = math.log(1 + (len(self) - len(positions) + 0.5) / (len(positions) + 0.5))
+            scores[positions] += (
+                idf * frequencies * (self.k1 + 1) / (frequencies + norms[positions])
+            )
+        return scores
+
+    def search(self, query: str, top_k: Optional[int] = 100) -> List[Tuple[int, float]]:
+        """
+        Returns the (endpoint id, BM25 score) of the top_k endpoints matching any term
+        of the query, sorted by score in descending order.
+        """
+        scores = self.scores(query)
+        matches = np.flatnonzero(scores)
+        order = matches[np.argsort(-scores[matches], kind="stable")]
+        if top_k is not None:
+            order = order[:top_k]
+        return [(int(self.ids[i]), float(scores[i])) for i in order]
+
+    def save(self, directory: str, name: str):
+        # <name>.bm25.pickle, next to the embeddings sidecar files of the service
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{name}.bm25.pickle")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, directory: str, name: str, fingerprint):
+        """
+        Loads a saved index. Returns None when it is missing or was built for
+        another fingerprint, the (service id, version) of the ingestion, or when
+        the service has no version to check it against.
+        """
+        if fingerprint is None or None in fingerprint:
+            return None
+        try:
+            with open(os.path.join(directory, f"{name}.bm25.pickle"), "rb") as f:
+                index = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+        if not isinstance(index, cls):
+            return None
+        if index.fingerprint is None or tuple(index.fingerprint) != tuple(fingerprint):
+            return None
+        return index
+
+
+def reciprocal_rank_fusion(
+    rankings: List[List[Tuple[int, float]]],
+    weights: Optional[List[float]] = None,
+    top_k: Optional[int] = None,
+    k: int = RRF_K,
+) -> List[Tuple[int, float]]:
+    """
+    Fuses rankings of (id, score) by summing weight / (k + rank) over the rankings
+    each id appears in. Only ranks are used, so cosine similarities and BM25
+    scores don't need to be calibrated against each other.
+    """
+    weights = weights or [1.0] * len(rankings)
+    fused = defaultdict(float)
+    for ranking, weight in zip(rankings, weights):
+        for rank, (id, _) in enumerate(ranking):
+            fused[id] += weight / (k + rank + 1)
+
+    results = sorted(fused.items(), key=lambda item: item[1], reverse=True)
+    return results if top_k is None else results[:top_k]
+
+
+_indexes: Dict[str, LexicalIndex] = {}
+_lock = threading.Lock()
+
+
+def get_service_lexical_index(service_name: str) -> LexicalIndex:
+    """
+    Returns the process-wide lexical index of a service, loading the one exported
+    by populate_db.py or building it from the database when it is missing or out
+    of date. See get_service_index.
+    """
+    fingerprint = APIEndpoint.get_embeddings_fingerprint(service_name)
+
+    index = _indexes.get(service_name)
+    if index is not None and index.fingerprint == fingerprint:
+        return index
+
+    with _lock:
+        index = _indexes.get(service_name)
+        if index is None or index.fingerprint != fingerprint:
+            index = LexicalIndex.load(EMBEDDINGS_DIR, service_name, fingerprint)
+            if index is None:
+                index = LexicalIndex.from_rows(
+                    APIEndpoint.get_text_rows(fingerprint[0]), fingerprint
+                )
+            _indexes[service_name] = index
+
+    return index
+
+
+def invalidate_service_lexical_index(service_name: Optional[str] = None):
+    with _lock:
+        if service_name is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(service_name, None)
+
+
+service_deleted_listeners.append(invalidate_service_lexical_index)
+
+
+def export_service_lexical_index(session, service_name: str, directory: str = EMBEDDINGS_DIR):
+    """Builds the lexical index of a service from the database and saves it."""
+    fingerprint = APIEndpoint.get_embeddings_fingerprint(service_name, session)
+    index = LexicalIndex.from_rows(
+        APIEndpoint.get_text_rows(fingerprint[0], session), fingerprint
+    )
+    index.save(directory, service_name)
+    return index
+
+
+def hybrid_search(
+    service_name: str,
+    prompt: str,
+    prompt_embedding: np.ndarray,
+    top_k: int = 10,
+    depth: int = 100,
+    lexical_weight: float = 1.0,
+) -> List[Tuple[int, float]]:
+    """
+    Ranks the endpoints of a service for a prompt fusing the embedding similarity
+    ranking with the BM25 ranking of the endpoint text. The top `depth` results of
+    each ranking are fused.
+
+    Returns the (endpoint id, fused score) of the top_k endpoints.
+    """
+    vector_ranking = get_service_index(service_name).search(prompt_embedding, top_k=depth)
+    lexical_ranking = get_service_lexical_index(service_name).search(prompt, top_k=depth)
+    return reciprocal_rank_fusion(
+        [vector_ranking, lexical_ranking], [1.0, lexical_weight], top_k=top_k
+    )
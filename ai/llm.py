@@ -1,36 +1,85 @@
+import os
 import yaml
 
 from jinja2 import Template
-from typing import Dict, List, Tuple
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 from .handler import AiHandler
 from auth import auth_info
-from openai import OpenAI
 import json
 
-from database.services import APIEndpoint
-from ai.embeddings import get_embedding, cosine_similarity, count_tokens
-
-DEFAULT_MODEL = "gpt-4"
+from database.services import TOKENS_FIELD, APIEndpoint, Services
+from ai.embeddings import clip_tokens, count_tokens, stack_embeddings, top_k_similar
+from ai.embedding_cache import get_cached_embedding, get_cached_embedding_async
+from ai.executor import run_blocking
+from ai.ann import get_ann_index
+from ai.lexical import hybrid_search
+from ai.context_packer import pack_endpoints
+from ai.models import get_model
+
+# Model generating the code, and model picking the endpoints among the candidates,
+# which can be a smaller and faster one. Their limits are in ai.models.
+DEFAULT_MODEL = os.getenv("LLM_CODE_MODEL", "gpt-4")
+SELECTION_MODEL = os.getenv("LLM_SELECTION_MODEL", DEFAULT_MODEL)
+# Share of the context window for the endpoint definitions of the code prompt
+ENDPOINTS_CONTEXT_RATIO = 0.3
+# Compacted definitions packed by relevance (see ai.context_packer) instead of the
+# full definitions clipped at the end
+PACK_ENDPOINTS = os.getenv("PACK_ENDPOINT_DEFINITIONS", "1") != "0"
+# Endpoints sent to the LLM to pick from, as many as with the embeddings alone until
+# benchmarks/retrieval_recall.py shows the hybrid recall holds with fewer
+TASK_CANDIDATES = 40
 ai_handler = AiHandler()
 
-def clip_to_context(text: str, clip_ratio: float= 0.8, model=DEFAULT_MODEL, **kwargs) -> str:
-    client = OpenAI()
+def clip_to_context(
+    text: str,
+    clip_ratio: float = 0.8,
+    model=DEFAULT_MODEL,
+    tokens: Optional[int] = None,
+    **kwargs,
+) -> str:
     # replace newlines, which can negatively affect performance.
     text = text.replace("\n", " ")
-    MAX_TOKENS = 8192
-    tokens = count_tokens(text, model)
     # clip ratio represents how much of the context window the text can occupy
-    while tokens > MAX_TOKENS * clip_ratio:
-        # Calculate the ratio of current tokens to the maximum allowed tokens
-        ratio = tokens / MAX_TOKENS
-        # Determine the amount of text to keep based on the clip ratio and the calculated token ratio.
-        # This uses the length of the text as a proxy for token count, adjusting the length to keep
-        # within the desired token limit. The assumption is that reducing the text by this ratio
-        # will similarly reduce the token count to within the target range.
-        amount_to_keep = len(text) * clip_ratio / ratio
-        text = text[:int(amount_to_keep)]
-        tokens = count_tokens(text, model)
-    return text
+    max_tokens = int(get_model(model).context_tokens * clip_ratio)
+    # a known token count (e.g. stored at ingestion) spares tokenizing a text that fits
+    if tokens is not None and tokens <= max_tokens:
+        return text
+    return clip_tokens(text, max_tokens, model)[0]
+
+
+def public_endpoints(endpoints: List[dict]) -> List[dict]:
+    """The endpoint definitions returned to the user, without the token counts."""
+    return [
+        {key: value for key, value in endpoint.items() if key != TOKENS_FIELD}
+        for endpoint in endpoints
+    ]
+
+
+def render_endpoints_definition(
+    endpoints: List[dict], clip_ratio: float, model: str = DEFAULT_MODEL
+) -> str:
+    """
+    Serializes the endpoint definitions, one per line, clipped to the clip ratio of
+    the context window. Definitions are budgeted with the token counts stored at
+    ingestion, only an endpoint without one or crossing the budget is tokenized.
+    """
+    max_tokens = int(get_model(model).context_tokens * clip_ratio)
+    lines, used = [], 0
+    for endpoint in endpoints:
+        endpoint = dict(endpoint)
+        tokens = endpoint.pop(TOKENS_FIELD, None)
+        line = json.dumps(endpoint)
+        if tokens is not None:
+            # the stored count covers the definition, not the added path and method
+            keys = f'"path": "{endpoint["path"]}", "method": "{endpoint["method"]}"'
+            tokens += count_tokens(keys, model) + 1
+        if tokens is None or tokens > max_tokens - used:
+            line, tokens = clip_tokens(line, max_tokens - used, model)
+        lines.append(line)
+        used += tokens
+        if used >= max_tokens:
+            break
+    return "\n".join(lines)
 
 def render(template: str, args: Dict) -> str:
     t = Template(template)
@@ -45,23 +94,19 @@ def rank_closest_embeddings(
 
     Args:
     - target_embedding: The embedding to compare against.
-    - embeddings: A list of (endpoint, embedding) tuples.
+    - embeddings: A list of (endpoint, embedding) tuples. Empty embeddings are ignored.
     - top_k: The number of top matches to return.
 
     Returns:
     A list of tuples (endpoint, similarity score) sorted by similarity score in descending order.
     """
-    match_scores = []
-
-    # Calculate similarity for each endpoint
-    for endpoint, embedding in embeddings:
-        similarity = cosine_similarity(target_embedding, embedding)
-        match_scores.append((endpoint, similarity))
+    endpoints = [endpoint for endpoint, _ in embeddings]
+    matrix, positions = stack_embeddings([embedding for _, embedding in embeddings])
+    indices, scores = top_k_similar(target_embedding, matrix, top_k)
 
-    # Sort matches by similarity in descending order
-    sorted_matches = sorted(match_scores, key=lambda x: x[1], reverse=True)
-    # Return top k matches or all matches
-    return sorted_matches if top_k is None else sorted_matches[:top_k]
+    return [
+        (endpoints[positions[i]], float(score)) for i, score in zip(indices, scores)
+    ]
 
 
 async def self_reflection(description: str, model: str = DEFAULT_MODEL) -> str:
@@ -105,9 +150,8 @@ async def self_reflection(description: str, model: str = DEFAULT_MODEL) -> str:
     Answer:
     ```yaml
     """
-    ai_handler = AiHandler()
-
-    user_prompt = render(user, {"description": clip_to_context(description)})
+    description = await run_blocking(clip_to_context, description, model=model)
+    user_prompt = render(user, {"description": description})
     outputs_def_response, finish_reason = await ai_handler.chat_completion(
         model=model,
         system=system_prompt,
@@ -115,14 +159,23 @@ async def self_reflection(description: str, model: str = DEFAULT_MODEL) -> str:
         temperature=temperature,
         frequency_penalty=frequency_penalty,
     )
-    return outputs_def_response
+    # the answer ends with the closing fence of the yaml block
+    return outputs_def_response.strip().rstrip("`").strip()
+
+
+def rank_task_endpoints(
+    service: str, prompt: str, prompt_embedding, top_k: int = TASK_CANDIDATES
+) -> List[Tuple[APIEndpoint, float]]:
+    # blocking: reads the service indexes and the endpoint rows
+    ranked_ids = dict(hybrid_search(service, prompt, prompt_embedding, top_k=top_k))
+    return [(e, ranked_ids[e.id]) for e in APIEndpoint.get_by_ids(list(ranked_ids))]
 
 
 async def get_task_endpoints(
     prompt: str,
     service: str,
     return_best_only: bool = True,
-    model: str = DEFAULT_MODEL,
+    model: str = SELECTION_MODEL,
 ) -> List[dict]:
     task_endpoints_prompt = """You are given a task description, and a list of candidate endpoints to solve the task. The endpoints in the list follow the format '[METHOD]endpoint/path: description'. Each endpoint is separated by |||. The description might be empty. The endpoints are ranked by similarity to the task description.
 
@@ -159,10 +212,9 @@ async def get_task_endpoints(
     """
 
     try:
-        embeddings = APIEndpoint.get_embeddings_for_service(service)
-        prompt_embedding = get_embedding(prompt)
-        ranked_endpoints = rank_closest_embeddings(
-            prompt_embedding, embeddings, top_k=40
+        prompt_embedding = await get_cached_embedding_async(prompt)
+        ranked_endpoints = await run_blocking(
+            rank_task_endpoints, service, prompt, prompt_embedding
         )
     except Exception as e:
         print(f"Error retrieving endpoint info: {e}")
@@ -174,7 +226,7 @@ async def get_task_endpoints(
     print("\n".join([e.path for e, _ in ranked_endpoints]))
     if return_best_only:
         best = ranked_endpoints[0][0]
-        return [best.to_dict()]
+        return [best.to_dict(with_tokens=True)]
 
     # We could add the parametesrs also to the request, but then they might become too large
     params = {
@@ -184,7 +236,7 @@ async def get_task_endpoints(
 
     user_prompt = render(task_endpoints_prompt, params)
     endpoints_response, finish_reason = await ai_handler.chat_completion(
-        model=DEFAULT_MODEL,
+        model=model,
         system="",
         user=user_prompt,
         temperature=0.0,
@@ -192,11 +244,35 @@ async def get_task_endpoints(
 
     endpoints_paths = yaml.safe_load(endpoints_response.lstrip('```yaml\n').rstrip('\n```'))["endpoints"]
     endpoints_defs = [
-        e.to_dict() for e, _ in ranked_endpoints if e.path in endpoints_paths
+        e.to_dict(with_tokens=True) for e, _ in ranked_endpoints if e.path in endpoints_paths
     ]
     return endpoints_defs
 
 
+def search_endpoints(prompt: str, top_k: int = 10) -> List[dict]:
+    """
+    Searches the endpoints of all the ingested services closest to the prompt, using
+    the approximate nearest neighbour index. Each endpoint definition includes its
+    "service" and similarity "score".
+    """
+    prompt_embedding = get_cached_embedding(prompt)
+    ranked_ids = dict(get_ann_index().search(prompt_embedding, top_k=top_k))
+    endpoints = APIEndpoint.get_by_ids(list(ranked_ids))
+
+    service_ids = {e.service_id for e in endpoints}
+    service_names = {
+        s.id: s.name for s in Services.query.filter(Services.id.in_(service_ids)).all()
+    }
+
+    results = []
+    for endpoint in endpoints:
+        definition = endpoint.to_dict()
+        definition["service"] = service_names.get(endpoint.service_id)
+        definition["score"] = ranked_ids[endpoint.id]
+        results.append(definition)
+    return results
+
+
 async def get_auth_info(
     description: str,
     endpoints_definition: str = [],
@@ -238,7 +314,9 @@ async def get_auth_info(
         auth_prompt,
         {
             "description": description,
-            "endpoint_definition": clip_to_context(endpoints_definition),
+            "endpoint_definition": await run_blocking(
+                clip_to_context, endpoints_definition, model=model
+            ),
         },
     )
 
@@ -252,11 +330,12 @@ async def get_auth_info(
     return auth_response
 
 
-async def generate_task_code(
+async def render_code_prompt(
     description: str,
     endpoints: List[dict],
     auth_details: str,
     token: str,
+    outputs: str = "",
     model: str = DEFAULT_MODEL,
 ) -> str:
     code_prompt = """You are given a problem description, the definition of the endpoint(s), and the token and details needed to authenticate.
@@ -280,7 +359,12 @@ async def generate_task_code(
     =====
     {{ token }}
     =====
-
+    {% if outputs %}
+    required outputs:
+    =====
+    {{ outputs }}
+    =====
+    {% endif %}
     Your goal is to generate a valid Python code that correctly solves the problem.
     Guidelines:
     - Make sure to include all the necessary module imports, properly initialize the variables, and address the problem constraints.
@@ -310,15 +394,92 @@ async def generate_task_code(
     ```python
     """
 
+    # tokenizing long definitions is CPU bound, keep it off the event loop
+    description = await run_blocking(clip_to_context, description, 0.5, model)
+    if PACK_ENDPOINTS:
+        endpoints_definition, _ = await run_blocking(
+            pack_endpoints,
+            endpoints,
+            int(get_model(model).context_tokens * ENDPOINTS_CONTEXT_RATIO),
+            model,
+        )
+    else:
+        endpoints_definition = await run_blocking(
+            render_endpoints_definition, endpoints, ENDPOINTS_CONTEXT_RATIO, model
+        )
     user_prompt = render(
         code_prompt,
         {
-            "description": clip_to_context(description, 0.5),
+            "description": description,
             "token": token if token else "no token provided",
             "auth_details": auth_details,
-                "endpoints_definition": clip_to_context('\n'.join([json.dumps(endpoint) for endpoint in endpoints]), 0.3),
+            "endpoints_definition": endpoints_definition,
+            "outputs": outputs,
         },
     )
+    return user_prompt
+
+
+class CodeFenceStripper:
+    """
+    Strips the markdown code fences around the code of a completion, chunk by chunk
+    as it is streamed: an opening ```python line is dropped and everything from the
+    closing ``` on is ignored. Backticks that could start a fence are held back
+    until the next chunk.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._started = False
+        self._done = False
+
+    def feed(self, chunk: str) -> str:
+        if self._done:
+            return ""
+        self._buffer += chunk
+
+        if not self._started:
+            text = self._buffer.lstrip()
+            if text.startswith("```"):
+                if "\n" not in text:
+                    return ""  # wait for the end of the opening fence line
+                text = text.split("\n", 1)[1]
+            elif len(text) < 3 and "```".startswith(text):
+                return ""
+            self._buffer = text
+            self._started = True
+
+        end = self._buffer.find("```")
+        if end >= 0:
+            code, self._buffer, self._done = self._buffer[:end], "", True
+            return code
+
+        held = len(self._buffer) - len(self._buffer.rstrip("`"))
+        code = self._buffer[: len(self._buffer) - held]
+        self._buffer = self._buffer[len(code) :]
+        return code
+
+    def flush(self) -> str:
+        code, self._buffer = ("" if self._done else self._buffer), ""
+        return code
+
+
+def strip_code_fences(text: str) -> str:
+    stripper = CodeFenceStripper()
+    return stripper.feed(text) + stripper.flush()
+
+
+async def generate_task_code(
+    description: str,
+    endpoints: List[dict],
+    auth_details: str,
+    token: str,
+    model: str = DEFAULT_MODEL,
+    outputs: str = "",
+) -> str:
+    user_prompt = await render_code_prompt(
+        description, endpoints, auth_details, token, outputs, model
+    )
 
     code_response, finish_reason = await ai_handler.chat_completion(
         model=model,
@@ -328,10 +489,39 @@ async def generate_task_code(
         frequency_penalty=0.1,
     )
 
-    code = code_response.lstrip('```python\n').rstrip('```')
-    if '```' in code:
-        code = code.split('```')[0]
-    return code
+    return strip_code_fences(code_response)
+
+
+async def generate_task_code_stream(
+    description: str,
+    endpoints: List[dict],
+    auth_details: str,
+    token: str,
+    model: str = DEFAULT_MODEL,
+    outputs: str = "",
+) -> AsyncIterator[str]:
+    """
+    Streaming version of `generate_task_code`: yields the code as the model
+    generates it, without the markdown fences.
+    """
+    user_prompt = await render_code_prompt(
+        description, endpoints, auth_details, token, outputs, model
+    )
+
+    stripper = CodeFenceStripper()
+    async for chunk in ai_handler.chat_completion_stream(
+        model=model,
+        system="",
+        user=user_prompt,
+        temperature=0.2,
+        frequency_penalty=0.1,
+    ):
+        code = stripper.feed(chunk)
+        if code:
+            yield code
+    code = stripper.flush()
+    if code:
+        yield code
 
 async def generate_service_call(prompt, service, token):
     # outputs = await self_reflection(prompt)
@@ -339,7 +529,7 @@ async def generate_service_call(prompt, service, token):
     try:
         # 1. Get the most probable endpoints needed to solve the problem
         embeddings = APIEndpoint.get_embeddings_for_service(service)
-        prompt_embedding = get_embedding(prompt)
+        prompt_embedding = get_cached_embedding(prompt)
         ranked_endpoints = rank_closest_embeddings(prompt_embedding, embeddings)
 
         # use the most similar endpoint
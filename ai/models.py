@@ -0,0 +1,246 @@
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass, replace
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ModelInfo:
+    """Capabilities and limits of a chat or embedding model."""
+
+    name: str
+    context_tokens: int
+    max_output_tokens: int
+    encoding: str = "cl100k_base"  # tiktoken encoding
+    # USD per 1000 tokens
+    input_cost: float = 0.0
+    output_cost: float = 0.0
+    requests_per_minute: int = 60
+    tokens_per_minute: int = 40000
+
+
+# Limits of the OpenAI API vary with the usage tier of the account, these are the
+# tier 2 ones. LLM_MAX_REQS_MINUTE and LLM_MAX_TOKENS_MINUTE override them all.
+MODELS: Dict[str, ModelInfo] = {
+    info.name: info
+    for info in [
+        ModelInfo(
+            "gpt-4",
+            context_tokens=8192,
+            max_output_tokens=4096,
+            input_cost=0.03,
+            output_cost=0.06,
+            requests_per_minute=5000,
+            tokens_per_minute=40_000,
+        ),
+        ModelInfo(
+            "gpt-4-32k",
+            context_tokens=32768,
+            max_output_tokens=4096,
+            input_cost=0.06,
+            output_cost=0.12,
+            requests_per_minute=5000,
+            tokens_per_minute=40_000,
+        ),
+        ModelInfo(
+            "gpt-4-turbo",
+            context_tokens=128000,
+            max_output_tokens=4096,
+            input_cost=0.01,
+            output_cost=0.03,
+            requests_per_minute=5000,
+            tokens_per_minute=450_000,
+        ),
+        ModelInfo(
+            "gpt-4-turbo-preview",
+            context_tokens=128000,
+            max_output_tokens=4096,
+            input_cost=0.01,
+            output_cost=0.03,
+            requests_per_minute=5000,
+            tokens_per_minute=450_000,
+        ),
+        ModelInfo(
+            "gpt-4-0125-preview",
+            context_tokens=128000,
+            max_output_tokens=4096,
+            input_cost=0.01,
+            output_cost=0.03,
+            requests_per_minute=5000,
+            tokens_per_minute=450_000,
+        ),
+        ModelInfo(
+            "gpt-4-1106-preview",
+            context_tokens=128000,
+            max_output_tokens=4096,
+            input_cost=0.01,
+            output_cost=0.03,
+            requests_per_minute=5000,
+            tokens_per_minute=450_000,
+        ),
+        # their o200k_base encoding needs tiktoken 0.7, cl100k_base counts a few more
+        # tokens, which keeps the budgets on the safe side
+        ModelInfo(
+            "gpt-4o",
+            context_tokens=128000,
+            max_output_tokens=4096,
+            input_cost=0.005,
+            output_cost=0.015,
+            requests_per_minute=5000,
+            tokens_per_minute=450_000,
+        ),
+        ModelInfo(
+            "gpt-4o-mini",
+            context_tokens=128000,
+            max_output_tokens=16384,
+            input_cost=0.00015,
+            output_cost=0.0006,
+            requests_per_minute=5000,
+            tokens_per_minute=2_000_000,
+        ),
+        ModelInfo(
+            "gpt-3.5-turbo",
+            context_tokens=16385,
+            max_output_tokens=4096,
+            input_cost=0.0005,
+            output_cost=0.0015,
+            requests_per_minute=3500,
+            tokens_per_minute=80_000,
+        ),
+        ModelInfo(
+            "text-embedding-3-small",
+            context_tokens=8191,
+            max_output_tokens=0,
+            input_cost=2e-05,
+            requests_per_minute=5000,
+            tokens_per_minute=1_000_000,
+        ),
+        ModelInfo(
+            "text-embedding-3-large",
+            context_tokens=8191,
+            max_output_tokens=0,
+            input_cost=0.00013,
+            requests_per_minute=5000,
+            tokens_per_minute=1_000_000,
+        ),
+        ModelInfo(
+            "text-embedding-ada-002",
+            context_tokens=8191,
+            max_output_tokens=0,
+            input_cost=0.0001,
+            requests_per_minute=5000,
+            tokens_per_minute=1_000_000,
+        ),
+    ]
+}
+
+# Models not in the registry (e.g. local ones) get these conservative limits
+UNKNOWN_CONTEXT_TOKENS = 4096
+UNKNOWN_MAX_OUTPUT_TOKENS = 1024
+
+_overrides_lock = threading.Lock()
+_overrides_loaded = False
+# models already warned about by get_model
+_unknown_models = set()
+
+
+def load_models_file(path: str):
+    """
+    Registers the models of a JSON file mapping model names to ModelInfo fields,
+    e.g. {"ollama/llama2": {"context_tokens": 4096, "max_output_tokens": 1024}}.
+    Fields of a registered model that are left out keep their value.
+    """
+    with open(path) as f:
+        models = json.load(f)
+    for name, fields in models.items():
+        base = MODELS.get(name) or ModelInfo(
+            name, UNKNOWN_CONTEXT_TOKENS, UNKNOWN_MAX_OUTPUT_TOKENS
+        )
+        MODELS[name] = replace(base, **fields)
+
+
+def _load_overrides():
+    # the LLM_MODELS_FILE models, loaded on first lookup
+    global _overrides_loaded
+    if _overrides_loaded:
+        return
+    with _overrides_lock:
+        if not _overrides_loaded:
+            path = os.getenv("LLM_MODELS_FILE")
+            if path:
+                load_models_file(path)
+            _overrides_loaded = True
+
+
+def get_model(name: str) -> ModelInfo:
+    """
+    Returns the capabilities of a model. Dated versions and provider prefixes
+    ("gpt-4-0613", "openai/gpt-4") resolve to the longest registered name they
+    start with, unknown models get conservative limits.
+    """
+    _load_overrides()
+    info = MODELS.get(name)
+    if info is not None:
+        return info
+
+    bare = name.split("/", 1)[-1]
+    prefixes = [m for m in MODELS if bare == m or bare.startswith(f"{m}-")]
+    if prefixes:
+        return replace(MODELS[max(prefixes, key=len)], name=name)
+
+    with _overrides_lock:
+        warn = name not in _unknown_models
+        _unknown_models.add(name)
+    if warn:
+        logger.warning(
+            f"Unknown model {name}, assuming a {UNKNOWN_CONTEXT_TOKENS} tokens context"
+        )
+    return ModelInfo(name, UNKNOWN_CONTEXT_TOKENS, UNKNOWN_MAX_OUTPUT_TOKENS)
+
+
+def completion_tokens_limit(model: str, prompt_tokens: int) -> int:
+    """
+    Most tokens a completion of the model can have after a prompt: its output
+    limit, or what is left of the context window if that is less.
+    """
+    info = get_model(model)
+    return max(min(info.max_output_tokens, info.context_tokens - prompt_tokens), 0)
+
+
+def model_cost(model: str, prompt_tokens: int, completion_tokens: int = 0) -> float:
+    """Cost in USD of a request to the model."""
+    info = get_model(model)
+    return (prompt_tokens * info.input_cost + completion_tokens * info.output_cost) / 1000
+
+
+class UsageMetrics:
+    """Requests, tokens and cost of the LLM completions, per model."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._usage: Dict[str, Dict[str, float]] = {}
+
+    def record(self, model: str, prompt_tokens: int, completion_tokens: int):
+        with self._lock:
+            usage = self._usage.setdefault(
+                model,
+                {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0},
+            )
+            usage["requests"] += 1
+            usage["prompt_tokens"] += prompt_tokens
+            usage["completion_tokens"] += completion_tokens
+            usage["cost"] += model_cost(model, prompt_tokens, completion_tokens)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                model: {**usage, "cost": round(usage["cost"], 4)}
+                for model, usage in self._usage.items()
+            }
+
+
+usage = UsageMetrics()
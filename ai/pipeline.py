@@ -0,0 +1,76 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+@dataclass
+class Stage:
+    """
+    A step of a pipeline. `run` is called with the results of the stages it
+    depends on as keyword arguments, named after them.
+    """
+
+    name: str
+    run: Callable[..., Awaitable[Any]]
+    depends_on: Tuple[str, ...] = field(default_factory=tuple)
+    timeout: Optional[float] = None  # seconds
+
+
+class StageError(Exception):
+    def __init__(self, stage: str, error: BaseException):
+        self.stage = stage
+        self.error = error
+        reason = "timed out" if isinstance(error, asyncio.TimeoutError) else str(error)
+        super().__init__(f"Stage {stage} failed: {reason or type(error).__name__}")
+
+
+async def run_pipeline(stages: List[Stage]) -> Tuple[Dict[str, Any], Dict[str, float]]:
+    """
+    Runs a graph of stages, listed in dependency order, each one as soon as the
+    stages it depends on are done, so independent stages run concurrently. When a
+    stage fails or exceeds its timeout the rest are cancelled and a StageError is
+    raised.
+
+    Returns the results and the latency in seconds of each stage, from the moment
+    its dependencies were ready, plus the "total" latency of the pipeline.
+    """
+    # listing the stages in dependency order rules out cycles
+    seen = set()
+    for stage in stages:
+        missing = set(stage.depends_on) - seen
+        if missing:
+            raise ValueError(f"Stage {stage.name} depends on stages not before it: {missing}")
+        seen.add(stage.name)
+
+    start = time.perf_counter()
+    tasks: Dict[str, asyncio.Task] = {}
+    latencies: Dict[str, float] = {}
+
+    async def run_stage(stage: Stage):
+        inputs = await asyncio.gather(*(tasks[name] for name in stage.depends_on))
+        stage_start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(
+                stage.run(**dict(zip(stage.depends_on, inputs))), stage.timeout
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            raise StageError(stage.name, e) from e
+        latencies[stage.name] = time.perf_counter() - stage_start
+        return result
+
+    for stage in stages:
+        tasks[stage.name] = asyncio.ensure_future(run_stage(stage))
+
+    try:
+        results = await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        raise
+
+    latencies["total"] = time.perf_counter() - start
+    return dict(zip(tasks, results)), latencies
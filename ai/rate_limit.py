@@ -0,0 +1,162 @@
+import asyncio
+import email.utils
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Optional, Tuple, Type, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class RateLimiter:
+    """
+    Async rate limiter with two budgets refilled continuously: requests per minute
+    and tokens per minute, like the limits of the OpenAI API. A request waits until
+    both budgets can pay for it. Callers are served in order, so large requests
+    aren't starved by small ones.
+
+    Tokens can be consumed after the fact (the completion tokens of a response)
+    and the limiter can be paused when the API answers with Retry-After, so the
+    other in-flight callers back off too instead of hitting more 429 errors.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        # created on first use, inside the event loop that uses the limiter
+        self._lock: Optional[asyncio.Lock] = None
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def _refill(self) -> float:
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(
+            self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60
+        )
+        self._tokens = min(
+            self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60
+        )
+        return now
+
+    def _wait_for(self, requests: float, tokens: float) -> float:
+        # seconds until both budgets can pay for the request
+        now = self._refill()
+        request_wait = (requests - self._requests) * 60 / self.requests_per_minute
+        token_wait = (tokens - self._tokens) * 60 / self.tokens_per_minute
+        return max(self._paused_until - now, request_wait, token_wait, 0.0)
+
+    async def acquire(self, tokens: int = 0):
+        """Waits until a request of `tokens` tokens fits in both budgets."""
+        # a request larger than the whole budget would never fit
+        tokens = min(tokens, self.tokens_per_minute)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            start = time.monotonic()
+            wait = self._wait_for(1, tokens)
+            if wait > 0:
+                self.waits += 1
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self._wait_for(1, tokens)
+            self.wait_time += time.monotonic() - start
+            self._requests -= 1
+            self._tokens -= tokens
+
+    def consume(self, tokens: int):
+        """Charges tokens used after the request was made, e.g. completion tokens."""
+        self._refill()
+        self._tokens -= tokens
+
+    def pause(self, seconds: float):
+        """Holds every request for the given seconds (a Retry-After from the API)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def stats(self) -> dict:
+        self._refill()
+        return {
+            "requests_per_minute": self.requests_per_minute,
+            "tokens_per_minute": self.tokens_per_minute,
+            "available_requests": round(self._requests, 2),
+            "available_tokens": round(self._tokens),
+            "waits": self.waits,
+            "wait_time": round(self.wait_time, 3),
+        }
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """
+    Seconds to wait according to the Retry-After (or retry-after-ms) header of the
+    HTTP response attached to an API error, None when there is none.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    milliseconds = headers.get("retry-after-ms")
+    if milliseconds is not None:
+        try:
+            return float(milliseconds) / 1000
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError, OverflowError):
+        # neither seconds nor an HTTP date
+        return None
+    return max(0.0, date.timestamp() - time.time()) if date else None
+
+
+async def retry_async(
+    call: Callable[[], Awaitable[T]],
+    retry_on: Tuple[Type[BaseException], ...],
+    tries: int = 5,
+    base_delay: float = 1.0,
+    max_delay: float = 60.0,
+    on_retry: Optional[Callable[[Exception, float], None]] = None,
+) -> T:
+    """
+    Awaits call() until it succeeds, retrying the errors in retry_on at most
+    tries - 1 times. Retries wait for the Retry-After of the error when the API
+    sent one, otherwise for an exponential backoff with full jitter:
+    uniform(0, min(max_delay, base_delay * 2 ** attempt)).
+    """
+    for attempt in range(tries):
+        try:
+            return await call()
+        except retry_on as e:
+            if attempt == tries - 1:
+                raise
+
+            delay = retry_after(e)
+            if delay is None:
+                delay = random.uniform(0, min(max_delay, base_delay * 2**attempt))
+            else:
+                # spread the callers that got the same Retry-After
+                delay = min(delay, max_delay) * random.uniform(1, 1.1)
+
+            logger.warning(
+                f"Attempt {attempt + 1}/{tries} failed ({type(e).__name__}), "
+                f"retrying in {delay:.2f}s"
+            )
+            if on_retry is not None:
+                on_retry(e, delay)
+            await asyncio.sleep(delay)
@@ -0,0 +1,335 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from ai.embedding_cache import get_cached_embedding_async, normalize_text
+from ai.embeddings import to_array, to_binary
+from ai.executor import run_blocking
+from database.services import APIEndpoint
+
+# Stands for the user token in the stored code, the token itself is never stored
+TOKEN_PLACEHOLDER = "{{TALK2APIS_TOKEN}}"
+# The token is redacted by plain substring replacement, so a short one would also
+# replace ordinary text of the code (and put the next user's token there). The
+# responses generated with shorter tokens are not cached, see ResponseCache.stats.
+MIN_TOKEN_LENGTH = 8
+
+
+def models_key(code_model: str, selection_model: str) -> str:
+    # both models shape the response: the selected endpoints and the code
+    return f"{code_model}+{selection_model}"
+
+
+def prompt_key(service: str, prompt: str, model: str) -> str:
+    # only the whitespace is normalized, the code uses the literal values of the
+    # prompt (channel IDs, message text) and those are case-sensitive
+    return hashlib.sha256(
+        f"{service}\0{normalize_text(prompt)}\0{model}".encode()
+    ).hexdigest()
+
+
+def endpoints_key(endpoints: List[dict]) -> str:
+    # the set of selected endpoints, independent of their order
+    selected = sorted(f"{e.get('method', '')} {e.get('path', '')}" for e in endpoints)
+    return hashlib.sha256("\n".join(selected).encode()).hexdigest()
+
+
+def redact_token(code: str, token: Optional[str]) -> Optional[str]:
+    """
+    Replaces every occurrence of the token in the code by TOKEN_PLACEHOLDER.
+    Returns None when the code can't be redacted safely: the token is shorter
+    than MIN_TOKEN_LENGTH, or the code already contains the placeholder.
+    """
+    if not token:
+        return code
+    if len(token) < MIN_TOKEN_LENGTH or TOKEN_PLACEHOLDER in code:
+        return None
+    return code.replace(token, TOKEN_PLACEHOLDER)
+
+
+def restore_token(code: str, token: Optional[str]) -> str:
+    return code.replace(TOKEN_PLACEHOLDER, token or "")
+
+
+class ResponseCache:
+    """
+    SQLite cache of the generated code, keyed on the service, the normalized
+    prompt, the set of selected endpoints and the models. Entries record the
+    fingerprint of the service, (service id, version), and are ignored once it is
+    re-ingested.
+
+    Lookups happen before the pipeline runs, when the selected endpoints are not
+    known yet: the most recently used entry of the (service, prompt, model) is
+    returned. With a similarity threshold, a prompt without an exact entry can
+    also reuse the entry of the most similar cached prompt of the service.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = 10000,
+        ttl: float = 7 * 24 * 3600,
+        similarity_threshold: Optional[float] = None,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        # responses not stored: no endpoints or code, or a token unsafe to redact
+        self.skipped = 0
+
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                prompt_key TEXT NOT NULL,
+                service TEXT NOT NULL,
+                model TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                embedding BLOB,
+                endpoints TEXT NOT NULL,
+                code TEXT NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_prompt_key ON responses (prompt_key)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_service ON responses (service, model)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+        )
+        self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def _touch(self, key: str) -> Tuple[List[dict], str]:
+        # caller holds the lock
+        self._conn.execute(
+            "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+        )
+        self._conn.commit()
+        endpoints, code = self._conn.execute(
+            "SELECT endpoints, code FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        return json.loads(endpoints), code
+
+    def get(
+        self, service: str, prompt: str, model: str, fingerprint
+    ) -> Optional[Tuple[List[dict], str]]:
+        """Returns the (endpoints, redacted code) cached for the exact prompt."""
+        with self._lock:
+            row = self._conn.execute(
+                """SELECT key FROM responses
+                WHERE prompt_key = ? AND fingerprint = ? AND created > ?
+                ORDER BY last_used DESC LIMIT 1""",
+                (
+                    prompt_key(service, prompt, model),
+                    json.dumps(fingerprint),
+                    time.time() - self.ttl,
+                ),
+            ).fetchone()
+            if row is None:
+                return None
+            self.hits += 1
+            return self._touch(row[0])
+
+    def get_similar(
+        self, service: str, embedding: np.ndarray, model: str, fingerprint
+    ) -> Optional[Tuple[List[dict], str]]:
+        """
+        Returns the (endpoints, redacted code) of the most similar cached prompt of
+        the service when its cosine similarity reaches the threshold.
+        """
+        if not self.similarity_threshold:
+            return None
+
+        with self._lock:
+            rows = self._conn.execute(
+                """SELECT key, embedding FROM responses
+                WHERE service = ? AND model = ? AND fingerprint = ? AND created > ?
+                AND embedding IS NOT NULL""",
+                (service, model, json.dumps(fingerprint), time.time() - self.ttl),
+            ).fetchall()
+            if not rows:
+                return None
+
+            matrix = np.stack([to_array(blob) for _, blob in rows]).astype(np.float32)
+            query = np.asarray(embedding, dtype=np.float32)
+            scores = matrix @ query / (
+                np.linalg.norm(matrix, axis=1) * np.linalg.norm(query) + 1e-12
+            )
+            best = int(np.argmax(scores))
+            if scores[best] < self.similarity_threshold:
+                return None
+            self.semantic_hits += 1
+            return self._touch(rows[best][0])
+
+    def put(
+        self,
+        service: str,
+        prompt: str,
+        model: str,
+        fingerprint,
+        endpoints: List[dict],
+        code: str,
+        embedding: Optional[np.ndarray] = None,
+    ):
+        """Stores a response, the code must already have the token redacted."""
+        key = hashlib.sha256(
+            f"{prompt_key(service, prompt, model)}\0{endpoints_key(endpoints)}".encode()
+        ).hexdigest()
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                """INSERT OR REPLACE INTO responses
+                (key, prompt_key, service, model, fingerprint, embedding, endpoints, code, created, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    key,
+                    prompt_key(service, prompt, model),
+                    service,
+                    model,
+                    json.dumps(fingerprint),
+                    None if embedding is None else to_binary(embedding),
+                    json.dumps(endpoints),
+                    code,
+                    now,
+                    now,
+                ),
+            )
+            self._conn.commit()
+        self.evict()
+
+    def evict(self):
+        """Drops the expired entries and the least recently used above max_entries."""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM responses WHERE created <= ?", (time.time() - self.ttl,)
+            )
+            self._conn.execute(
+                """DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )""",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        total = self.hits + self.semantic_hits + self.misses
+        return {
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.semantic_hits) / total if total else 0.0,
+            "skipped": self.skipped,
+            "entries": len(self),
+        }
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """
+    Returns the process-wide response cache, configured on first use with
+    RESPONSE_CACHE_PATH (empty to disable the cache), RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_TTL (seconds) and RESPONSE_CACHE_SIMILARITY (cosine similarity
+    threshold of the semantic lookup, disabled when unset).
+    """
+    global _response_cache
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                path = os.getenv("RESPONSE_CACHE_PATH", "instance/response_cache.db")
+                if not path:
+                    return None
+                similarity = os.getenv("RESPONSE_CACHE_SIMILARITY")
+                _response_cache = ResponseCache(
+                    path,
+                    max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000")),
+                    ttl=float(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600))),
+                    similarity_threshold=float(similarity) if similarity else None,
+                )
+    return _response_cache
+
+
+async def get_cached_response(
+    service: str, prompt: str, token: Optional[str], model: str, selection_model: str
+) -> Optional[dict]:
+    """
+    Returns the cached {"code", "endpoints"} response for the prompt, with the
+    user token put back in the code, or None on a miss.
+    """
+    cache = get_response_cache()
+    if cache is None:
+        return None
+
+    model = models_key(model, selection_model)
+    fingerprint = await run_blocking(APIEndpoint.get_embeddings_fingerprint, service)
+    cached = await run_blocking(cache.get, service, prompt, model, fingerprint)
+    if cached is None and cache.similarity_threshold:
+        # the embedding is needed anyway to retrieve the endpoints on a miss
+        embedding = await get_cached_embedding_async(prompt)
+        cached = await run_blocking(cache.get_similar, service, embedding, model, fingerprint)
+
+    if cached is None:
+        cache.misses += 1
+        return None
+    endpoints, code = cached
+    return {"code": restore_token(code, token), "endpoints": endpoints}
+
+
+async def cache_response(
+    service: str,
+    prompt: str,
+    token: Optional[str],
+    model: str,
+    selection_model: str,
+    response: dict,
+):
+    """
+    Stores a response with the token redacted. Responses without endpoints (e.g.
+    the retrieval failed) or code are not stored, nor the ones whose token can't
+    be redacted safely, see redact_token.
+    """
+    cache = get_response_cache()
+    if cache is None:
+        return
+    code = redact_token(response["code"] or "", token)
+    if not response["endpoints"] or not code or not code.strip():
+        cache.skipped += 1
+        return
+
+    fingerprint = await run_blocking(APIEndpoint.get_embeddings_fingerprint, service)
+    embedding = None
+    if cache.similarity_threshold:
+        embedding = await get_cached_embedding_async(prompt)
+    await run_blocking(
+        cache.put,
+        service,
+        prompt,
+        models_key(model, selection_model),
+        fingerprint,
+        response["endpoints"],
+        code,
+        embedding,
+    )
@@ -0,0 +1,59 @@
+"""Store the token counts of the endpoint texts
+
+Revision ID: 5f1d8a2c7e94
+Revises: 9c4e2b7d1a3f
+Create Date: 2026-10-18 16:02:19.540318
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from ai.embeddings import count_endpoint_tokens
+
+# revision identifiers, used by Alembic.
+revision: str = '5f1d8a2c7e94'
+down_revision: Union[str, None] = '9c4e2b7d1a3f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 500
+TOKEN_COLUMNS = ["summary_tokens", "description_tokens", "definition_tokens"]
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("api_endpoints") as batch_op:
+        for column in TOKEN_COLUMNS:
+            batch_op.add_column(sa.Column(column, sa.Integer(), nullable=True))
+
+    # count the tokens of the existing endpoints, new ones are counted at ingestion
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.text("SELECT id, summary, description, definition FROM api_endpoints")
+    ).fetchall()
+    updates = [
+        {
+            "id": id,
+            **count_endpoint_tokens(
+                {"summary": summary, "description": description, "definition": definition}
+            ),
+        }
+        for id, summary, description, definition in rows
+    ]
+
+    for start in range(0, len(updates), BATCH_SIZE):
+        connection.execute(
+            sa.text(
+                "UPDATE api_endpoints SET summary_tokens = :summary_tokens, "
+                "description_tokens = :description_tokens, "
+                "definition_tokens = :definition_tokens WHERE id = :id"
+            ),
+            updates[start : start + BATCH_SIZE],
+        )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("api_endpoints") as batch_op:
+        for column in reversed(TOKEN_COLUMNS):
+            batch_op.drop_column(column)
@@ -0,0 +1,58 @@
+"""Rewrite api_endpoints.embedding in the versioned storage format
+
+Revision ID: 9c4e2b7d1a3f
+Revises: b3e7c1d9f2a6
+Create Date: 2026-10-18 10:12:41.318204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from ai.embeddings import read_embedding_header, to_array, to_binary
+
+# revision identifiers, used by Alembic.
+revision: str = '9c4e2b7d1a3f'
+down_revision: Union[str, None] = 'b3e7c1d9f2a6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 500
+
+
+def rewrite_embeddings(convert) -> None:
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.text("SELECT id, embedding FROM api_endpoints WHERE embedding IS NOT NULL")
+    ).fetchall()
+
+    updates = []
+    for id, embedding in rows:
+        converted = convert(bytes(embedding))
+        if converted is not None:
+            updates.append({"id": id, "embedding": converted})
+
+    for start in range(0, len(updates), BATCH_SIZE):
+        connection.execute(
+            sa.text("UPDATE api_endpoints SET embedding = :embedding WHERE id = :id"),
+            updates[start : start + BATCH_SIZE],
+        )
+
+
+def upgrade() -> None:
+    # Legacy blobs are raw float64 bytes, rewrite them with a header and the
+    # storage dtype (EMBEDDING_STORAGE_DTYPE, float32 by default)
+    rewrite_embeddings(
+        lambda embedding: to_binary(to_array(embedding))
+        if read_embedding_header(embedding) is None
+        else None
+    )
+
+
+def downgrade() -> None:
+    rewrite_embeddings(
+        lambda embedding: to_array(embedding).astype("float64").tobytes()
+        if read_embedding_header(embedding) is not None
+        else None
+    )
@@ -0,0 +1,34 @@
+"""Version the services on each ingestion
+
+Revision ID: b3e7c1d9f2a6
+Revises: 46f73082162c
+Create Date: 2026-10-18 18:41:07.215903
+
+"""
+import time
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b3e7c1d9f2a6'
+down_revision: Union[str, None] = '46f73082162c'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("services") as batch_op:
+        batch_op.add_column(sa.Column("version", sa.BigInteger(), nullable=True))
+
+    # a distinct version per existing service, new ingestions stamp their own
+    op.get_bind().execute(
+        sa.text("UPDATE services SET version = :now + id"), {"now": time.time_ns()}
+    )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("services") as batch_op:
+        batch_op.drop_column("version")
@@ -1,43 +1,165 @@
 import os
+import json
+import threading
+import time
 from dotenv import load_dotenv
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, render_template, jsonify, request, stream_with_context
 from database.database import init_db
-import uuid
-import docker
 
 from ai import llm
+from ai.embedding_cache import get_query_cache
+from ai.response_cache import cache_response, get_cached_response, get_response_cache
+from ai.clients import clients
+from ai.models import usage
+from ai.executor import iterate_async, run_coroutine
+from ai.pipeline import Stage, run_pipeline
+from runner.pool import get_runner_pool, runner_pool_stats, warm_runner_pool
 
 load_dotenv()
 
 db_uri = os.getenv("SQLALCHEMY_APIS_DATABASE_URI")
 validate_user_prompt = os.getenv("VALIDATE_USER_PROMPT")
+# adds the outputs required by the prompt, as listed by the LLM, to the code prompt
+self_reflection = os.getenv("SELF_REFLECTION")
+# starts the code runners with the app under a WSGI server, so the first /run_code
+# doesn't wait for them (python app.py always does)
+prewarm_runners = os.getenv("RUNNER_PREWARM")
+
+# Seconds each stage of /gen-script may take, retries of the LLM calls included
+STAGE_TIMEOUTS = {"endpoints": 120, "auth": 60, "outputs": 120, "code": 300}
+# Most endpoints /search returns
+MAX_SEARCH_TOP_K = 100
 
 app = Flask(__name__)
 db = init_db(db_uri, app)
 
+if prewarm_runners:
+    threading.Thread(target=warm_runner_pool, daemon=True).start()
+
+
+def prompt_stages(service, prompt):
+    """
+    Stages that only need the prompt, they run concurrently before the code
+    generation, which depends on all of them.
+    """
+    stages = [
+        Stage(
+            "endpoints",
+            lambda: llm.get_task_endpoints(
+                service=service, prompt=prompt, return_best_only=False
+            ),
+            timeout=STAGE_TIMEOUTS["endpoints"],
+        ),
+        Stage(
+            "auth",
+            lambda: llm.get_auth_info(description=prompt, service=service, use_llm=False),
+            timeout=STAGE_TIMEOUTS["auth"],
+        ),
+    ]
+    if self_reflection:
+        stages.append(
+            Stage(
+                "outputs",
+                lambda: llm.self_reflection(prompt),
+                timeout=STAGE_TIMEOUTS["outputs"],
+            )
+        )
+    return stages
+
+
+def latency_metadata(latencies):
+    return {"latency_ms": {stage: round(t * 1000) for stage, t in latencies.items()}}
+
 
 async def process_user_prompt(service, token, prompt):
     try:
-        endpoints = await llm.get_task_endpoints(
-            service=service, prompt=prompt, return_best_only=False
+        cached = await get_cached_response(
+            service, prompt, token, llm.DEFAULT_MODEL, llm.SELECTION_MODEL
         )
-
-        auth_info = await llm.get_auth_info(
-            description=prompt, service=service, use_llm=False
+        if cached is not None:
+            return {**cached, "metadata": {"cached": True}}, None
+
+        stages = prompt_stages(service, prompt)
+
+        async def generate_code(endpoints, auth, outputs=""):
+            return await llm.generate_task_code(
+                description=prompt,
+                auth_details=auth,
+                endpoints=endpoints,
+                token=token,
+                outputs=outputs,
+            )
+
+        stages.append(
+            Stage(
+                "code",
+                generate_code,
+                depends_on=tuple(stage.name for stage in stages),
+                timeout=STAGE_TIMEOUTS["code"],
+            )
+        )
+        results, latencies = await run_pipeline(stages)
+
+        response = {
+            "code": results["code"],
+            "endpoints": llm.public_endpoints(results["endpoints"]),
+        }
+        await cache_response(
+            service, prompt, token, llm.DEFAULT_MODEL, llm.SELECTION_MODEL, response
         )
 
-        code = await llm.generate_task_code(
+        return {**response, "metadata": latency_metadata(latencies)}, None
+    except Exception as e:
+        return None, str(e)
+
+
+async def stream_user_prompt(service, token, prompt):
+    """
+    Streaming version of process_user_prompt, yields (event, data) tuples: the
+    selected "endpoints" first, then the generated "code" chunk by chunk and the
+    "metadata" with the latency of each stage.
+    """
+    try:
+        cached = await get_cached_response(
+            service, prompt, token, llm.DEFAULT_MODEL, llm.SELECTION_MODEL
+        )
+        if cached is not None:
+            yield "endpoints", cached["endpoints"]
+            yield "code", cached["code"]
+            yield "metadata", {"cached": True}
+            return
+
+        start = time.perf_counter()
+        results, latencies = await run_pipeline(prompt_stages(service, prompt))
+        endpoints = results["endpoints"]
+        yield "endpoints", llm.public_endpoints(endpoints)
+
+        # the code is forwarded while it is generated, so the stage has no timeout
+        code_start = time.perf_counter()
+        chunks = []
+        async for code in llm.generate_task_code_stream(
             description=prompt,
-            auth_details=auth_info,
+            auth_details=results["auth"],
             endpoints=endpoints,
             token=token,
+            outputs=results.get("outputs", ""),
+        ):
+            chunks.append(code)
+            yield "code", code
+        latencies["code"] = time.perf_counter() - code_start
+        latencies["total"] = time.perf_counter() - start
+
+        response = {"code": "".join(chunks), "endpoints": llm.public_endpoints(endpoints)}
+        await cache_response(
+            service, prompt, token, llm.DEFAULT_MODEL, llm.SELECTION_MODEL, response
         )
+        yield "metadata", latency_metadata(latencies)
+    except Exception as e:
+        yield "error", {"error": str(e)}
 
-        response = {"code": code, "endpoints": endpoints}
 
-        return response, None
-    except Exception as e:
-        return None, {"error": e}
+def server_sent_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
 
 # def process_user_prompt(service, token, prompt):
@@ -76,7 +198,7 @@ def faq():
 
 
 @app.route("/gen-script", methods=["POST"])
-async def chat():
+def chat():
     data = request.get_json()
 
     if "service" not in data:
@@ -94,8 +216,10 @@ async def chat():
     service = data["service"]
     token = data["token"]
     prompt = data["prompt"]
-    response, error = await process_user_prompt(
-        prompt=prompt, service=service, token=token
+    # the pipeline runs on the process-wide event loop, blocking work is offloaded
+    # to a bounded thread pool so the loop can serve many requests concurrently
+    response, error = run_coroutine(
+        process_user_prompt(prompt=prompt, service=service, token=token)
     )
     # code, error = await generate_service_call(prompt, service, token)
     if error is not None:
@@ -106,48 +230,85 @@ async def chat():
     return jsonify(response)
 
 
-@app.route("/run_code", methods=["POST"])
-def run_code():
-    code = request.json.get("code")
+@app.route("/gen-script/stream", methods=["POST"])
+def chat_stream():
+    """
+    Same as /gen-script, but the response is a text/event-stream that forwards the
+    code as the model generates it.
+    """
+    data = request.get_json()
 
-    scripts_folder = "user-scripts"
-    # Check if the directory exists
-    if not os.path.exists(scripts_folder):
-        # If not, create the directory
-        os.makedirs(scripts_folder)
+    for field in ["service", "token", "prompt"]:
+        if field not in data or (field == "prompt" and len(data["prompt"]) == 0):
+            response = {"error": f"Bad parameters: missing or invalid {field}"}
+            return jsonify(response), 400
+
+    def events():
+        for event, event_data in iterate_async(
+            stream_user_prompt(
+                service=data["service"], token=data["token"], prompt=data["prompt"]
+            )
+        ):
+            yield server_sent_event(event, event_data)
+        yield server_sent_event("done", {})
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        # don't let proxies buffer the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-    # Generate a random file name
-    filename = f"{scripts_folder}/temp_script_{uuid.uuid4().hex}.py"
 
-    # Save the code to a file
-    with open(filename, "w") as file:
-        file.write(code)
+@app.route("/search", methods=["POST"])
+def search():
+    data = request.get_json()
 
-    try:
-        # Create a Docker client
-        client = docker.from_env()
-
-        # Run the script in a Docker container
-        result = client.containers.run(
-            "talk2apis-code-runner",  # Use the new Docker image
-            f"python {filename}",
-            remove=True,
-            volumes={os.environ["HOST_PROJECT_PATH"]: {"bind": "/app", "mode": "rw"}},
-        )
+    if "prompt" not in data or len(data["prompt"]) == 0:
+        response = {"error": "Bad parameters: missing or invalid prompt"}
+        return jsonify(response), 400
 
-        # Capture standard output
-        output = result.decode("utf-8")
-        error = None
+    top_k = data.get("top_k", 10)
+    # bool is an int too
+    if type(top_k) is not int or not 1 <= top_k <= MAX_SEARCH_TOP_K:
+        response = {
+            "error": f"Bad parameters: top_k must be an integer from 1 to {MAX_SEARCH_TOP_K}"
+        }
+        return jsonify(response), 400
 
-    except Exception as e:
-        output = None
-        error = str(e)
+    return jsonify({"endpoints": llm.search_endpoints(data["prompt"], top_k=top_k)})
+
+
+@app.route("/metrics")
+def metrics():
+    response_cache = get_response_cache()
+    return jsonify(
+        {
+            "query_embedding_cache": get_query_cache().stats(),
+            "llm_http": clients.stats(),
+            "llm_rate_limit": clients.limiter_stats(),
+            "llm_usage": usage.stats(),
+            "response_cache": response_cache.stats() if response_cache else None,
+            "runner_pool": runner_pool_stats(),
+        }
+    )
 
-    return jsonify({"output": output, "error": error})
+
+@app.route("/run_code", methods=["POST"])
+def run_code():
+    code = request.json.get("code")
+    try:
+        result = get_runner_pool().run(code)
+    except Exception as e:
+        # e.g. the Docker daemon can't be reached to start the runners
+        return jsonify({"output": None, "error": str(e)})
+    return jsonify({"output": result.output, "error": result.error})
 
 
 if __name__ == "__main__":
     debug = os.getenv("DEBUG")
     port = os.getenv("HTTP_PORT")
 
+    if not prewarm_runners:
+        threading.Thread(target=warm_runner_pool, daemon=True).start()
     app.run(debug=debug, port=port, use_reloader=False)
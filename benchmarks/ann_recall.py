@@ -0,0 +1,82 @@
+"""
+Recall@k and latency of the IVF index used for cross-service search, compared to
+the exact brute force ranking (top_k_similar, which rank_closest_embeddings uses).
+
+Runs on synthetic clustered embeddings, or on the embeddings of a database built
+by populate_db.py with --db.
+
+    python -m benchmarks.ann_recall --rows 20000
+    python -m benchmarks.ann_recall --db instance/apis.db
+"""
+import argparse
+import sqlite3
+import time
+
+import numpy as np
+
+from ai.ann import IVFIndex
+from ai.embeddings import normalize_rows, stack_embeddings, to_array, top_k_similar
+
+
+def synthetic_embeddings(rows, dim, topics, seed=0):
+    # endpoints of the same "topic" are close to each other, as in real specs
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((topics, dim))
+    labels = rng.integers(topics, size=rows)
+    return normalize_rows(centers[labels] + 0.8 * rng.standard_normal((rows, dim)))
+
+
+def database_embeddings(db_path):
+    connection = sqlite3.connect(db_path)
+    rows = connection.execute(
+        "SELECT embedding FROM api_endpoints WHERE embedding IS NOT NULL"
+    ).fetchall()
+    matrix, _ = stack_embeddings([to_array(blob) for blob, in rows])
+    return matrix
+
+
+def main(matrix, queries, top_k, nprobes):
+    ids = np.arange(len(matrix))
+    start = time.perf_counter()
+    index = IVFIndex.build(ids, matrix)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    exact = [set(top_k_similar(q, matrix, top_k)[0]) for q in queries]
+    exact_time = (time.perf_counter() - start) / len(queries)
+
+    print(
+        f"{len(matrix)} x {matrix.shape[1]} embeddings, {len(index.centroids)} clusters "
+        f"(built in {build_time:.2f}s), {len(queries)} queries, top_k={top_k}"
+    )
+    print(f"  exact      : recall 1.000, {exact_time * 1000:7.2f} ms/query")
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        found = [{id for id, _ in index.search(q, top_k, nprobe)} for q in queries]
+        ann_time = (time.perf_counter() - start) / len(queries)
+        recall = np.mean([len(f & e) / len(e) for f, e in zip(found, exact)])
+        print(f"  nprobe={nprobe:<4}: recall {recall:.3f}, {ann_time * 1000:7.2f} ms/query")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", help="sqlite database created by populate_db.py")
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--topics", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top_k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, nargs="*", default=[1, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    if args.db:
+        matrix = database_embeddings(args.db)
+    else:
+        matrix = synthetic_embeddings(args.rows, args.dim, args.topics)
+
+    # queries are perturbed endpoints, like a prompt close to some endpoint
+    rng = np.random.default_rng(1)
+    queries = matrix[rng.integers(len(matrix), size=args.queries)]
+    queries = normalize_rows(queries + 0.05 * rng.standard_normal(queries.shape))
+
+    main(matrix, queries, args.top_k, args.nprobe)
@@ -0,0 +1,70 @@
+"""
+Measures the embedding throughput of spec ingestion against a local fake
+embeddings server: one request per endpoint (previous behaviour) vs. the batched
+concurrent pipeline.
+
+    python -m benchmarks.embedding_throughput --definition_file openapi/definitions/slack.json
+"""
+import argparse
+import asyncio
+import time
+
+from openai import AsyncOpenAI
+
+from ai.embeddings import embed_texts_async, openai_embedder
+from benchmarks.fake_openai import base_url, start_server
+from openapi.service import Service
+
+
+async def embed_one_by_one(texts, embedder):
+    # Previous behaviour: a single text per request, strictly sequential
+    for text in texts:
+        await embedder([text.replace("\n", " ")], "text-embedding-3-small")
+
+
+def main(definition_file, latency, limit, concurrency):
+    service = Service("benchmark", definition_file)
+    texts = [e["definition"] for e in service.extract_endpoints()][:limit]
+
+    server = start_server(latency=latency)
+    embedder = openai_embedder(AsyncOpenAI(base_url=base_url(server), api_key="fake"))
+
+    print(f"{len(texts)} endpoints from {definition_file}, {latency * 1000:.0f} ms per request")
+
+    start = time.perf_counter()
+    asyncio.run(embed_one_by_one(texts, embedder))
+    sequential = time.perf_counter() - start
+    sequential_requests = server.RequestHandlerClass.requests
+    print(
+        f"  one request per endpoint : {sequential:7.2f} s, {sequential_requests} requests, "
+        f"{len(texts) / sequential:8.1f} endpoints/s"
+    )
+
+    embedder = openai_embedder(AsyncOpenAI(base_url=base_url(server), api_key="fake"))
+    start = time.perf_counter()
+    asyncio.run(
+        embed_texts_async(
+            texts, embedder=embedder, concurrency=concurrency, requests_per_minute=6000
+        )
+    )
+    batched = time.perf_counter() - start
+    print(
+        f"  batched + concurrent     : {batched:7.2f} s, "
+        f"{server.RequestHandlerClass.requests - sequential_requests} requests, "
+        f"{len(texts) / batched:8.1f} endpoints/s"
+    )
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--definition_file", default="openapi/definitions/slack.json"
+    )
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    main(args.definition_file, args.latency, args.limit, args.concurrency)
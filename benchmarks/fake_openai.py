@@ -0,0 +1,165 @@
+"""
+Minimal local stand-in for the OpenAI HTTP API (embeddings and chat completions),
+used to measure the app offline. Every request sleeps for a fixed latency before
+answering, completions also wait --token_latency seconds per generated token
+(word), streamed as they are "generated" when the request asks for a stream.
+
+    python -m benchmarks.fake_openai --port 8911 --latency 0.2 --token_latency 0.02
+    OPENAI_BASE_URL=http://127.0.0.1:8911/v1 OPENAI_API_KEY=fake ...
+"""
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+EMBEDDING_DIM = 1536
+# Lines of the fake generated code
+CODE_LINES = 40
+
+
+def fake_embedding(text: str, dim: int = EMBEDDING_DIM):
+    # deterministic per text, so that the same text always gets the same vector
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32).tolist()
+
+
+def fake_completion(messages):
+    # picks the first candidate endpoint when asked to, otherwise answers with code
+    prompt = messages[-1]["content"] if messages else ""
+    paths = re.findall(r"\[[A-Za-z]+\](/\S*?):", prompt)
+    if paths:
+        return f"endpoints:\n- {paths[0]}\n```"
+    return "".join(f'print("line {i}")\n' for i in range(CODE_LINES)) + "```"
+
+
+def completion_tokens(content):
+    return re.findall(r"\S+\s*|\s+", content)
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    # keep-alive, like the real API
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    token_latency = 0.0
+    requests = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.lock:
+            type(self).requests += 1
+        time.sleep(self.latency)
+
+        if self.path.endswith("/embeddings"):
+            inputs = body["input"]
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            response = {
+                "object": "list",
+                "model": body["model"],
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": fake_embedding(text)}
+                    for i, text in enumerate(inputs)
+                ],
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            }
+        elif self.path.endswith("/chat/completions") and body.get("stream"):
+            self.stream_completion(body)
+            return
+        elif self.path.endswith("/chat/completions"):
+            content = fake_completion(body["messages"])
+            time.sleep(self.token_latency * len(completion_tokens(content)))
+            response = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {
+                            "role": "assistant",
+                            "content": content,
+                        },
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }
+        else:
+            self.send_error(404)
+            return
+
+        payload = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def stream_completion(self, body):
+        # server-sent events with one chunk per token, in a chunked response
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send_event(data):
+            event = f"data: {data}\n\n".encode()
+            self.wfile.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+            self.wfile.flush()
+
+        for i, token in enumerate(completion_tokens(fake_completion(body["messages"]))):
+            if i > 0:
+                time.sleep(self.token_latency)
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+            }
+            send_event(json.dumps(chunk))
+        send_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def start_server(
+    port: int = 0, latency: float = 0.0, token_latency: float = 0.0
+) -> ThreadingHTTPServer:
+    """Starts the fake server in a background thread and returns it."""
+    handler = type(
+        "Handler",
+        (FakeOpenAIHandler,),
+        {"latency": latency, "token_latency": token_latency, "requests": 0},
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def base_url(server: ThreadingHTTPServer) -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8911)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--token_latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = start_server(args.port, args.latency, args.token_latency)
+    print(f"Fake OpenAI API listening on {base_url(server)}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
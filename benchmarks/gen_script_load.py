@@ -0,0 +1,119 @@
+"""
+Load test of /gen-script: sends requests from many concurrent clients and reports
+the throughput and latency percentiles. By default the app is served in-process
+by the threaded development server, with the embedding and LLM calls answered by
+the local fake OpenAI server after --latency seconds (plus --token_latency per
+generated token for completions).
+
+With --stream the requests go to /gen-script/stream, and the time to the first
+code chunk is reported next to the total latency.
+
+The database must contain the service, e.g. ingested with populate_db.py while
+pointing OPENAI_BASE_URL to the fake server. Run the same command on two
+revisions to compare them, or point --url to an app served some other way.
+
+    python -m benchmarks.gen_script_load --db instance/apis.db --concurrency 32
+    python -m benchmarks.gen_script_load --url http://127.0.0.1:5000 --concurrency 32
+    python -m benchmarks.gen_script_load --stream --token_latency 0.03 --concurrency 1
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+from benchmarks.fake_openai import base_url, start_server
+
+
+def serve_app(db_path, openai_url):
+    # the app reads its configuration at import time
+    os.environ["SQLALCHEMY_APIS_DATABASE_URI"] = f"sqlite:///{os.path.abspath(db_path)}"
+    os.environ["OPENAI_BASE_URL"] = openai_url
+    os.environ["OPENAI_API_BASE"] = openai_url  # litellm
+    os.environ["OPENAI_API_KEY"] = "fake"
+
+    from werkzeug.serving import make_server
+
+    from app import app
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def send(url, service, prompt, stream=False):
+    """Returns the latency, the time to the first code chunk and whether it succeeded."""
+    start = time.perf_counter()
+    response = requests.post(
+        f"{url}/gen-script/stream" if stream else f"{url}/gen-script",
+        json={"service": service, "token": "xoxb-fake", "prompt": prompt},
+        timeout=300,
+        stream=stream,
+    )
+    if not stream:
+        latency = time.perf_counter() - start
+        return latency, latency, response.status_code == 200
+
+    first_code, ok = None, response.status_code == 200
+    for line in response.iter_lines(decode_unicode=True):
+        if line == "event: code" and first_code is None:
+            first_code = time.perf_counter() - start
+        elif line == "event: error":
+            ok = False
+    latency = time.perf_counter() - start
+    return latency, first_code or latency, ok
+
+
+def main(url, service, prompts, total, concurrency, stream=False):
+    with ThreadPoolExecutor(concurrency) as pool:
+        # warm up the connection pools and the indexes of the service
+        list(pool.map(lambda p: send(url, service, p, stream), prompts[:concurrency]))
+
+        start = time.perf_counter()
+        results = list(
+            pool.map(
+                lambda i: send(url, service, prompts[i % len(prompts)], stream),
+                range(total),
+            )
+        )
+        elapsed = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, _, _ in results])
+    first_code = np.array([first for _, first, _ in results])
+    errors = sum(not ok for _, _, ok in results)
+    print(
+        f"{total} requests, {concurrency} concurrent clients: {total / elapsed:.1f} req/s, "
+        f"latency p50 {np.percentile(latencies, 50) * 1000:.0f} ms, "
+        f"p95 {np.percentile(latencies, 95) * 1000:.0f} ms, "
+        f"first code p50 {np.percentile(first_code, 50) * 1000:.0f} ms, {errors} errors"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="base url of a running app")
+    parser.add_argument("--db", default="instance/apis.db")
+    parser.add_argument("--service", default="slack")
+    parser.add_argument("--fixture", default="benchmarks/fixtures/slack_retrieval.json")
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--token_latency", type=float, default=0.0)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, nargs="*", default=[1, 8, 32, 64])
+    args = parser.parse_args()
+
+    with open(args.fixture) as f:
+        prompts = [case["prompt"] for case in json.load(f)]
+
+    url = args.url
+    if url is None:
+        fake_server = start_server(latency=args.latency, token_latency=args.token_latency)
+        _, url = serve_app(args.db, base_url(fake_server))
+        print(f"Fake OpenAI API answering after {args.latency * 1000:.0f} ms")
+
+    for concurrency in args.concurrency:
+        main(url, args.service, prompts, args.requests, concurrency, args.stream)
@@ -0,0 +1,125 @@
+"""
+Tokens of the endpoint definitions in the code generation prompt, with the full
+definitions clipped to the budget (as with PACK_ENDPOINT_DEFINITIONS=0) and with
+the compacted definitions packed by ai.context_packer.
+
+The endpoints of each prompt are the first --endpoints of its BM25 ranking when a
+fixture of prompts is given, random groups of endpoints of the spec otherwise.
+For both methods it reports the mean tokens, the share of prompts whose most
+relevant endpoint is included without being clipped, the mean number of such
+endpoints and the time to build the text. A packed endpoint only counts as
+included with (part of) its response schema, response depth 1 or more; the
+"depths" column gives the mean number of packed endpoints at each response depth.
+
+    python -m benchmarks.prompt_context
+    python -m benchmarks.prompt_context --definition_file openapi/definitions/jira.json --fixture ""
+"""
+import argparse
+import json
+import random
+import time
+
+import numpy as np
+
+from ai.context_packer import RESPONSE_DEPTHS, pack_endpoints
+from ai.embeddings import count_tokens
+from ai.lexical import LexicalIndex
+from ai.llm import DEFAULT_MODEL, ENDPOINTS_CONTEXT_RATIO, render_endpoints_definition
+from ai.models import get_model
+from database.services import TOKENS_FIELD
+from openapi.service import Service
+
+
+def endpoint_dict(endpoint):
+    # what APIEndpoint.to_dict(with_tokens=True) returns for the stored record
+    definition = json.loads(endpoint["definition"])
+    definition["path"] = endpoint["path"]
+    definition["method"] = endpoint["method"]
+    definition[TOKENS_FIELD] = endpoint["definition_tokens"]
+    return definition
+
+
+def endpoint_groups(records, fixture, size, samples):
+    if fixture:
+        with open(fixture) as f:
+            prompts = [case["prompt"] for case in json.load(f)]
+        index = LexicalIndex.from_rows(
+            [
+                (i, e["path"], e["summary"], e["description"], e["definition"])
+                for i, e in enumerate(records)
+            ]
+        )
+        groups = [[i for i, _ in index.search(prompt, top_k=size)] for prompt in prompts]
+        return [group for group in groups if group]
+
+    rng = random.Random(0)
+    return [rng.sample(range(len(records)), size) for _ in range(samples)]
+
+
+def full_endpoints(text, endpoints):
+    # whether each definition is in the text without being clipped
+    return [
+        json.dumps({k: v for k, v in e.items() if k != TOKENS_FIELD}) in text
+        for e in endpoints
+    ]
+
+
+def main(definition_file, fixture, sizes, samples):
+    records = Service("benchmark", definition_file).extract_endpoints()
+    endpoints = [endpoint_dict(e) for e in records]
+    budget = int(get_model(DEFAULT_MODEL).context_tokens * ENDPOINTS_CONTEXT_RATIO)
+    print(
+        f"{len(endpoints)} endpoints of {definition_file}, "
+        f"budget {budget} tokens of {DEFAULT_MODEL}"
+    )
+    depth_names = "/".join(str(depth) for depth in RESPONSE_DEPTHS)
+    print(
+        f"  {'endpoints':>9} {'method':>8} {'tokens':>8} {'top complete':>13} "
+        f"{'included':>9} {'ms':>7}  depths {depth_names}"
+    )
+
+    for size in sizes:
+        groups = endpoint_groups(records, fixture, size, samples)
+        for method in ("full", "packed"):
+            tokens, top_complete, complete, elapsed = [], [], [], 0.0
+            at_depth = {depth: 0 for depth in RESPONSE_DEPTHS}
+            for group in groups:
+                selected = [endpoints[i] for i in group]
+                start = time.perf_counter()
+                if method == "full":
+                    text = render_endpoints_definition(selected, ENDPOINTS_CONTEXT_RATIO)
+                    elapsed += time.perf_counter() - start
+                    included = full_endpoints(text, selected)
+                else:
+                    text, depths = pack_endpoints(selected, budget, DEFAULT_MODEL)
+                    elapsed += time.perf_counter() - start
+                    included = [depth is not None and depth > 0 for depth in depths]
+                    for depth in depths:
+                        if depth is not None:
+                            at_depth[depth] += 1
+
+                tokens.append(count_tokens(text, DEFAULT_MODEL))
+                top_complete.append(bool(included) and included[0])
+                complete.append(sum(included))
+
+            print(
+                f"  {size:>9} {method:>8} {np.mean(tokens):>8.0f} "
+                f"{np.mean(top_complete):>13.0%} {np.mean(complete):>9.2f} "
+                f"{elapsed / len(groups) * 1000:>7.2f}"
+                + (
+                    "  " + "/".join(f"{at_depth[d] / len(groups):.2f}" for d in RESPONSE_DEPTHS)
+                    if method == "packed"
+                    else ""
+                )
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--definition_file", default="openapi/definitions/slack.json")
+    parser.add_argument("--fixture", default="benchmarks/fixtures/slack_retrieval.json")
+    parser.add_argument("--endpoints", type=int, nargs="*", default=[1, 3, 5])
+    parser.add_argument("--samples", type=int, default=50)
+    args = parser.parse_args()
+
+    main(args.definition_file, args.fixture, args.endpoints, args.samples)
@@ -0,0 +1,73 @@
+"""
+Compares the vectorized top-k ranking with the previous pairwise implementation
+of rank_closest_embeddings on a synthetic embedding matrix.
+
+    python -m benchmarks.rank_embeddings --rows 10000 --dim 1536 --top_k 40
+"""
+import argparse
+import time
+
+import numpy as np
+
+from ai.embeddings import cosine_similarity, stack_embeddings, top_k_similar
+
+
+def pairwise_rank(target_embedding, embeddings, top_k=100):
+    # Previous implementation: one cosine similarity per pair and a full sort
+    match_scores = []
+    for endpoint, embedding in embeddings:
+        similarity = cosine_similarity(target_embedding, embedding)
+        match_scores.append((endpoint, similarity))
+    sorted_matches = sorted(match_scores, key=lambda x: x[1], reverse=True)
+    return sorted_matches if top_k is None else sorted_matches[:top_k]
+
+
+def timeit(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(rows, dim, top_k, batch, repeat):
+    rng = np.random.default_rng(0)
+    embeddings = [(i, v) for i, v in enumerate(rng.standard_normal((rows, dim)))]
+    query = rng.standard_normal(dim)
+    queries = rng.standard_normal((batch, dim))
+
+    pairwise_time, expected = timeit(
+        lambda: pairwise_rank(query, embeddings, top_k), repeat
+    )
+
+    stack_time, (matrix, _) = timeit(
+        lambda: stack_embeddings([e for _, e in embeddings]), repeat
+    )
+    single_time, (indices, _) = timeit(
+        lambda: top_k_similar(query, matrix, top_k), repeat
+    )
+    batch_time, _ = timeit(lambda: top_k_similar(queries, matrix, top_k), repeat)
+
+    assert list(indices) == [i for i, _ in expected], "rankings differ"
+
+    print(f"{rows} x {dim} embeddings, top_k={top_k}")
+    print(f"  pairwise rank_closest_embeddings : {pairwise_time * 1000:9.2f} ms/query")
+    print(f"  stack + normalize (once)         : {stack_time * 1000:9.2f} ms")
+    print(f"  top_k_similar, single query      : {single_time * 1000:9.2f} ms/query")
+    print(
+        f"  top_k_similar, batch of {batch:<4}     : {batch_time / batch * 1000:9.2f} ms/query"
+    )
+    print(f"  speedup (single query)           : {pairwise_time / single_time:9.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--top_k", type=int, default=40)
+    parser.add_argument("--batch", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    main(args.rows, args.dim, args.top_k, args.batch, args.repeat)
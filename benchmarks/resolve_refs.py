@@ -0,0 +1,113 @@
+"""
+Compares the previous recursive resolve_refs with the memoized RefResolver on the
+bundled definitions, resolving the parameters and responses of every endpoint as
+Service.extract_endpoints does.
+
+    python -m benchmarks.resolve_refs
+"""
+import argparse
+import json
+import time
+
+from openapi.service import RefResolver, Service
+
+
+def legacy_resolve_refs(path, definition, schema, parent_refs=None, only_schema_paths=False):
+    # Previous implementation: no caching, new path list and parent_refs set per level
+    if parent_refs is None:
+        parent_refs = set()
+
+    if isinstance(definition, dict):
+        if "$ref" in definition and (not only_schema_paths or "schema" in path):
+            ref_path = definition["$ref"]
+            if ref_path in parent_refs:
+                return ref_path
+            ref_definition = schema
+            for part in ref_path.split("/")[1:]:
+                ref_definition = ref_definition[part]
+            return legacy_resolve_refs(
+                path + [ref_path],
+                ref_definition,
+                schema,
+                parent_refs | {ref_path},
+                only_schema_paths,
+            )
+        else:
+            return {
+                key: legacy_resolve_refs(
+                    path + [key], value, schema, parent_refs, only_schema_paths
+                )
+                for key, value in definition.items()
+            }
+    elif isinstance(definition, list):
+        return [
+            legacy_resolve_refs(
+                path + [str(index)], item, schema, parent_refs, only_schema_paths
+            )
+            for index, item in enumerate(definition)
+        ]
+    else:
+        return definition
+
+
+def resolve_all(definition, resolve):
+    # returns the serialized definitions, the spec itself is not modified
+    results = []
+    for path, endpoint_dict in definition["paths"].items():
+        for method, method_dict in endpoint_dict.items():
+            if not isinstance(method_dict, dict):
+                continue
+            resolved = {}
+            if "parameters" in method_dict:
+                resolved["parameters"] = resolve(path.split("/"), method_dict["parameters"], False)
+            if "responses" in method_dict:
+                resolved["responses"] = resolve(path.split("/"), method_dict["responses"], True)
+            results.append(json.dumps(resolved))
+    return results
+
+
+def main(files):
+    for file in files:
+        service = Service("benchmark", file)
+        service.load_service_data()
+        definition = service.definition
+
+        start = time.perf_counter()
+        expected = resolve_all(
+            definition,
+            lambda path, d, only_schema: legacy_resolve_refs(
+                path, d, definition, only_schema_paths=only_schema
+            ),
+        )
+        legacy_time = time.perf_counter() - start
+
+        timings = {}
+        for share in (False, True):
+            resolver = RefResolver(definition, share=share)
+            start = time.perf_counter()
+            results = resolve_all(
+                definition,
+                lambda path, d, only_schema: resolver.resolve(
+                    path, d, only_schema_paths=only_schema
+                ),
+            )
+            timings[share] = time.perf_counter() - start
+            assert results == expected, f"{file}: resolved definitions differ"
+
+        print(f"{file} ({len(expected)} endpoints, {resolver.hits} cache hits)")
+        print(f"  resolve_refs (previous)     : {legacy_time:8.3f} s")
+        print(f"  RefResolver, copied results : {timings[False]:8.3f} s")
+        print(f"  RefResolver, shared results : {timings[True]:8.3f} s")
+        print(f"  speedup (shared)            : {legacy_time / timings[True]:8.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--definition_files",
+        nargs="*",
+        default=["openapi/definitions/jira.json", "openapi/definitions/slack.json"],
+    )
+    args = parser.parse_args()
+
+    main(args.definition_files)
@@ -0,0 +1,97 @@
+"""
+Offline recall@k of the endpoint retrieval used by get_task_endpoints: embeddings
+only, BM25 only and both fused, over a fixture of prompt -> expected endpoint
+paths.
+
+Endpoints are extracted from the definition file. Embeddings are read from the
+ingestion embedding cache (instance/embedding_cache.db), the missing ones are
+computed with the OpenAI API and cached, so only the first run needs the API.
+--lexical_only doesn't need it at all.
+
+    python -m benchmarks.retrieval_recall
+    python -m benchmarks.retrieval_recall --lexical_only
+"""
+import argparse
+import json
+
+import numpy as np
+from dotenv import load_dotenv
+
+from ai.embedding_cache import EmbeddingCache
+from ai.embeddings import DEFAULT_EMBEDDING_MODEL, embed_texts, stack_embeddings, top_k_similar
+from ai.lexical import LexicalIndex, reciprocal_rank_fusion
+from openapi.service import Service
+
+DEPTH = 100
+
+
+def cached_embeddings(texts, cache):
+    embeddings = cache.get_many(texts, DEFAULT_EMBEDDING_MODEL)
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        print(f"Embedding {len(missing)} texts missing from the cache")
+        computed = embed_texts([texts[i] for i in missing])
+        cache.put_many([texts[i] for i in missing], computed, DEFAULT_EMBEDDING_MODEL)
+        for i, embedding in zip(missing, computed):
+            embeddings[i] = embedding
+    return [() if embedding is None else embedding for embedding in embeddings]
+
+
+def recall_at(rankings, expected, ks):
+    # share of prompts with an expected endpoint in the first k results
+    return {
+        k: np.mean([bool(set(r[:k]) & e) for r, e in zip(rankings, expected)]) for k in ks
+    }
+
+
+def main(definition_file, fixture, ks, lexical_only, lexical_weight):
+    endpoints = list(Service("benchmark", definition_file).extract_endpoints())
+    paths = [e["path"] for e in endpoints]
+    with open(fixture) as f:
+        cases = json.load(f)
+    prompts = [case["prompt"] for case in cases]
+    expected = [set(case["expected"]) for case in cases]
+
+    lexical_index = LexicalIndex.from_rows(
+        [
+            (i, e["path"], e["summary"], e["description"], e["definition"])
+            for i, e in enumerate(endpoints)
+        ]
+    )
+    lexical = [lexical_index.search(prompt, top_k=DEPTH) for prompt in prompts]
+    results = {"bm25": lexical}
+
+    if not lexical_only:
+        cache = EmbeddingCache()
+        matrix, positions = stack_embeddings(
+            cached_embeddings([e["definition"] for e in endpoints], cache)
+        )
+        vector = []
+        for query in cached_embeddings(prompts, cache):
+            indices, scores = top_k_similar(query, matrix, DEPTH)
+            vector.append([(int(positions[i]), float(s)) for i, s in zip(indices, scores)])
+        results["embeddings"] = vector
+        results["hybrid"] = [
+            reciprocal_rank_fusion([v, l], [1.0, lexical_weight])
+            for v, l in zip(vector, lexical)
+        ]
+
+    print(f"{len(cases)} prompts over {len(endpoints)} endpoints of {definition_file}")
+    print(f"  {'':<12}" + "".join(f"{f'recall@{k}':>11}" for k in ks))
+    for name, rankings in results.items():
+        ranked_paths = [[paths[id] for id, _ in ranking] for ranking in rankings]
+        recall = recall_at(ranked_paths, expected, ks)
+        print(f"  {name:<12}" + "".join(f"{recall[k]:>11.3f}" for k in ks))
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--definition_file", default="openapi/definitions/slack.json")
+    parser.add_argument("--fixture", default="benchmarks/fixtures/slack_retrieval.json")
+    parser.add_argument("--k", type=int, nargs="*", default=[1, 5, 10, 15, 20, 40])
+    parser.add_argument("--lexical_only", action="store_true")
+    parser.add_argument("--lexical_weight", type=float, default=1.0)
+    args = parser.parse_args()
+
+    main(args.definition_file, args.fixture, args.k, args.lexical_only, args.lexical_weight)
@@ -0,0 +1,107 @@
+"""
+Latency of /run_code with cold runners (RUNNER_POOL_SIZE=0, one runner started
+per script) and with a warm pool of runners started ahead of the scripts.
+
+With --backend docker the scripts run in containers of the code-runner image, which
+must be built (docker-compose build code-runner), with --backend subprocess in local
+processes under resource limits. With --backend stub nothing is executed: the
+runners take --start_latency seconds to start and --exec_latency seconds to run a
+script, to measure the pool itself on a box without Docker.
+
+The scripts are sent --interval seconds apart, the time a user takes between runs,
+during which the pool replaces the used runners.
+
+    python -m benchmarks.run_code_latency --backend stub
+    python -m benchmarks.run_code_latency --backend subprocess
+    python -m benchmarks.run_code_latency --backend docker --runs 20 --size 2
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from runner.backend import RunnerBackend, RunResult
+from runner.pool import RunnerPool, make_backend, set_runner_pool
+
+SCRIPT = 'print("Hello from the runner")\n'
+
+
+class StubBackend(RunnerBackend):
+    """Runners that only take time to start, run a script and stop."""
+
+    def __init__(self, start_latency: float, exec_latency: float, stop_latency: float):
+        self.start_latency = start_latency
+        self.exec_latency = exec_latency
+        self.stop_latency = stop_latency
+        self.started = 0
+
+    def start(self):
+        time.sleep(self.start_latency)
+        self.started += 1
+        return self.started
+
+    def execute(self, handle, code, timeout):
+        time.sleep(self.exec_latency)
+        return RunResult("Hello from the runner\n", None, 0)
+
+    def stop(self, handle):
+        time.sleep(self.stop_latency)
+
+
+def benchmark_backend(args):
+    if args.backend == "stub":
+        return StubBackend(args.start_latency, args.exec_latency, args.stop_latency)
+    return make_backend(args.backend)
+
+
+def wait_ready(pool, timeout=60):
+    # the pool starts its runners in the background
+    deadline = time.monotonic() + timeout
+    while pool.stats()["idle"] < pool.size and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def main(client, args):
+    print(f"  {'mode':>5} {'p50 ms':>8} {'p95 ms':>8} {'mean ms':>8} {'warm':>5} {'errors':>6}")
+    for mode, size in (("cold", 0), ("warm", args.size)):
+        pool = RunnerPool(benchmark_backend(args), size=size, max_runs=args.max_runs)
+        set_runner_pool(pool)
+        wait_ready(pool)
+
+        latencies, errors = [], 0
+        for i in range(args.runs):
+            if i:
+                time.sleep(args.interval)
+            start = time.perf_counter()
+            response = client.post("/run_code", json={"code": SCRIPT})
+            latencies.append(time.perf_counter() - start)
+            errors += response.status_code != 200 or response.json["error"] is not None
+
+        stats = pool.stats()
+        latencies = np.array(latencies) * 1000
+        print(
+            f"  {mode:>5} {np.percentile(latencies, 50):>8.0f} "
+            f"{np.percentile(latencies, 95):>8.0f} {latencies.mean():>8.0f} "
+            f"{stats['warm_runs']:>5} {errors:>6}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=["docker", "subprocess", "stub"], default="stub")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--interval", type=float, default=1.5)
+    parser.add_argument("--size", type=int, default=2)
+    parser.add_argument("--max_runs", type=int, default=1)
+    parser.add_argument("--start_latency", type=float, default=1.0)
+    parser.add_argument("--exec_latency", type=float, default=0.03)
+    parser.add_argument("--stop_latency", type=float, default=0.3)
+    args = parser.parse_args()
+
+    # /run_code doesn't use the database, and the pool is replaced below
+    os.environ["SQLALCHEMY_APIS_DATABASE_URI"] = "sqlite://"
+    os.environ["RUNNER_POOL_SIZE"] = "0"
+    from app import app
+
+    main(app.test_client(), args)
@@ -0,0 +1,62 @@
+"""
+Reports the load time of each bundled definition with every loader: the
+pure-Python yaml loader, libyaml's C loader, json and the pickled snapshot cache.
+
+    python -m benchmarks.spec_loading
+"""
+import argparse
+import glob
+import json
+import os
+import pickle
+import time
+
+import yaml
+
+from openapi.service import YamlLoader
+
+
+def timeit(func, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def read(file_path, load):
+    with open(file_path, "rb") as f:
+        return load(f)
+
+
+def main(files):
+    for file in files:
+        size = os.path.getsize(file) / 1024
+        print(f"{file} ({size:.0f} KB)")
+
+        if file.endswith(".json"):
+            parse_time, definition = timeit(lambda: read(file, json.load))
+            print(f"  json.load             : {parse_time * 1000:9.1f} ms")
+        else:
+            pure_time, definition = timeit(lambda: read(file, yaml.safe_load), repeat=1)
+            print(f"  yaml.safe_load        : {pure_time * 1000:9.1f} ms")
+            if YamlLoader is not yaml.SafeLoader:
+                c_time, _ = timeit(lambda: read(file, lambda f: yaml.load(f, Loader=YamlLoader)))
+                print(f"  yaml {YamlLoader.__name__:<16} : {c_time * 1000:9.1f} ms")
+
+        snapshot = pickle.dumps(definition, protocol=pickle.HIGHEST_PROTOCOL)
+        snapshot_time, _ = timeit(lambda: pickle.loads(snapshot))
+        print(f"  pickled snapshot      : {snapshot_time * 1000:9.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--definition_files", nargs="*", default=[])
+    args = parser.parse_args()
+
+    files = args.definition_files
+    if len(files) == 0:
+        for extension in ["json", "yaml", "yml"]:
+            files.extend(sorted(glob.glob(f"openapi/definitions/*.{extension}")))
+    main(files)
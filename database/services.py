@@ -1,16 +1,28 @@
 from database import db
+from ai.embeddings import to_array
+from sqlalchemy import func
 from sqlalchemy.dialects.sqlite import JSON, BLOB
 import numpy as np
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 import json
 from sqlalchemy.orm.exc import NoResultFound
 
+# Callbacks invoked with the service name whenever DeleteService removes a
+# service, used to drop any in-memory state derived from its rows.
+service_deleted_listeners: List[Callable[[str], None]] = []
+
+# Key of the definition token count in APIEndpoint.to_dict(with_tokens=True)
+TOKENS_FIELD = "x-talk2apis-tokens"
+
 
 class Services(db.Model):
     __tablename__ = "services"
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), unique=True, nullable=False)
     description = db.Column(db.String(), nullable=False)
+    # time of the ingestion in nanoseconds, set by populate_db.py. Unlike the ids,
+    # which SQLite reuses once a service is deleted, it changes on every ingestion.
+    version = db.Column(db.BigInteger, nullable=True)
 
 
 class ServiceCategories(db.Model):
@@ -40,8 +52,12 @@ class APIEndpoint(db.Model):
     parameters = db.Column(JSON, nullable=True)
     definition = db.Column(JSON, nullable=True)
     embedding = db.Column(BLOB)
+    # token counts computed at ingestion, see ai.embeddings.TOKEN_COUNT_MODEL
+    summary_tokens = db.Column(db.Integer, nullable=True)
+    description_tokens = db.Column(db.Integer, nullable=True)
+    definition_tokens = db.Column(db.Integer, nullable=True)
 
-    def to_dict(self):
+    def to_dict(self, with_tokens: bool = False):
         # Convert the definition JSON to a dictionary
         definition_dict = json.loads(self.definition) if self.definition else {}
 
@@ -49,6 +65,10 @@ class APIEndpoint(db.Model):
         definition_dict["path"] = self.path
         definition_dict["method"] = self.method
 
+        # an OpenAPI extension field, so prompts are budgeted without tokenizing
+        if with_tokens and self.definition_tokens is not None:
+            definition_dict[TOKENS_FIELD] = self.definition_tokens
+
         return definition_dict
 
     @classmethod
@@ -69,13 +89,65 @@ class APIEndpoint(db.Model):
         # Extract embeddings
         db_endpoints = cls.query.filter_by(service_id=service.id).all()
         embeddings = [
-            (endpoint, np.frombuffer(endpoint.embedding))
+            (endpoint, to_array(endpoint.embedding))
             for endpoint in db_endpoints
             if endpoint.embedding
         ]
 
         return embeddings
 
+    @classmethod
+    def get_embeddings_fingerprint(
+        cls, service_name: str, session=None
+    ) -> Tuple[int, Optional[int]]:
+        """
+        Returns (service id, version) for the service, a cheap way to detect that
+        its endpoints were re-ingested by another process.
+        """
+        session = session or db.session
+        return tuple(
+            session.query(Services.id, Services.version)
+            .filter(Services.name == service_name)
+            .one()
+        )
+
+    @classmethod
+    def get_all_embeddings_fingerprint(cls, session=None) -> Tuple[int, Optional[int]]:
+        # (service count, latest version): any ingestion raises the version, any
+        # deletion lowers the count
+        session = session or db.session
+        return tuple(session.query(func.count(Services.id), func.max(Services.version)).one())
+
+    @classmethod
+    def get_embedding_rows(
+        cls, service_id: Optional[int], session=None
+    ) -> List[Tuple[int, bytes]]:
+        # Plain column query, no ORM objects are built for the endpoints. All the
+        # services when service_id is None.
+        session = session or db.session
+        query = session.query(cls.id, cls.embedding)
+        if service_id is not None:
+            query = query.filter(cls.service_id == service_id)
+        return query.all()
+
+    @classmethod
+    def get_text_rows(
+        cls, service_id: int, session=None
+    ) -> List[Tuple[int, str, str, str, str]]:
+        # (id, path, summary, description, definition) rows the lexical index is built on
+        session = session or db.session
+        return (
+            session.query(cls.id, cls.path, cls.summary, cls.description, cls.definition)
+            .filter(cls.service_id == service_id)
+            .all()
+        )
+
+    @classmethod
+    def get_by_ids(cls, ids: List[int]) -> List["APIEndpoint"]:
+        # Keep the order of the given ids (e.g. ranking order)
+        endpoints = {e.id: e for e in cls.query.filter(cls.id.in_(ids)).all()}
+        return [endpoints[id] for id in ids if id in endpoints]
+
 
 class APIParameters(db.Model):
     __tablename__ = "api_parameters"  # Explicitly define the table name
@@ -90,34 +162,40 @@ class APIParameters(db.Model):
     required = db.Column(db.Boolean, nullable=False)
 
 
+def delete_service_rows(session, service):
+    """Deletes a service and all its related rows, without committing."""
+    # Delete related rows in APIParameter
+    session.query(APIParameters).filter(APIParameters.service_id == service.id).delete()
+
+    # Delete related rows in APIEndpoint
+    session.query(APIEndpoint).filter(APIEndpoint.service_id == service.id).delete()
+
+    # Delete related rows in ServiceAPI
+    session.query(ServiceAPIs).filter(ServiceAPIs.service_id == service.id).delete()
+
+    # Delete related rows in ServiceCategory
+    session.query(ServiceCategories).filter(
+        ServiceCategories.service_id == service.id
+    ).delete()
+
+    # Finally, delete the service itself
+    session.delete(service)
+
+
 def DeleteService(session, service_name):
     # Query for the service
     service = session.query(Services).filter(Services.name == service_name).first()
 
     # If the service exists, delete all related rows
     if service is not None:
-        # Delete related rows in APIParameter
-        session.query(APIParameters).filter(
-            APIParameters.service_id == service.id
-        ).delete()
-
-        # Delete related rows in APIEndpoint
-        session.query(APIEndpoint).filter(APIEndpoint.service_id == service.id).delete()
-
-        # Delete related rows in ServiceAPI
-        session.query(ServiceAPIs).filter(ServiceAPIs.service_id == service.id).delete()
-
-        # Delete related rows in ServiceCategory
-        session.query(ServiceCategories).filter(
-            ServiceCategories.service_id == service.id
-        ).delete()
-
-        # Finally, delete the service itself
-        session.delete(service)
+        delete_service_rows(session, service)
 
         # Commit the transaction
         session.commit()
 
+        for listener in service_deleted_listeners:
+            listener(service_name)
+
         print(f"Service {service_name} and all related rows deleted.")
     else:
         print(f"Service {service_name} not found.")
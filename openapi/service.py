@@ -1,10 +1,57 @@
+import hashlib
 import json
-from ai.embeddings import get_embedding, to_binary
+from ai.embeddings import (
+    DEFAULT_EMBEDDING_MODEL,
+    count_endpoint_tokens,
+    embed_texts,
+    to_binary,
+)
 from tqdm import tqdm
 import numpy as np
+import pickle
+import time
 import yaml
 import os
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# libyaml's C loader is an order of magnitude faster than the pure-Python one
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Parsed specs and extracted endpoints are cached here, keyed on the spec file
+# path, modification time and size. Set SPEC_CACHE_DIR to an empty string to
+# disable the cache.
+SPEC_CACHE_DIR = os.getenv("SPEC_CACHE_DIR", "instance/spec_cache")
+# Bump when the parsing or the endpoint extraction changes to drop old snapshots
+SPEC_CACHE_VERSION = 2
+
+# Number of endpoints embedded at once when streaming the endpoints of a spec
+EMBED_CHUNK_SIZE = 256
+
+
+def load_json_without_paths(f):
+    """
+    Incrementally parses a JSON spec building every top-level key but "paths",
+    whose content is skipped without being materialized.
+    """
+    definition = {}
+    key, builder = None, None
+    for prefix, event, value in ijson.parse(f, use_float=True):
+        if prefix == "":
+            if builder is not None:
+                definition[key] = builder.value
+                builder = None
+            if event == "map_key":
+                key = value
+                if key != "paths":
+                    builder = ijson.ObjectBuilder()
+        elif builder is not None:
+            builder.event(event, value)
+    return definition
+
 
 def resolve_refs(
     path,
@@ -26,67 +73,211 @@ def resolve_refs(
 
     The resolve_refs function should (BUT IS NOT) treat $ref keys differently based on their context
     (schema or examples) to handle these scenarios.
+
+    This is a one-off resolution, use a RefResolver to resolve many definitions of
+    the same spec and reuse the already resolved references.
+    """
+    return RefResolver(schema).resolve(path, definition, parent_refs, only_schema_paths)
+
+
+def _copy_json(value):
+    # deepcopy for parsed JSON/YAML documents, without deepcopy's memo bookkeeping
+    if isinstance(value, dict):
+        return {key: _copy_json(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy_json(item) for item in value]
+    return value
+
+
+class RefResolver:
     """
-    if parent_refs is None:
-        parent_refs = set()
-
-    if isinstance(definition, dict):
-        # we should be resolving only references in schema, but currently we are doing
-        # only in parameters (which don't include exmaples) so we can skip checking for
-        # the schema keyword
-        if "$ref" in definition and (not only_schema_paths or "schema" in path):
-            ref_path = definition["$ref"]
-            if ref_path in parent_refs:
-                print(f"Circular reference detected: {ref_path}")
-                return ref_path
-            ref_path_parts = ref_path.split("/")[
-                1:
-            ]  # Split and ignore the first '#' element
-            ref_definition = schema
-            for part in ref_path_parts:
-                ref_definition = ref_definition[part]
-            resolved_definition = resolve_refs(
-                path + [ref_path],
-                ref_definition,
-                schema,
-                parent_refs | {ref_path},
-                only_schema_paths,
-            )  # Recursively resolve nested references
-            return resolved_definition
+    Resolves the $ref of the definitions of a single spec, see `resolve_refs`.
+
+    Resolved references are cached and reused across calls. A circular reference is
+    replaced by the $ref string as in `resolve_refs`, which makes the resolution of
+    a ref depend on the refs being resolved around it: a cached resolution is only
+    reused when none of the refs it went through is being resolved, and a ref that
+    cut a cycle through one of its ancestors is not cached.
+
+    With share=True, cached subtrees are shared between the results instead of
+    being copied, and must not be modified.
+    """
+
+    def __init__(self, schema, share=False):
+        self.schema = schema
+        self.share = share
+        self.hits = 0
+        self.misses = 0
+        # (ref, only_schema_paths) -> (resolved definition, refs it went through)
+        self._cache = {}
+        self._only_schema_paths = False
+        # number of "schema" keys in the current path
+        self._schema_depth = 0
+        # refs being resolved, the parent_refs of resolve_refs
+        self._active = set()
+        # for each ref being resolved, the circular refs cut inside it and all the
+        # refs it went through
+        self._frames = [(set(), set())]
+
+    def resolve(self, path, definition, parent_refs=None, only_schema_paths=False):
+        self._only_schema_paths = only_schema_paths
+        self._schema_depth = sum(1 for part in path if part == "schema")
+        self._active = set(parent_refs or ())
+        self._frames = [(set(), set())]
+        return self._resolve(definition)
+
+    def _resolve(self, definition):
+        if isinstance(definition, dict):
+            # we should be resolving only references in schema, but currently we are doing
+            # only in parameters (which don't include exmaples) so we can skip checking for
+            # the schema keyword
+            if "$ref" in definition and (
+                not self._only_schema_paths or self._schema_depth > 0
+            ):
+                return self._resolve_ref(definition["$ref"])
+
+            resolved = {}
+            for key, value in definition.items():
+                if isinstance(value, (dict, list)):
+                    if key == "schema":
+                        self._schema_depth += 1
+                        resolved[key] = self._resolve(value)
+                        self._schema_depth -= 1
+                    else:
+                        resolved[key] = self._resolve(value)
+                else:
+                    resolved[key] = value
+            return resolved
+        elif isinstance(definition, list):
+            return [
+                self._resolve(item) if isinstance(item, (dict, list)) else item
+                for item in definition
+            ]
         else:
-            return {
-                key: resolve_refs(
-                    path + [key], value, schema, parent_refs, only_schema_paths
-                )
-                for key, value in definition.items()
-            }
-    elif isinstance(definition, list):
-        return [
-            resolve_refs(
-                path + [str(index)], item, schema, parent_refs, only_schema_paths
-            )
-            for index, item in enumerate(definition)
-        ]
-    else:
-        return definition
+            return definition
+
+    def _resolve_ref(self, ref_path):
+        cuts, reach = self._frames[-1]
+        reach.add(ref_path)
+
+        if ref_path in self._active:
+            print(f"Circular reference detected: {ref_path}")
+            cuts.add(ref_path)
+            return ref_path
+
+        key = (ref_path, self._only_schema_paths)
+        cached = self._cache.get(key)
+        if cached is not None and cached[1].isdisjoint(self._active):
+            self.hits += 1
+            resolved, ref_reach = cached
+            reach |= ref_reach
+            return resolved if self.share else _copy_json(resolved)
+        self.misses += 1
+
+        ref_definition = self.schema
+        for part in ref_path.split("/")[1:]:  # Split and ignore the first '#' element
+            ref_definition = ref_definition[part]
+
+        self._active.add(ref_path)
+        self._frames.append((set(), set()))
+        try:
+            resolved = self._resolve(ref_definition)  # Recursively resolve nested references
+        finally:
+            self._active.discard(ref_path)
+            ref_cuts, ref_reach = self._frames.pop()
+        ref_cuts.discard(ref_path)
+        cuts |= ref_cuts
+        reach |= ref_reach
+
+        if ref_cuts:
+            return resolved
+
+        self._cache[key] = (resolved, frozenset(ref_reach))
+        return resolved if self.share else _copy_json(resolved)
 
 
 class Service:
-    def __init__(self, name, file_path):
+    def __init__(self, name, file_path, embedder=None, embedding_cache=None, stream=False):
         self.name = name
         self.file_path = file_path
+        # extract and embed endpoints incrementally, see get_service_endpoints
+        self.stream = stream
         self.definition = None
+        self.load_time = None
+        self.resolver = None
+        # batched embedding function, defaults to the OpenAI embeddings API
+        self.embedder = embedder
+        # optional EmbeddingCache consulted before calling the embedder
+        self.embedding_cache = embedding_cache
+
+    def _snapshot_path(self, kind):
+        if not SPEC_CACHE_DIR:
+            return None
+        stat = os.stat(self.file_path)
+        key = hashlib.sha256(
+            f"{SPEC_CACHE_VERSION}:{os.path.abspath(self.file_path)}:{stat.st_mtime_ns}:{stat.st_size}".encode()
+        ).hexdigest()[:16]
+        name = os.path.basename(self.file_path)
+        return os.path.join(SPEC_CACHE_DIR, f"{name}.{key}.{kind}.pickle")
+
+    def _load_snapshot(self, kind):
+        snapshot_path = self._snapshot_path(kind)
+        if snapshot_path is None or not os.path.exists(snapshot_path):
+            return None
+        try:
+            with open(snapshot_path, "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            print(f"Ignoring unreadable spec snapshot {snapshot_path}: {e}")
+            return None
+
+    def _save_snapshot(self, kind, data):
+        snapshot_path = self._snapshot_path(kind)
+        if snapshot_path is None:
+            return
+        # write and rename so concurrent loaders never read a partial file
+        tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(SPEC_CACHE_DIR, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, snapshot_path)
+        except OSError as e:
+            # the snapshot only saves time, the parsed spec is still good
+            print(f"Not saving the spec snapshot {snapshot_path}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
 
     def load_service_data(self):
         file_extension = os.path.splitext(self.file_path)[1].lower()
-
-        with open(self.file_path, "r") as f:
-            if file_extension == ".json":
-                self.definition = json.load(f)
-            elif file_extension in [".yml", ".yaml"]:
-                self.definition = yaml.safe_load(f)
-            else:
-                raise ValueError("Unsupported file format")
+        if file_extension not in [".json", ".yml", ".yaml"]:
+            raise ValueError("Unsupported file format")
+
+        start = time.perf_counter()
+        definition = None if self.stream else self._load_snapshot("definition")
+        if definition is not None:
+            self.definition = definition
+            source = "snapshot"
+        elif self.stream and file_extension == ".json" and ijson is not None:
+            # everything but the paths, which are streamed by iter_path_items
+            with open(self.file_path, "rb") as f:
+                self.definition = load_json_without_paths(f)
+            source = "json, streaming paths"
+        else:
+            with open(self.file_path, "rb") as f:
+                if file_extension == ".json":
+                    self.definition = json.load(f)
+                    source = "json"
+                else:
+                    self.definition = yaml.load(f, Loader=YamlLoader)
+                    source = f"yaml, {YamlLoader.__name__}"
+            if not self.stream:
+                self._save_snapshot("definition", self.definition)
+
+        self.load_time = time.perf_counter() - start
+        print(f"Loaded {self.file_path} in {self.load_time:.3f}s ({source})")
 
     def get_service_info(self):
         if self.definition is None:
@@ -135,9 +326,80 @@ class Service:
         return parameters
 
     def get_service_endpoints(self):
-        endpoints = []
+        """
+        Returns the endpoint records of the service with their embeddings. In stream
+        mode records are yielded as they are extracted and embedded, in chunks of
+        EMBED_CHUNK_SIZE, instead of returning a list.
+        """
+        if self.stream:
+            return self.iter_embedded_endpoints(self.iter_endpoints())
+        return self.embed_endpoints(self.extract_endpoints())
+
+    def get_paths(self):
+        if self.definition is None:
+            self.load_service_data()
+
+        return list(self.definition["paths"])
+
+    def extract_endpoints(self, paths=None):
+        """
+        Returns the endpoint records (without embeddings) of the service, or only
+        of the given paths.
+        """
+        if paths is None:
+            endpoints = self._load_snapshot("endpoints")
+            if endpoints is not None:
+                return endpoints
+
+        endpoints = list(self.iter_endpoints(paths))
+
+        if paths is None:
+            self._save_snapshot("endpoints", endpoints)
+
+        return endpoints
+
+    def iter_path_items(self, paths=None):
+        """
+        Yields the (path, endpoint dict) items of the spec. JSON specs loaded in
+        stream mode are read incrementally from the file instead of from memory.
+        """
+        if self.definition is None:
+            self.load_service_data()
+
+        streamed = (
+            self.stream
+            and ijson is not None
+            and os.path.splitext(self.file_path)[1].lower() == ".json"
+        )
+        if "paths" not in self.definition:
+            if not streamed:
+                raise ValueError(f"The spec {self.file_path} has no paths")
+            with open(self.file_path, "rb") as f:
+                for path, endpoint_dict in ijson.kvitems(f, "paths", use_float=True):
+                    if paths is None or path in paths:
+                        yield path, endpoint_dict
+        elif paths is None:
+            yield from self.definition["paths"].items()
+        else:
+            for path in paths:
+                yield path, self.definition["paths"][path]
+
+    def iter_endpoints(self, paths=None):
+        """
+        Yields the endpoint records (without embeddings) of the service, or only of
+        the given paths, one at a time.
+        """
+        if self.definition is None:
+            self.load_service_data()
+        if self.resolver is None:
+            # resolved definitions are only serialized, they can share subtrees
+            self.resolver = RefResolver(self.definition, share=True)
+
         for path, endpoint_dict in tqdm(
-            list(self.definition["paths"].items()), desc="Processing endpoints"
+            self.iter_path_items(paths),
+            desc="Processing endpoints",
+            unit=" paths",
+            disable=paths is not None,
         ):
             # if path != "/pipelines":
             #     continue
@@ -152,30 +414,100 @@ class Service:
                 endpoint["summary"] = method_dict.get("summary", "")
                 endpoint["description"] = method_dict.get("description", "")
 
+                # the spec is left untouched, the resolved definition is only kept
+                # in the serialized record
+                method_dict = dict(method_dict)
+
                 # let's resolve at least the parameters if they exist
                 if "parameters" in method_dict:
-                    method_dict["parameters"] = resolve_refs(
-                        path.split("/"), method_dict["parameters"], self.definition
+                    method_dict["parameters"] = self.resolver.resolve(
+                        path.split("/"), method_dict["parameters"]
                     )
 
                 if "responses" in method_dict:
-                    method_dict["responses"] = resolve_refs(
+                    method_dict["responses"] = self.resolver.resolve(
                         path.split("/"),
                         method_dict["responses"],
-                        self.definition,
                         only_schema_paths=True,
                     )
 
                 endpoint["definition"] = json.dumps(method_dict)
+                # budgets the prompts of the endpoint without tokenizing it again
+                endpoint.update(count_endpoint_tokens(endpoint))
+
+                yield endpoint
+
+    def iter_embedded_endpoints(self, endpoints):
+        """Embeds the endpoint records in chunks, yielding them as they are done."""
+        chunk = []
+        for endpoint in endpoints:
+            chunk.append(endpoint)
+            if len(chunk) == EMBED_CHUNK_SIZE:
+                yield from self.embed_endpoints(chunk)
+                chunk = []
+        if chunk:
+            yield from self.embed_endpoints(chunk)
+
+    def embed_endpoints(self, endpoints):
+        texts = [endpoint["definition"] for endpoint in endpoints]
+
+        if self.embedding_cache is not None:
+            embeddings = self.embedding_cache.get_many(texts, DEFAULT_EMBEDDING_MODEL)
+        else:
+            embeddings = [None] * len(texts)
+
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            new_embeddings = embed_texts(
+                [texts[i] for i in missing],
+                model=DEFAULT_EMBEDDING_MODEL,
+                embedder=self.embedder,
+            )
+            for i, embedding in zip(missing, new_embeddings):
+                embeddings[i] = embedding
 
-                try:
-                    endpoint["embedding"] = to_binary(
-                        get_embedding(endpoint["definition"])
-                    )
-                except ValueError as e:
-                    print(f"skip embedding {path}: {e}")
-                    endpoint["embedding"] = to_binary(np.array([]))
+            if self.embedding_cache is not None:
+                self.embedding_cache.put_many(
+                    [texts[i] for i in missing], new_embeddings, DEFAULT_EMBEDDING_MODEL
+                )
 
-                endpoints.append(endpoint)
+        for endpoint, embedding in zip(endpoints, embeddings):
+            if embedding is None:
+                print(f"skip embedding {endpoint['path']}: definition too long")
+                embedding = np.array([])
+            endpoint["embedding"] = to_binary(embedding)
 
         return endpoints
+
+
+# Specs loaded by this process, so that a pool worker handling several path
+# groups of the same spec only parses it once
+_loaded_services = {}
+
+
+def _get_loaded_service(name, file_path):
+    service = _loaded_services.get(file_path)
+    if service is None:
+        service = Service(name, file_path)
+        service.load_service_data()
+        _loaded_services[file_path] = service
+    return service
+
+
+def extract_first_path_group(name, file_path, group_size):
+    """
+    Returns the service info, all its paths and the endpoint records of the first
+    group_size paths, so small specs are handled by a single task. Meant to run in
+    a worker process.
+    """
+    service = _get_loaded_service(name, file_path)
+    paths = service.get_paths()
+    return service.get_service_info(), paths, service.extract_endpoints(paths[:group_size])
+
+
+def extract_path_group(name, file_path, paths):
+    """
+    Returns the endpoint records (without embeddings) of a group of paths of a
+    spec. Meant to run in a worker process.
+    """
+    return _get_loaded_service(name, file_path).extract_endpoints(paths)
@@ -1,95 +1,284 @@
 import os
 import glob
 import argparse
-from sqlalchemy import create_engine
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from sqlalchemy import create_engine, event, insert
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.exc import NoResultFound
 from dotenv import load_dotenv
+from tqdm import tqdm
 
-from openapi.service import Service
+from openapi.service import Service, extract_first_path_group, extract_path_group
 from database.services import (
     Services,
     ServiceCategories,
     ServiceAPIs,
     APIEndpoint,
     APIParameters,
-    DeleteService,
+    delete_service_rows,
 )
 
 from ai.embeddings import to_binary
+from ai.embedding_cache import EmbeddingCache
+from ai.ann import build_ann_index
+from ai.index import export_service_index
+from ai.lexical import export_service_lexical_index
 
 load_dotenv()
 
 
-def main(files, recreate=False):
-    # Connect to the SQLitef database
-    db_uri = "sqlite:///instance/apis.db"
-    engine = create_engine(db_uri)
-    Session = sessionmaker(bind=engine)
-    session = Session()
+INSERT_BATCH_SIZE = 500
+# Number of paths of a spec parsed by a single pool task with --workers
+PATH_GROUP_SIZE = 100
 
-    for file in files:
-        # Get the service name from the filename
-        service_name = os.path.basename(file).split(".")[0]
 
-        try:
-            service = (
-                session.query(Services).filter(Services.name == service_name).one()
-            )
-            if not recreate:
-                print(f"Service {service_name} already exists in the database. Skipping...")
-                continue
+def set_import_pragmas(dbapi_connection, connection_record):
+    # WAL avoids rewriting the whole journal on each commit and NORMAL sync only
+    # fsyncs at checkpoints, which is safe in WAL mode for a re-runnable import
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.close()
 
-            print(
-                f"Service {service_name} already exists in the database. Recreating..."
-            )
 
-            # Delete the service
-            DeleteService(session, service_name)
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-        except NoResultFound:
-            print(f"Adding new service to the database: {service_name}.")
 
-        # Create a new Service object
-        service = Service(service_name, file)
+def insert_endpoints(session, endpoints, service_id, api_id):
+    """
+    Inserts the endpoint records in batched executemany statements. Nothing is
+    committed, the caller owns the transaction.
 
-        # Get the service info
-        service_info = service.get_service_info()
+    Returns the number of inserted rows and the seconds spent inserting them.
+    """
+    rows, insert_time = 0, 0.0
+    progress = tqdm(desc="Inserting endpoints", unit=" rows")
+    for batch in batched(endpoints, INSERT_BATCH_SIZE):
+        start = time.perf_counter()
+        session.execute(
+            insert(APIEndpoint),
+            [
+                {
+                    "service_id": service_id,
+                    "api_id": api_id,
+                    "path": endpoint["path"],
+                    "method": endpoint["method"],
+                    "summary": endpoint["summary"],
+                    "description": endpoint["description"],
+                    "definition": endpoint["definition"],
+                    "embedding": endpoint["embedding"],
+                    "summary_tokens": endpoint.get("summary_tokens"),
+                    "description_tokens": endpoint.get("description_tokens"),
+                    "definition_tokens": endpoint.get("definition_tokens"),
+                }
+                for endpoint in batch
+            ],
+        )
+        insert_time += time.perf_counter() - start
+        rows += len(batch)
+        progress.update(len(batch))
+    progress.close()
+    return rows, insert_time
 
-        # Create a new Service object in the database
-        db_service = Services(
-            name=service_info["name"], description=service_info["description"]
+
+def prepare_service(session, service_name, recreate):
+    """
+    Returns whether the service has to be imported. An existing service is only
+    replaced by write_service, once the new one is ready.
+    """
+    try:
+        session.query(Services).filter(Services.name == service_name).one()
+        if not recreate:
+            print(f"Service {service_name} already exists in the database. Skipping...")
+            return False
+
+        print(f"Service {service_name} already exists in the database. Recreating...")
+
+    except NoResultFound:
+        print(f"Adding new service to the database: {service_name}.")
+
+    return True
+
+
+def write_service(session, service_info, endpoints):
+    """
+    Writes the service and its endpoints in a single transaction, replacing the
+    existing service of the same name, then exports the embeddings sidecar files
+    and the lexical index of the service. When anything fails, e.g. embedding the
+    streamed endpoints, the existing service is left untouched.
+
+    Returns the number of inserted endpoints and the seconds spent writing them.
+    """
+    # flush only to get the ids of the parent rows
+    try:
+        existing = (
+            session.query(Services).filter(Services.name == service_info["name"]).first()
         )
+        if existing is not None:
+            delete_service_rows(session, existing)
+            session.flush()
 
+        db_service = Services(
+            name=service_info["name"],
+            description=service_info["description"],
+            version=time.time_ns(),
+        )
         session.add(db_service)
-        session.commit()
+        session.flush()
 
-        # Create a new ServiceAPI object in the database
         db_service_api = ServiceAPIs(
             service_id=db_service.id,
             version=service_info["version"],
             base_url=service_info["base_url"],
         )
-
         session.add(db_service_api)
+        session.flush()
+
+        rows, insert_time = insert_endpoints(
+            session, endpoints, db_service.id, db_service_api.id
+        )
+
+        commit_start = time.perf_counter()
         session.commit()
+        insert_time += time.perf_counter() - commit_start
+    except Exception:
+        session.rollback()
+        raise
+
+    # memory-mapped by the app workers, see ai.index.get_service_index
+    export_service_index(session, service_info["name"])
+    export_service_lexical_index(session, service_info["name"])
+
+    return rows, insert_time
+
+
+def report(service_name, rows, elapsed, insert_time, embedding_cache):
+    print(
+        f"Imported {rows} endpoints of {service_name} in {elapsed:.2f}s "
+        f"({rows / elapsed:.0f} rows/s overall, {insert_time:.2f}s writing to the database)"
+    )
+    if embedding_cache is not None:
+        print(f"Embedding cache: {embedding_cache.stats()}")
 
-        # Create service endpoints
-        for endpoint in service.get_service_endpoints():
-            db_endpoint = APIEndpoint(
-                service_id=db_service.id,
-                api_id=db_service_api.id,
-                path=endpoint["path"],
-                method=endpoint["method"],
-                summary=endpoint["summary"],
-                description=endpoint["description"],
-                definition=endpoint["definition"],
-                embedding=endpoint["embedding"],
+
+def import_parallel(session, services, workers, embedding_cache):
+    """
+    Parses and resolves the specs in a process pool, splitting each spec in groups
+    of paths, while this process embeds and writes each service as soon as all its
+    groups are done. A service that fails to parse, embed or write is skipped,
+    keeping its previous version in the database, and the others go on.
+
+    Returns the names of the services that failed.
+    """
+    start = time.perf_counter()
+    failed = {}
+    with ProcessPoolExecutor(workers) as pool:
+        # future -> (service name, file, group number)
+        pending = {
+            pool.submit(extract_first_path_group, name, file, PATH_GROUP_SIZE): (name, file, 0)
+            for name, file in services
+        }
+        # service name -> [service info, endpoint groups, remaining groups]
+        results = {}
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, file, group = pending.pop(future)
+                if name in failed:
+                    continue
+
+                try:
+                    if group == 0:
+                        service_info, paths, endpoints = future.result()
+                        extra_groups = range(PATH_GROUP_SIZE, len(paths), PATH_GROUP_SIZE)
+                        for number, i in enumerate(extra_groups, start=1):
+                            paths_group = paths[i : i + PATH_GROUP_SIZE]
+                            pending[
+                                pool.submit(extract_path_group, name, file, paths_group)
+                            ] = (name, file, number)
+                        results[name] = [service_info, {0: endpoints}, len(extra_groups)]
+                    else:
+                        results[name][1][group] = future.result()
+                        results[name][2] -= 1
+
+                    service_info, groups, remaining = results[name]
+                    if remaining > 0:
+                        continue
+
+                    endpoints = [e for number in sorted(groups) for e in groups[number]]
+                    service = Service(name, file, embedding_cache=embedding_cache)
+                    rows, insert_time = write_service(
+                        session, service_info, service.embed_endpoints(endpoints)
+                    )
+                except Exception as e:
+                    print(f"Failed to import {name} from {file}: {e}")
+                    failed[name] = e
+                    results.pop(name, None)
+                    continue
+                report(name, rows, time.perf_counter() - start, insert_time, embedding_cache)
+
+    print(
+        f"Imported {len(services) - len(failed)} services in {time.perf_counter() - start:.2f}s"
+    )
+    if failed:
+        print(f"Failed services, left as they were: {', '.join(failed)}")
+    return list(failed)
+
+
+def main(files, recreate=False, use_embedding_cache=True, workers=1, stream=False):
+    # Connect to the SQLitef database
+    db_uri = "sqlite:///instance/apis.db"
+    engine = create_engine(db_uri)
+    event.listen(engine, "connect", set_import_pragmas)
+    Session = sessionmaker(bind=engine)
+    session = Session()
+
+    embedding_cache = EmbeddingCache() if use_embedding_cache else None
+
+    services = []
+    for file in files:
+        # Get the service name from the filename
+        service_name = os.path.basename(file).split(".")[0]
+        if prepare_service(session, service_name, recreate):
+            services.append((service_name, file))
+
+    if workers > 1:
+        import_parallel(session, services, workers, embedding_cache)
+    else:
+        for service_name, file in services:
+            start = time.perf_counter()
+
+            # Create a new Service object
+            service = Service(
+                service_name, file, embedding_cache=embedding_cache, stream=stream
             )
 
-            session.add(db_endpoint)
-            session.commit()
+            rows, insert_time = write_service(
+                session, service.get_service_info(), service.get_service_endpoints()
+            )
+            report(
+                service_name, rows, time.perf_counter() - start, insert_time, embedding_cache
+            )
 
+    if len(services) > 0:
+        start = time.perf_counter()
+        ann_index = build_ann_index(session)
+        print(
+            f"Built the cross-service search index over {len(ann_index)} endpoints "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
 
     # Don't forget to close the session when you're done
     session.close()
@@ -103,6 +292,22 @@ if __name__ == "__main__":
     parser.add_argument(
         "--recreate", action="store_true", help="Overwrite db entries for existing apis"
     )
+    parser.add_argument(
+        "--no_embedding_cache",
+        action="store_true",
+        help="Embed every endpoint instead of reusing cached embeddings",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes parsing the definition files",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Extract, embed and insert endpoints incrementally to bound memory usage",
+    )
 
     args = parser.parse_args()
 
@@ -116,4 +321,4 @@ if __name__ == "__main__":
         files = glob.glob(os.path.join(definitions_dir, "slack.json"))
         # files = glob.glob(os.path.join(definitions_dir, "*.json"))
         # files.extend(glob.glob(os.path.join(definitions_dir, "*.yml")))
-    main(files, recreate)
+    main(files, recreate, not args.no_embedding_cache, args.workers, args.stream)
@@ -0,0 +1,41 @@
+from dataclasses import dataclass
+from typing import Any, Optional
+
+
+@dataclass
+class RunResult:
+    """Outcome of a script: its standard output, and the error when it failed."""
+
+    output: Optional[str]
+    error: Optional[str]
+    exit_code: Optional[int] = None
+    timed_out: bool = False
+
+
+class RunnerBackend:
+    """
+    Starts the runners of a RunnerPool and executes the scripts in them. A runner
+    is whatever the backend needs to run one script quickly, e.g. a container.
+    """
+
+    # runners that can only run one script, never reset
+    single_use = False
+
+    def start(self) -> Any:
+        """Starts a runner and returns its handle."""
+        raise NotImplementedError
+
+    def execute(self, handle, code: str, timeout: float) -> RunResult:
+        raise NotImplementedError
+
+    def healthy(self, handle) -> bool:
+        return True
+
+    def reset(self, handle):
+        """Cleans what the previous script left in the runner."""
+
+    def stop(self, handle):
+        pass
+
+    def close(self):
+        """Releases the resources of the backend, once the pool is closed."""
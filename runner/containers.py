@@ -0,0 +1,107 @@
+import os
+import uuid
+
+import docker
+from docker.errors import APIError, NotFound
+
+from runner.backend import RunnerBackend, RunResult
+
+RUNNER_IMAGE = os.getenv("RUNNER_IMAGE", "talk2apis-code-runner")
+# Resources of each runner container
+RUNNER_MEMORY = os.getenv("RUNNER_MEMORY", "256m")
+RUNNER_CPUS = float(os.getenv("RUNNER_CPUS", "1"))
+RUNNER_PIDS = 64
+# The scripts call the APIs of the services, "none" cuts them off
+RUNNER_NETWORK = os.getenv("RUNNER_NETWORK", "bridge")
+# Scripts are passed as a single `python -c` argument, limited to 128 KiB by Linux
+MAX_SCRIPT_BYTES = 128 * 1024 - 1
+# Exit status of a script stopped by `timeout`
+TIMEOUT_EXIT_CODE = 124
+LABEL = "talk2apis.runner"
+
+
+class DockerBackend(RunnerBackend):
+    """
+    Runner containers of the code-runner image for a RunnerPool. The containers
+    idle on `sleep infinity` and each script runs with `docker exec`, so nothing
+    is shared with the host: the root file system is read-only, /tmp is a small
+    tmpfs and the scripts run as nobody, without capabilities.
+    """
+
+    def __init__(
+        self,
+        image: str = RUNNER_IMAGE,
+        memory: str = RUNNER_MEMORY,
+        cpus: float = RUNNER_CPUS,
+        network: str = RUNNER_NETWORK,
+    ):
+        self.client = docker.from_env()
+        self.image = image
+        self.memory = memory
+        self.cpus = cpus
+        self.network = network
+        # tells the containers of this pool apart, to remove them all on close
+        self.labels = {LABEL: uuid.uuid4().hex}
+
+    def start(self):
+        return self.client.containers.run(
+            self.image,
+            ["sleep", "infinity"],
+            detach=True,
+            init=True,  # reaps the processes the scripts leave behind
+            read_only=True,
+            tmpfs={"/tmp": "rw,nosuid,nodev,size=64m"},
+            working_dir="/tmp",
+            environment={"HOME": "/tmp", "PYTHONDONTWRITEBYTECODE": "1"},
+            user="nobody",
+            cap_drop=["ALL"],
+            security_opt=["no-new-privileges"],
+            mem_limit=self.memory,
+            nano_cpus=int(self.cpus * 1e9),
+            pids_limit=RUNNER_PIDS,
+            network=self.network,
+            labels=self.labels,
+        )
+
+    def execute(self, container, code: str, timeout: float) -> RunResult:
+        if len(code.encode()) > MAX_SCRIPT_BYTES:
+            return RunResult(None, f"Script longer than {MAX_SCRIPT_BYTES} bytes")
+
+        exit_code, (stdout, stderr) = container.exec_run(
+            ["timeout", "-k", "1", str(timeout), "python", "-c", code], demux=True
+        )
+        output = (stdout or b"").decode("utf-8", errors="replace")
+        if exit_code == 0:
+            return RunResult(output, None, exit_code)
+        if exit_code == TIMEOUT_EXIT_CODE:
+            error = f"Script timed out after {timeout:g} seconds"
+            return RunResult(output, error, exit_code, timed_out=True)
+        error = (stderr or b"").decode("utf-8", errors="replace")
+        return RunResult(output, error or f"Script exited with status {exit_code}", exit_code)
+
+    def healthy(self, container) -> bool:
+        container.reload()
+        return container.status == "running" and container.exec_run(["true"]).exit_code == 0
+
+    def reset(self, container):
+        # the files the previous script left in /tmp
+        exit_code, output = container.exec_run(
+            ["sh", "-c", "rm -rf /tmp/* /tmp/.[!.]* /tmp/..?*"]
+        )
+        if exit_code != 0:
+            raise RuntimeError(output.decode("utf-8", errors="replace"))
+
+    def stop(self, container):
+        try:
+            container.remove(force=True)
+        except NotFound:
+            pass
+
+    def close(self):
+        label = ",".join(f"{k}={v}" for k, v in self.labels.items())
+        for container in self.client.containers.list(all=True, filters={"label": label}):
+            try:
+                self.stop(container)
+            except APIError:
+                pass
+        self.client.close()
@@ -0,0 +1,283 @@
+import atexit
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Deque, Optional
+
+from runner.backend import RunnerBackend, RunResult
+
+logger = logging.getLogger(__name__)
+
+# Runners started ahead of the requests, 0 starts one per run
+RUNNER_POOL_SIZE = int(os.getenv("RUNNER_POOL_SIZE", "2"))
+# Scripts run by a runner before it is replaced, 1 gives each script a fresh one
+RUNNER_MAX_RUNS = int(os.getenv("RUNNER_MAX_RUNS", "1"))
+RUNNER_TIMEOUT = float(os.getenv("RUNNER_TIMEOUT", "60"))  # seconds per script
+RUNNER_HEALTH_INTERVAL = float(os.getenv("RUNNER_HEALTH_INTERVAL", "30"))  # seconds
+# Where the scripts run: "docker" (containers of the code-runner image) or
+# "subprocess" (local processes under resource limits, for trusted deployments)
+RUNNER_BACKEND = os.getenv("RUNNER_BACKEND", "docker")
+
+
+@dataclass
+class _Worker:
+    handle: Any  # what the backend started, e.g. a container
+    pooled: bool = True
+    runs: int = 0
+
+
+class RunnerPool:
+    """
+    Keeps `size` runners started ahead of the requests, so a script only waits for
+    its own execution. A runner is discarded after `max_runs` scripts, or after one
+    that timed out, and a new one is started in the background; in between runs,
+    the backend resets it. Idle runners are health checked every
+    `health_interval` seconds. When every runner is busy the script gets one
+    started on the spot, which is discarded afterwards.
+    """
+
+    def __init__(
+        self,
+        backend: RunnerBackend,
+        size: int = RUNNER_POOL_SIZE,
+        max_runs: int = RUNNER_MAX_RUNS,
+        timeout: float = RUNNER_TIMEOUT,
+        health_interval: float = RUNNER_HEALTH_INTERVAL,
+    ):
+        self.backend = backend
+        self.size = max(0, size)
+        self.max_runs = max(1, max_runs)
+        self.timeout = timeout
+        self.health_interval = health_interval
+
+        self._lock = threading.Lock()
+        self._idle: Deque[_Worker] = deque()
+        self._pooled = 0  # pooled runners, started, running or idle
+        self._busy = 0
+        self._closed = False
+        self._closing = threading.Event()
+        self._stats = {
+            "runs": 0,
+            "warm_runs": 0,
+            "cold_starts": 0,
+            "recycled": 0,
+            "unhealthy": 0,
+            "start_failures": 0,
+        }
+        # starts, resets and stops the runners off the request threads
+        self._background = ThreadPoolExecutor(
+            max(1, min(self.size, 4)), thread_name_prefix="runner-pool"
+        )
+
+        self._fill()
+        if self.size and health_interval:
+            threading.Thread(target=self._health_loop, daemon=True).start()
+
+    def _fill(self):
+        with self._lock:
+            missing = 0 if self._closed else self.size - self._pooled
+            self._pooled += max(0, missing)
+        for _ in range(missing):
+            self._submit(self._start_pooled)
+
+    def _submit(self, fn, *args):
+        try:
+            self._background.submit(fn, *args)
+        except RuntimeError:
+            # closed pool, the busy runners are stopped as they are released
+            fn(*args)
+
+    def _start_pooled(self):
+        try:
+            worker = _Worker(self.backend.start())
+        except Exception as e:
+            # retried by the next health check
+            logger.warning(f"Couldn't start a runner: {e}")
+            with self._lock:
+                self._pooled -= 1
+                self._stats["start_failures"] += 1
+            return
+        self._make_idle(worker)
+
+    def _make_idle(self, worker: _Worker):
+        with self._lock:
+            if not self._closed:
+                self._idle.append(worker)
+                return
+        self.backend.stop(worker.handle)
+
+    def _acquire(self) -> _Worker:
+        with self._lock:
+            self._stats["runs"] += 1
+            self._busy += 1
+            if self._idle:
+                self._stats["warm_runs"] += 1
+                return self._idle.popleft()
+            self._stats["cold_starts"] += 1
+        try:
+            return _Worker(self.backend.start(), pooled=False)
+        except Exception:
+            with self._lock:
+                self._busy -= 1
+            raise
+
+    def _release(self, worker: _Worker, reusable: bool):
+        with self._lock:
+            self._busy -= 1
+        worker.runs += 1
+        if (
+            worker.pooled
+            and reusable
+            and not self.backend.single_use
+            and worker.runs < self.max_runs
+        ):
+            self._submit(self._recycle, worker)
+        else:
+            self._submit(self._discard, worker)
+
+    def _recycle(self, worker: _Worker):
+        try:
+            self.backend.reset(worker.handle)
+        except Exception as e:
+            logger.warning(f"Couldn't reset a runner: {e}")
+            self._discard(worker)
+            return
+        with self._lock:
+            self._stats["recycled"] += 1
+        self._make_idle(worker)
+
+    def _discard(self, worker: _Worker):
+        try:
+            self.backend.stop(worker.handle)
+        except Exception as e:
+            logger.warning(f"Couldn't stop a runner: {e}")
+        if worker.pooled:
+            with self._lock:
+                self._pooled -= 1
+            self._fill()
+
+    def check(self):
+        """Replaces the idle runners that fail the health check, and the missing ones."""
+        with self._lock:
+            workers = list(self._idle)
+        for worker in workers:
+            try:
+                healthy = self.backend.healthy(worker.handle)
+            except Exception:
+                healthy = False
+            if healthy:
+                continue
+            with self._lock:
+                # unless a script took it in the meantime, which then discards it
+                if worker not in self._idle:
+                    continue
+                self._idle.remove(worker)
+                self._stats["unhealthy"] += 1
+            self._discard(worker)
+        self._fill()
+
+    def _health_loop(self):
+        while not self._closing.wait(self.health_interval):
+            try:
+                self.check()
+            except Exception as e:
+                logger.warning(f"Runner health check failed: {e}")
+
+    def run(self, code: str, timeout: Optional[float] = None) -> RunResult:
+        """Runs a script in an idle runner, or in a new one if there is none."""
+        try:
+            worker = self._acquire()
+        except Exception as e:
+            return RunResult(None, f"Couldn't start a runner: {e}")
+
+        reusable = False
+        try:
+            result = self.backend.execute(worker.handle, code, timeout or self.timeout)
+            reusable = not result.timed_out
+            return result
+        except Exception as e:
+            return RunResult(None, str(e))
+        finally:
+            self._release(worker, reusable)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self._stats,
+                "size": self.size,
+                "idle": len(self._idle),
+                "busy": self._busy,
+            }
+
+    def close(self):
+        """Stops the idle runners, the busy ones are stopped when they are done."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+        self._closing.set()
+        for worker in idle:
+            self._submit(self.backend.stop, worker.handle)
+        self._background.shutdown(wait=True)
+        self.backend.close()
+
+
+_runner_pool = None
+_runner_pool_lock = threading.Lock()
+
+
+def make_backend(name: str = RUNNER_BACKEND) -> RunnerBackend:
+    # imported on demand, the subprocess backend doesn't need the docker package
+    if name == "docker":
+        from runner.containers import DockerBackend
+
+        return DockerBackend()
+    if name == "subprocess":
+        from runner.processes import SubprocessBackend
+
+        return SubprocessBackend()
+    raise ValueError(f"Unknown runner backend {name}, use docker or subprocess")
+
+
+def get_runner_pool() -> RunnerPool:
+    """
+    Returns the process-wide pool of runners of the RUNNER_BACKEND backend,
+    started on first use with RUNNER_POOL_SIZE runners, each one replaced after
+    RUNNER_MAX_RUNS scripts.
+    """
+    global _runner_pool
+    if _runner_pool is None:
+        with _runner_pool_lock:
+            if _runner_pool is None:
+                _runner_pool = RunnerPool(make_backend())
+                atexit.register(_runner_pool.close)
+    return _runner_pool
+
+
+def set_runner_pool(pool: RunnerPool):
+    """Replaces the process-wide pool, e.g. with one of another backend."""
+    global _runner_pool
+    with _runner_pool_lock:
+        previous, _runner_pool = _runner_pool, pool
+    if previous is not None:
+        previous.close()
+    atexit.register(pool.close)
+
+
+def runner_pool_stats() -> Optional[dict]:
+    """Stats of the process-wide pool, None until it is started."""
+    pool = _runner_pool
+    return pool.stats() if pool is not None else None
+
+
+def warm_runner_pool():
+    """Starts the pool ahead of the first script, if the backend is available."""
+    try:
+        get_runner_pool()
+    except Exception as e:
+        logger.warning(f"Code runners not started: {e}")
@@ -0,0 +1,140 @@
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+from dataclasses import dataclass
+
+from runner.backend import RunnerBackend, RunResult
+
+SANDBOX = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sandbox.py")
+
+RUNNER_MEMORY = os.getenv("RUNNER_MEMORY", "256m")
+# CPU seconds of a script, its wall time is limited by RUNNER_TIMEOUT
+RUNNER_CPU_TIME = int(os.getenv("RUNNER_CPU_TIME", os.getenv("RUNNER_TIMEOUT", "60")))
+# Network of the scripts: "none" isolates them, anything else lets them call the APIs
+RUNNER_NETWORK = os.getenv("RUNNER_NETWORK", "bridge")
+# Modules imported before the script arrives, so it doesn't wait for them
+RUNNER_PRELOAD = [m for m in os.getenv("RUNNER_PRELOAD", "requests,json").split(",") if m]
+MAX_FILE_SIZE = 16 * 1024 * 1024  # bytes
+MAX_OPEN_FILES = 256
+
+SIZE_UNITS = {"k": 1024, "m": 1024**2, "g": 1024**3}
+
+
+def parse_size(size: str) -> int:
+    # docker style sizes: 512k, 256m, 1g
+    size = size.strip().lower()
+    if size and size[-1] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(size)
+
+
+@dataclass
+class _Process:
+    process: subprocess.Popen
+    workdir: str
+
+
+class SubprocessBackend(RunnerBackend):
+    """
+    Runs the scripts in local Python processes, for trusted deployments where
+    going through the Docker daemon costs more than the script. Each runner is an
+    interpreter started ahead of the script (runner/sandbox.py) with rlimits on
+    memory, CPU time, file sizes and open files, no core dumps, the network cut
+    off when RUNNER_NETWORK=none, and the system calls of DENIED_SYSCALLS denied
+    when the seccomp bindings are installed. It runs in a temporary directory
+    with a minimal environment, but otherwise sees the file system of the app.
+    """
+
+    single_use = True
+
+    def __init__(
+        self,
+        memory: str = RUNNER_MEMORY,
+        cpu_time: int = RUNNER_CPU_TIME,
+        network: str = RUNNER_NETWORK,
+        preload=RUNNER_PRELOAD,
+        python: str = sys.executable,
+    ):
+        self.python = python
+        self.cpu_time = cpu_time
+        self.config = json.dumps(
+            {
+                "limits": {
+                    "RLIMIT_AS": parse_size(memory),
+                    # SIGXCPU at the soft limit, SIGKILL a second later
+                    "RLIMIT_CPU": [cpu_time, cpu_time + 1],
+                    "RLIMIT_FSIZE": MAX_FILE_SIZE,
+                    "RLIMIT_NOFILE": MAX_OPEN_FILES,
+                    "RLIMIT_CORE": 0,
+                },
+                "network": network != "none",
+                "preload": list(preload),
+            }
+        )
+
+    def start(self) -> _Process:
+        workdir = tempfile.mkdtemp(prefix="talk2apis-run-")
+        env = {
+            "PATH": os.defpath,
+            "HOME": workdir,
+            "TMPDIR": workdir,
+            "LANG": "C.UTF-8",
+            "LC_ALL": "C.UTF-8",
+        }
+        try:
+            process = subprocess.Popen(
+                # -I: no PYTHON* variables, user site-packages or working directory in the path
+                [self.python, "-I", SANDBOX, self.config],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=workdir,
+                env=env,
+                # its own process group, killed as a whole
+                start_new_session=True,
+            )
+        except Exception:
+            shutil.rmtree(workdir, ignore_errors=True)
+            raise
+        return _Process(process, workdir)
+
+    def execute(self, handle: _Process, code: str, timeout: float) -> RunResult:
+        process = handle.process
+        try:
+            stdout, stderr = process.communicate(code.encode(), timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self._kill(handle)
+            stdout, _ = process.communicate()
+            error = f"Script timed out after {timeout:g} seconds"
+            return RunResult(stdout.decode("utf-8", errors="replace"), error, timed_out=True)
+
+        output = stdout.decode("utf-8", errors="replace")
+        exit_code = process.returncode
+        if exit_code == 0:
+            return RunResult(output, None, exit_code)
+        error = stderr.decode("utf-8", errors="replace")
+        if exit_code == -signal.SIGXCPU:
+            error = f"{error}Script exceeded {self.cpu_time} seconds of CPU time"
+        return RunResult(output, error or f"Script exited with status {exit_code}", exit_code)
+
+    def _kill(self, handle: _Process):
+        try:
+            os.killpg(handle.process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def healthy(self, handle: _Process) -> bool:
+        return handle.process.poll() is None
+
+    def stop(self, handle: _Process):
+        # the processes the script left behind go with it
+        self._kill(handle)
+        handle.process.wait()
+        for pipe in (handle.process.stdin, handle.process.stdout, handle.process.stderr):
+            if pipe:
+                pipe.close()
+        shutil.rmtree(handle.workdir, ignore_errors=True)
@@ -1,5 +1,49 @@
 
 
+// Posts the prompt to /gen-script/stream and calls handlers[event](data) for each
+// server-sent event of the response as soon as it arrives.
+async function streamScript(service, token, prompt, handlers) {
+    let response = await fetch('/gen-script/stream', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({ service: service, token: token, prompt: prompt })
+    });
+
+    if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+    }
+
+    let reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = '';
+    while (true) {
+        let { value, done } = await reader.read();
+        if (done) {
+            break;
+        }
+        buffer += value;
+
+        // events are separated by a blank line
+        let events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (let event of events) {
+            let name = 'message';
+            let data = '';
+            for (let line of event.split('\n')) {
+                if (line.startsWith('event: ')) {
+                    name = line.slice(7);
+                } else if (line.startsWith('data: ')) {
+                    data += line.slice(6);
+                }
+            }
+            if (handlers[name]) {
+                handlers[name](JSON.parse(data));
+            }
+        }
+    }
+}
+
 $(document).ready(function() {
     // Initialize ACE Editor
     var editor = ace.edit("editor"); // Make sure your HTML has a div with id="editor" for this
@@ -31,36 +75,36 @@ $(document).ready(function() {
         var token = $('#token').val();
         var prompt = $('#prompt').val();
 
-        console.log('making jaax call')
-        // Send data to the server
-        $.ajax({
-            url: '/gen-script',
-            method: 'POST',
-            contentType: 'application/json',
-            data: JSON.stringify({ service: service, token: token, prompt: prompt }),
-            success: function(response) {
-                // Set the returned code in the ACE Editor
-                editor.setValue(response.code, -1); // Update ACE Editor content
-
+        // Stream the generated code into the editor as it arrives
+        editor.setValue("", -1);
+        $('#endpoints').empty();
+        streamScript(service, token, prompt, {
+            endpoints: function(endpoints) {
                 // Handle the endpoints array
                 var endpointsElement = $('#endpoints');
-                endpointsElement.empty(); // Clear the previous endpoints
-                response.endpoints.forEach(function(endpoint) {
+                endpoints.forEach(function(endpoint) {
                     // Convert the endpoint object to a nicely formatted JSON string
                     var endpointStr = JSON.stringify(endpoint, null, 2);
                     // Append the endpoint string to the endpoints element
                     endpointsElement.append('<pre>' + endpointStr + '</pre>');
                 });
-
-                // Enable the submit button
-                $('#output').text("");
-                submitButton.disabled = false;
+            },
+            code: function(chunk) {
+                // Append at the end of the document without moving the view
+                var session = editor.getSession();
+                session.insert({ row: session.getLength(), column: 0 }, chunk);
             },
             error: function(error) {
-                console.error('error: /gen-script:', error);
-                $('#output').text('Error generating code.', error);
-                submitButton.disabled = false;
+                throw new Error(error.error);
             }
+        }).then(function() {
+            $('#output').text("");
+        }).catch(function(error) {
+            console.error('error: /gen-script/stream:', error);
+            $('#output').text('Error generating code. ' + error.message);
+        }).finally(function() {
+            // Enable the submit button
+            submitButton.disabled = false;
         });
     });
 
@@ -0,0 +1,58 @@
+"""
+Limits of the subprocess runners (runner/processes.py, runner/sandbox.py), checked
+on the local box, no Docker needed:
+
+    python -m pytest tests/test_subprocess_runner.py
+"""
+import signal
+import sys
+
+import pytest
+
+from runner.processes import SubprocessBackend
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="the sandbox needs Linux rlimits and namespaces"
+)
+
+
+def run(code, timeout=10, **options):
+    backend = SubprocessBackend(preload=[], **options)
+    handle = backend.start()
+    try:
+        return backend.execute(handle, code, timeout)
+    finally:
+        backend.stop(handle)
+
+
+def test_timeout():
+    result = run("import time\ntime.sleep(30)", timeout=1)
+    assert result.timed_out
+    assert "timed out" in result.error
+
+
+def test_cpu_time():
+    result = run("while True:\n    pass", timeout=30, cpu_time=1)
+    assert result.exit_code == -signal.SIGXCPU
+    assert "CPU time" in result.error
+
+
+def test_memory():
+    result = run("data = bytearray(1024 ** 3)", memory="256m")
+    assert result.exit_code == 1
+    assert "MemoryError" in result.error
+
+
+def test_no_network():
+    code = (
+        "import errno, socket\n"
+        "try:\n"
+        "    socket.create_connection(('1.1.1.1', 53), timeout=5)\n"
+        "    print('connected')\n"
+        "except OSError as e:\n"
+        "    print(errno.errorcode.get(e.errno))\n"
+    )
+    result = run(code, network="none")
+    assert result.error is None
+    # ENETUNREACH in a network namespace, EPERM when only the sockets are blocked
+    assert result.output.strip() in ("ENETUNREACH", "EPERM")